@@ -0,0 +1,110 @@
+from __future__ import print_function, division
+
+"""
+Online adaptation of linear discriminant classifiers
+
+Class means and the inverse of the common covariance matrix are updated
+with exponential forgetting, using the Sherman-Morrison formula for the
+covariance so that each update costs O(features^2).
+
+Supported models: pycnbi.decoder.rlda.rLDA and scikit-learn's
+LinearDiscriminantAnalysis (binary case). The scikit-learn model must
+expose the covariance_ attribute (store_covariance=True or solver='lsqr').
+
+Reference:
+Vidaurre et al., "Toward Unsupervised Adaptation of LDA for Brain-Computer
+Interfaces", IEEE Trans. Biomed. Eng., 2011.
+
+"""
+
+import numpy as np
+from pycnbi.decoder.rlda import rLDA
+
+
+class LDAAdapter(object):
+    def __init__(self, cls, uc_mu=0.01, uc_cov=0.001):
+        """
+        Params
+        ======
+        cls: trained rLDA or binary LinearDiscriminantAnalysis object
+        uc_mu: update coefficient of class means in (0, 1)
+        uc_cov: update coefficient of the covariance matrix in (0, 1)
+        """
+        if not 0 < uc_mu < 1 or not 0 < uc_cov < 1:
+            raise ValueError('Update coefficients must be between 0 and 1.')
+        self.uc_mu = uc_mu
+        self.uc_cov = uc_cov
+        self.labels = list(cls.classes_)
+        if len(self.labels) != 2:
+            raise NotImplementedError('Adaptation is supported for binary classifiers only.')
+
+        if isinstance(cls, rLDA):
+            if not hasattr(cls, 'cov_inv'):
+                raise RuntimeError('The rLDA model does not contain adaptation statistics. Please retrain it.')
+            self.mu = np.array([cls.mu1, cls.mu2], dtype=np.float64)
+            self.cov_inv = np.array(cls.cov_inv, dtype=np.float64)
+            self.b_offset = 0.0
+        elif hasattr(cls, 'means_') and hasattr(cls, 'coef_'):
+            if not hasattr(cls, 'covariance_'):
+                raise RuntimeError('The LDA model does not contain covariance_. Train it with store_covariance=True.')
+            self.mu = np.array(cls.means_, dtype=np.float64)
+            self.cov_inv = np.linalg.pinv(cls.covariance_)
+            # keep the prior term of the bias
+            w = cls.coef_[0]
+            self.b_offset = float(cls.intercept_[0] + np.dot(w, self.mu.mean(axis=0)))
+        else:
+            raise NotImplementedError('Adaptation is not supported for %s.' % type(cls))
+        self.mu_all = self.mu.mean(axis=0)
+        self.n_updates = 0
+
+    def update(self, X, Y):
+        """
+        Update the model statistics with labelled samples
+
+        Params
+        ======
+        X: [samples x features]
+        Y: [samples] class labels
+        """
+        X = np.atleast_2d(X)
+        for x, y in zip(X, np.ravel(Y)):
+            k = self.labels.index(y)
+            self.mu[k] = (1 - self.uc_mu) * self.mu[k] + self.uc_mu * x
+            self.mu_all = (1 - self.uc_cov) * self.mu_all + self.uc_cov * x
+
+            # Sherman-Morrison update of the inverse covariance
+            v = x - self.mu_all
+            u = np.dot(self.cov_inv, v)
+            denom = (1 - self.uc_cov) / self.uc_cov + np.dot(v, u)
+            self.cov_inv = (self.cov_inv - np.outer(u, u) / denom) / (1 - self.uc_cov)
+            self.n_updates += 1
+
+    def get_weights(self):
+        """
+        Returns
+        =======
+        w: weight vector [features]
+        b: bias scalar
+        """
+        w = np.dot(self.cov_inv, self.mu[1] - self.mu[0])
+        b = -np.dot(w, self.mu.mean(axis=0)) + self.b_offset
+        return w, b
+
+    def apply(self, cls):
+        """
+        Write the current weights into the classifier
+        """
+        w, b = self.get_weights()
+        set_weights(cls, w, b)
+
+
+def set_weights(cls, w, b):
+    """
+    Replace the weights of a linear discriminant classifier in place
+    """
+    if isinstance(cls, rLDA):
+        cls.w = np.array(w, dtype=np.float64)
+        cls.b = np.array([b], dtype=np.float64)
+    else:
+        cls.coef_ = np.array(w, dtype=np.float64).reshape(1, -1)
+        cls.intercept_ = np.array([b], dtype=np.float64)
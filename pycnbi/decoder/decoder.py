@@ -25,18 +25,63 @@ import random
 import os
 import sys
 import psutil
+import pylsl
 import pycnbi.utils.pycnbi_utils as pu
 import pycnbi.utils.q_common as qc
 import numpy as np
 import multiprocessing as mp
 import multiprocessing.sharedctypes as sharedctypes
+try:
+    import queue
+except ImportError:
+    import Queue as queue
 import mne
 from pycnbi.stream_receiver.stream_receiver import StreamReceiver
 from pycnbi.triggers.trigger_def import trigger_def
+from pycnbi.utils.cnbi_lsl import start_server
+from pycnbi.decoder.adaptation import LDAAdapter, set_weights
 from numpy import ctypeslib
 mne.set_log_level('ERROR')
 os.environ['OMP_NUM_THREADS'] = '1' # actually improves performance for multitaper
 
+def compute_psd(psde, w, w_frames):
+    """
+    Compute PSD of the latest samples for one or more window lengths
+
+    Params
+    ------
+        psde: MNE PSDEstimator object
+        w: signal array (trials x channels x times)
+        w_frames: window length in frames, or list of window lengths.
+            Each window ends at the last sample of w and PSDs are concatenated
+            along the frequency axis, matching pycnbi_utils.slice_win().
+
+    Returns
+    -------
+        PSD array (trials x channels x freqs)
+    """
+    if type(w_frames) is not list:
+        return psde.transform(w[:, :, -w_frames:])
+    return np.concatenate([psde.transform(w[:, :, -wf:]) for wf in w_frames], axis=2)
+
+
+def compute_timelag(w, w_frames, downsample):
+    """
+    Compute timelag features of the latest samples, matching trainer.get_timelags()
+
+    Params
+    ------
+        w: signal array (trials x channels x times)
+        w_frames: window length in frames before downsampling
+        downsample: number of samples to average
+
+    Returns
+    -------
+        feature array (trials x channels x lags)
+    """
+    return pu.decimate_mean(w[:, :, -w_frames:], downsample)
+
+
 def get_decoder_info(classifier):
     """
     Get only the classifier information without connecting to a server
@@ -62,12 +107,21 @@ def get_decoder_info(classifier):
     w_frames = model['w_frames']
     wstep = model['wstep']
     sfreq = model['sfreq']
-    psd_temp = psde.transform(np.zeros((1, len(model['picks']), w_frames)))
+    w_temp = np.zeros((1, len(model['picks']), np.max(w_frames)))
+    if model.get('features', 'PSD') == 'TIMELAG':
+        psd_temp = compute_timelag(w_temp, w_frames, model['downsample'])
+    else:
+        psd_temp = compute_psd(psde, w_temp, w_frames)
     psd_shape = psd_temp.shape
     psd_size = psd_temp.size
+    feat_index = model.get('feat_index', None)
+    if feat_index is None:
+        n_features = psd_size
+    else:
+        n_features = len(feat_index)
 
     info = dict(labels=labels, cls=cls, psde=psde, w_seconds=w_seconds, w_frames=w_frames,\
-                wstep=wstep, sfreq=sfreq, psd_shape=psd_shape, psd_size=psd_size)
+                wstep=wstep, sfreq=sfreq, psd_shape=psd_shape, psd_size=psd_size, n_features=n_features)
     return info
 
 
@@ -110,8 +164,18 @@ class BCIDecoder(object):
             self.w_frames = model['w_frames']
             self.wstep = model['wstep']
             self.sfreq = model['sfreq']
-            if not int(self.sfreq * self.w_seconds) == self.w_frames:
-                raise RuntimeError('sfreq * w_sec %d != w_frames %d' % (int(self.sfreq * self.w_seconds), self.w_frames))
+            self.features = model.get('features', 'PSD')
+            self.downsample = model.get('downsample', 1)
+            # indices of features used by a pruned model. None: use all PSD features.
+            self.feat_index = model.get('feat_index', None)
+            if type(self.w_seconds) is list:
+                w_seconds, w_frames = self.w_seconds, self.w_frames
+            else:
+                w_seconds, w_frames = [self.w_seconds], [self.w_frames]
+            for w_sec, w_frm in zip(w_seconds, w_frames):
+                # timelag windows are trimmed to a multiple of the downsampling factor
+                if self.features == 'PSD' and not int(self.sfreq * w_sec) == w_frm:
+                    raise RuntimeError('sfreq * w_sec %d != w_frames %d' % (int(self.sfreq * w_sec), w_frm))
 
             if 'multiplier' in model:
                 self.multiplier = model['multiplier']
@@ -119,7 +183,7 @@ class BCIDecoder(object):
                 self.multiplier = 1
 
             # Stream Receiver
-            self.sr = StreamReceiver(window_size=self.w_seconds, amp_name=self.amp_name, amp_serial=self.amp_serial)
+            self.sr = StreamReceiver(window_size=max(w_seconds), amp_name=self.amp_name, amp_serial=self.amp_serial)
             if self.sfreq != self.sr.sample_rate:
                 raise RuntimeError('Amplifier sampling rate (%.1f) != model sampling rate (%.1f). Stop.' % (
                     self.sr.sample_rate, self.sfreq))
@@ -144,12 +208,14 @@ class BCIDecoder(object):
             if self.ref_old is not None:
                 self.ref_old = self.ch_names.index(mc[model['ref_old']])
 
-            # PSD buffer
-            psd_temp = self.psde.transform(np.zeros((1, len(self.picks), self.w_frames)))
+            # PSD buffer (timelag features are buffered in the same way)
+            psd_temp = self.compute_features(np.zeros((1, len(self.picks), max(w_frames))))
             self.psd_shape = psd_temp.shape
             self.psd_size = psd_temp.size
             self.psd_buffer = np.zeros((0, self.psd_shape[1], self.psd_shape[2]))
             self.ts_buffer = []
+            self.ts_last = None
+            self.feats_last = None
 
         else:
             # Fake left-right decoder
@@ -159,6 +225,8 @@ class BCIDecoder(object):
             # TODO: parameterize directions using fake_dirs
             self.labels = [11, 9]
             self.label_names = ['LEFT_GO', 'RIGHT_GO']
+            self.ts_last = None
+            self.feats_last = None
 
     def print(self, *args):
         if len(args) > 0: print('[BCIDecoder] ', end='')
@@ -186,6 +254,22 @@ class BCIDecoder(object):
     def stop(self):
         pass
 
+    def compute_features(self, w):
+        """
+        Compute features of the latest window
+
+        Params
+        ------
+        w: signal array (trials x channels x times)
+
+        Returns
+        -------
+        feature array (trials x channels x features)
+        """
+        if self.features == 'TIMELAG':
+            return compute_timelag(w, self.w_frames, self.downsample)
+        return compute_psd(self.psde, w, self.w_frames)
+
     def get_prob(self):
         """
         Read the latest window
@@ -202,10 +286,12 @@ class BCIDecoder(object):
             for x in range(1, len(self.labels)):
                 probs.append(p_others)
             time.sleep(0.0625)  # simulated delay for PSD + RF
+            self.ts_last = pylsl.local_clock()
         else:
             self.sr.acquire()
             w, ts = self.sr.get_window()  # w = times x channels
             w = w.T  # -> channels x times
+            self.ts_last = ts[-1]  # LSL timestamp of the window end
 
             # apply filters. Important: maintain the original channel order at this point.
             pu.preprocess(w, sfreq=self.sfreq, spatial=self.spatial, spatial_ch=self.spatial_ch,
@@ -219,7 +305,7 @@ class BCIDecoder(object):
             # c=1; print( '### %d: %.1f - %.1f = %.1f'% ( self.picks[c], max(w[c]), min(w[c]), max(w[c])-min(w[c]) ) )
 
             # psd = channels x freqs
-            psd = self.psde.transform(w.reshape((1, w.shape[0], w.shape[1])))
+            psd = self.compute_features(w.reshape((1, w.shape[0], w.shape[1])))
 
             # update psd buffer ( < 1 msec overhead )
             self.psd_buffer = np.concatenate((self.psd_buffer, psd), axis=0)
@@ -234,6 +320,9 @@ class BCIDecoder(object):
 
             # make a feautre vector and classify
             feats = np.concatenate(psd[0]).reshape(1, -1)
+            if self.feat_index is not None:
+                feats = feats[:, self.feat_index]
+            self.feats_last = feats
 
             # compute likelihoods
             probs = self.cls.predict_proba(feats)[0]
@@ -251,6 +340,14 @@ class BCIDecoder(object):
         """
         return self.psd_buffer[-1].reshape((1, -1))
 
+    def get_timestamp(self):
+        """
+        Returns
+        -------
+        LSL timestamp of the last sample of the latest decoded window
+        """
+        return self.ts_last
+
     def is_ready(self):
         """
         Ready to decode? Returns True if buffer is not empty.
@@ -269,7 +366,7 @@ class BCIDecoderDaemon(object):
     """
 
     def __init__(self, classifier=None, buffer_size=1.0, fake=False, amp_serial=None,\
-                 amp_name=None, fake_dirs=None, parallel=None, alpha_new=None):
+                 amp_name=None, fake_dirs=None, parallel=None, alpha_new=None, lsl_server=None):
         """
         Params
         ------
@@ -285,6 +382,9 @@ class BCIDecoderDaemon(object):
             num_strides: Number of decoders to run in parallel.
         alpha_new: exponential smoothing factor, real value in [0, 1].
             p_new = p_new * alpha_new + p_old * (1 - alpha_new)
+        lsl_server: LSL server name to publish the decoder output. None: no LSL output.
+            Each sample is [raw probs, smoothed probs] in float32, in the same label order
+            as get_labels(), time-stamped with the LSL timestamp of the window end.
 
         Example: If the decoder runs 32ms per cycle, we can set
                  period=0.04, stride=0.01, num_strides=4
@@ -305,6 +405,7 @@ class BCIDecoderDaemon(object):
             raise ValueError('alpha_new must be a real number between 0 and 1.')
         self.alpha_new = alpha_new
         self.alpha_old = 1 - alpha_new
+        self.lsl_server = lsl_server
 
         if fake == False or fake is None:
             self.model = qc.load_obj(self.classifier)
@@ -325,6 +426,7 @@ class BCIDecoderDaemon(object):
             self.stopmsg = 'FAKE ' + self.stopmsg
 
         self.psdlock = mp.Lock()
+        self.adapter = None
         self.reset()
         self.start()
 
@@ -347,6 +449,7 @@ class BCIDecoderDaemon(object):
             info = get_decoder_info(self.classifier)
             psd_size = info['psd_size']
             psd_shape = info['psd_shape'][1:]  # we get only the last window
+            n_features = info['n_features']
             psd_ctypes = sharedctypes.RawArray('d', np.zeros(psd_size))
             self.psd = np.frombuffer(psd_ctypes, dtype=np.float64, count=psd_size)
 
@@ -358,6 +461,25 @@ class BCIDecoderDaemon(object):
         self.procs = []
         mp.freeze_support()
 
+        # online adaptation: workers send features while collecting and reload weights on version change.
+        # features are tagged with the trial id and counted in n_sent, both protected by lock, so that
+        # adapt_end() can wait for all features of the trial without relying on Queue.empty().
+        if self.fake == True:
+            self.adapt_shared = None
+        else:
+            self.adapt_shared = dict(lock=mp.Lock(), collect=mp.Value('i', 0, lock=False),
+                                     trial=mp.Value('i', 0, lock=False), n_sent=mp.Value('i', 0, lock=False),
+                                     queue=mp.Queue(), weights=mp.Array('d', n_features + 1),
+                                     version=mp.Value('i', 0))
+
+        # LSL publisher of decoder outputs fed by the decoder workers
+        if self.lsl_server is None:
+            self.lsl_queue = None
+            self.lsl_proc = None
+        else:
+            self.lsl_queue = mp.Queue()
+            self.lsl_proc = mp.Process(target=self.lsl_publisher, args=[self.lsl_queue])
+
         if self.parallel:
             num_strides = self.parallel['num_strides']
             period = self.parallel['period']
@@ -371,14 +493,57 @@ class BCIDecoderDaemon(object):
                 self.procs.append(mp.Process(target=self.daemon, args=\
                     [self.classifier, self.probs, self.probs_smooth, self.pread, self.t_problast,\
                      self.running[i], self.return_psd, psd_ctypes, self.psdlock,\
-                     dict(t_start=(t_start+i*stride), period=period)]))
+                     dict(t_start=(t_start+i*stride), period=period), self.lsl_queue, self.adapt_shared]))
         else:
             self.running = [mp.Value('i', 0)]
             self.procs = [mp.Process(target=self.daemon, args=\
                 [self.classifier, self.probs, self.probs_smooth, self.pread, self.t_problast,\
-                 self.running[0], self.return_psd, psd_ctypes, self.psdlock, None])]
+                 self.running[0], self.return_psd, psd_ctypes, self.psdlock, None, self.lsl_queue,\
+                 self.adapt_shared])]
+
+    def lsl_publisher(self, lsl_queue):
+        """
+        Publishes the decoder outputs on LSL network.
+
+        Runs as a separate process so that all interleaved decoder workers feed
+        a single outlet. A None item stops the publisher.
+        """
+        ch_names = ['raw-%s' % l for l in self.label_names] + ['smooth-%s' % l for l in self.label_names]
+        outlet = start_server(self.lsl_server, n_channels=len(ch_names), channel_format='float32',\
+                              stype='MentalState', ch_names=ch_names)
+        print('[DecoderPublisher-%-6d] Publishing decoder outputs to LSL server %s' % (os.getpid(), self.lsl_server))
+        while True:
+            item = lsl_queue.get()
+            if item is None:
+                break
+            ts, probs, probs_smooth = item
+            outlet.push_sample(probs + probs_smooth, ts)
 
-    def daemon(self, classifier, probs, probs_smooth, pread, t_problast, running, return_psd, psd_ctypes, lock, interleave=None):
+    def adapt_worker(self, decoder, adapt_shared, version):
+        """
+        Synchronize a decoder worker with the adaptation state.
+
+        Loads new weights if the shared version changed and sends the latest
+        feature vector tagged with the trial id while features are being collected.
+
+        Returns
+        -------
+        The weight version currently loaded in the worker
+        """
+        if adapt_shared['version'].value != version:
+            with adapt_shared['weights'].get_lock():
+                weights = np.array(adapt_shared['weights'][:])
+                version = adapt_shared['version'].value
+            set_weights(decoder.cls, weights[:-1], weights[-1])
+        if adapt_shared['collect'].value == 1 and decoder.feats_last is not None:
+            with adapt_shared['lock']:
+                if adapt_shared['collect'].value == 1:
+                    adapt_shared['queue'].put((adapt_shared['trial'].value, decoder.feats_last))
+                    adapt_shared['n_sent'].value += 1
+        return version
+
+    def daemon(self, classifier, probs, probs_smooth, pread, t_problast, running, return_psd, psd_ctypes, lock,\
+               interleave=None, lsl_queue=None, adapt_shared=None):
         """
         Runs Decoder class as a daemon.
 
@@ -389,6 +554,8 @@ class BCIDecoderDaemon(object):
         interleave: None or dict with the following keys:
         - t_start:double (seconds, same as time.time() format)
         - period:double (seconds)
+        lsl_queue: None or multiprocessing.Queue feeding the LSL publisher.
+        adapt_shared: None or dict of shared objects for online adaptation. See reset().
 
         """
 
@@ -402,6 +569,7 @@ class BCIDecoderDaemon(object):
             psd = ctypeslib.as_array(psd_ctypes)
         else:
             psd = None
+        weights_version = 0
 
         if interleave is None:
             # single-core decoding
@@ -409,9 +577,13 @@ class BCIDecoderDaemon(object):
             while running.value == 1:
                 # compute features and likelihoods
                 probs[:] = decoder.get_prob()
+                if adapt_shared is not None:
+                    weights_version = self.adapt_worker(decoder, adapt_shared, weights_version)
                 for i in range(len(probs_smooth)):
                     probs_smooth[i] = probs_smooth[i] * self.alpha_old + probs[i] * self.alpha_new
                 pread.value = 0
+                if lsl_queue is not None:
+                    lsl_queue.put((decoder.get_timestamp(), probs[:], probs_smooth[:]))
                 # copy back PSD values only when requested
                 if self.fake == False and return_psd.value == 1:
                     lock.acquire()
@@ -432,7 +604,9 @@ class BCIDecoderDaemon(object):
                 # compute likelihoods
                 t_prob = time.time()
                 probs_local = decoder.get_prob()
-                
+                if adapt_shared is not None:
+                    weights_version = self.adapt_worker(decoder, adapt_shared, weights_version)
+
                 # update the probs only if the current value is the latest
                 if t_prob > t_problast.value:
                     lock.acquire()
@@ -441,6 +615,8 @@ class BCIDecoderDaemon(object):
                         probs_smooth[i] = probs_smooth[i] * self.alpha_old + probs[i] * self.alpha_new
                     pread.value = 0
                     t_problast.value = t_prob
+                    if lsl_queue is not None:
+                        lsl_queue.put((decoder.get_timestamp(), probs[:], probs_smooth[:]))
                     lock.release()
                 
                 # copy back PSD values only when requested
@@ -472,6 +648,8 @@ class BCIDecoderDaemon(object):
                 ', '.join(['%d' % proc.pid for proc in self.procs]) + ')'
             self.print(msg)
             return
+        if self.lsl_proc is not None:
+            self.lsl_proc.start()
         for proc in self.procs:
             proc.start()
         for running in self.running:
@@ -490,6 +668,9 @@ class BCIDecoderDaemon(object):
             running.value = 0
         for proc in self.procs:
             proc.join()
+        if self.lsl_proc is not None:
+            self.lsl_queue.put(None)
+            self.lsl_proc.join()
         self.reset()
         self.print(self.stopmsg)
 
@@ -509,6 +690,83 @@ class BCIDecoderDaemon(object):
         """
         return self.label_names
 
+    def adapt_init(self, uc_mu=0.01, uc_cov=0.001):
+        """
+        Enable online adaptation of the classifier. Supported for LDA and rLDA models.
+
+        Params
+        ------
+        uc_mu: update coefficient of class means
+        uc_cov: update coefficient of the covariance matrix
+        """
+        if self.fake:
+            raise RuntimeError('Adaptation is not supported for a fake decoder.')
+        self.adapter = LDAAdapter(self.model['cls'], uc_mu=uc_mu, uc_cov=uc_cov)
+        self.print('Online adaptation enabled (uc_mu=%s, uc_cov=%s)' % (uc_mu, uc_cov))
+
+    def adapt_begin(self):
+        """
+        Start collecting feature vectors of a trial
+        """
+        if self.adapter is None:
+            return
+        # features of previous trials still in the queue are dropped by adapt_end() using the trial id
+        with self.adapt_shared['lock']:
+            self.adapt_shared['trial'].value += 1
+            self.adapt_shared['n_sent'].value = 0
+            self.adapt_shared['collect'].value = 1
+
+    def adapt_end(self, label_index, timeout=1.0):
+        """
+        Stop collecting features, update the model with the true label
+        and send the new weights to the decoder workers without stopping them.
+
+        Params
+        ------
+        label_index: index of the true label in get_labels()
+        timeout: maximum waiting time in seconds for each feature vector still in the queue
+
+        Returns
+        -------
+        Number of feature vectors used for the update
+        """
+        if self.adapter is None:
+            return 0
+        with self.adapt_shared['lock']:
+            self.adapt_shared['collect'].value = 0
+            trial = self.adapt_shared['trial'].value
+            n_sent = self.adapt_shared['n_sent'].value
+        # wait until all the features sent during this trial arrive, dropping those of older trials
+        feats = []
+        while len(feats) < n_sent:
+            try:
+                trial_id, f = self.adapt_shared['queue'].get(timeout=timeout)
+            except queue.Empty:
+                self.print('Warning: Received %d of %d feature vectors of the trial.' % (len(feats), n_sent))
+                break
+            if trial_id == trial:
+                feats.append(f)
+        if len(feats) == 0:
+            return 0
+        X = np.concatenate(feats, axis=0)
+        Y = [self.labels[label_index]] * X.shape[0]
+        self.adapter.update(X, Y)
+        w, b = self.adapter.get_weights()
+        with self.adapt_shared['weights'].get_lock():
+            self.adapt_shared['weights'][:] = np.append(w, b)
+            self.adapt_shared['version'].value += 1
+        return X.shape[0]
+
+    def save_model(self, clsfile):
+        """
+        Save the classifier with the adapted weights
+        """
+        if self.adapter is None:
+            raise RuntimeError('Adaptation was not enabled.')
+        self.adapter.apply(self.model['cls'])
+        qc.save_obj(clsfile, self.model)
+        self.print('Adapted decoder saved to %s' % clsfile)
+
     def get_prob(self):
         """
         Returns
@@ -58,7 +58,8 @@ class rLDA(object):
         if self.lambdaStar is not None and numFeatures > 1:
             cov = (1 - self.lambdaStar) * cov + (self.lambdaStar / numFeatures) * np.trace(cov) * np.eye(cov.shape[0])
 
-        w = np.linalg.pinv(cov) * (mu2 - mu1)
+        cov_inv = np.linalg.pinv(cov)
+        w = cov_inv * (mu2 - mu1)
         b = -(w.T) * mu
 
         for wi in w:
@@ -68,6 +69,12 @@ class rLDA(object):
         self.w = np.array(w).reshape(-1)  # vector
         self.b = np.array(b).reshape(-1)  # scalar
         self.labels = labels
+        self.classes_ = labels  # scikit-learn compatible attribute used by decoders
+
+        # class means and inverse covariance are kept for online adaptation
+        self.mu1 = np.array(mu1).reshape(-1)
+        self.mu2 = np.array(mu2).reshape(-1)
+        self.cov_inv = np.array(cov_inv)
 
         return self.w, self.b
 
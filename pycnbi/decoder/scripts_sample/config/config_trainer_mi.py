@@ -31,7 +31,8 @@ DATADIR = r'D:\data\MI\rx1\train'
 '''"""""""""""""""""""""""""""
  PSD PARAMETERS
 
- wlen: window length in seconds
+ wlen: window length in seconds, or list of window lengths for multi-scale features
+  e.g. wlen=[0.5, 1.0] computes PSDs of the last 0.5 and 1.0 seconds of each window
  wstep: window step in frames (32 is enough for 512 Hz, or 256 for 2KHz)
 """""""""""""""""""""""""""'''
 LOAD_PSD = False
@@ -39,6 +40,10 @@ LOAD_PSD = False
 # ignored if LOAD_PSD==True
 PSD = dict(fmin=1, fmax=40, wlen=0.5, wstep=16)
 
+# None or directory to cache computed features.
+# Features are recomputed only if input files or feature-related parameters change.
+FEATURE_CACHE = None
+
 '''"""""""""""""""""""""""""""
  CHANNEL SPECIFICATION
 
@@ -88,6 +93,17 @@ FEATURES = 'PSD'  # PSD | CSP | TIMELAG
 EXPORT_GOOD_FEATURES = True  # Export informative features
 FEAT_TOPN = 20  # export only the best-N features
 
+# used if FEATURES == 'TIMELAG'
+# wlen: window length in seconds
+# wstep: window step in frames of the original sampling rate
+# downsample: number of samples to average, e.g. 8 for 512 Hz -> 64 Hz
+TIMELAG = dict(wlen=0.5, wstep=32, downsample=8)
+
+# None or list of K: export compact decoders retrained on the best-K features.
+# Each model computes PSD only over the selected channels and frequency range.
+# The accuracy-latency tradeoff is saved to DATADIR/classifier/prune_result.txt
+FEAT_PRUNE = None  # [10, 20, 50]
+
 '''"""""""""""""""""""""""""""
  CLASSIFIER
 """""""""""""""""""""""""""'''
@@ -114,6 +130,29 @@ CV_FOLDS = 8
 CV_RANDOM_SEED = 0
 CV_EXPORT_RESULT = True
 
+# export the time and memory usage of each training stage (loading, epoching, filtering,
+# feature computation, each CV fold and the final fit) to profile.json next to cv_result.txt
+EXPORT_PROFILE = False
+
+# balance the number of samples among classes in training and testing sets
+# False | 'OVER' | 'UNDER' | {label:weight} (weight relative to the largest class)
+BALANCE_SAMPLES = False
+BALANCE_SEED = 0
+
+# how folds are run in parallel: 'multiprocessing' | 'threading' | 'sequential'
+# cores given by N_JOBS are split between folds and the classifier
+CV_BACKEND = 'multiprocessing'
+
+# None or parameter search settings. If defined, run_trainer() searches parameters instead of training.
+# params: {name: list of values} or {name: (low, high)} for random search. Use 'VAR.key' for dict items.
+# method: 'grid' | 'random' (n_iter samples), halving: use successive halving with reduction factor eta.
+# Results are ranked and saved to DATADIR/classifier/search_result.txt
+SEARCH = None
+'''
+SEARCH = dict(method='grid', halving=True, eta=3,
+              params={'RF.trees':[200, 500, 1000], 'RF.max_depth':[10, 30, None], 'PSD.fmax':[30, 40]})
+'''
+
 '''"""""""""""""""""""""""""""
  ETC
 """""""""""""""""""""""""""'''
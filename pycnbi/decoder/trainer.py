@@ -28,7 +28,10 @@ along with this program.  If not, see <http://www.gnu.org/licenses/>.
 # start
 import os
 import sys
+import math
 import timeit
+import hashlib
+import itertools
 import platform
 import numpy as np
 import traceback
@@ -43,6 +46,7 @@ from mne import Epochs, pick_types
 from pycnbi.decoder.rlda import rLDA
 from builtins import input
 from IPython import embed  # for debugging
+from sklearn.base import clone
 from sklearn.ensemble import RandomForestClassifier
 from sklearn.ensemble import GradientBoostingClassifier
 from xgboost import XGBClassifier
@@ -91,7 +95,15 @@ def load_cfg(cfg_file):
         'EXCLUDES':None,
         'CV_IGNORE_THRES':None,
         'CV_DECISION_THRES':None,
-        'BALANCE_SAMPLES':False
+        'BALANCE_SAMPLES':False,
+        'LOAD_EVENTS_FILE':None,
+        'FEATURE_CACHE':None,
+        'CV_BACKEND':'multiprocessing',
+        'SEARCH':None,
+        'FEAT_PRUNE':None,
+        'BALANCE_SEED':0,
+        'TIMELAG':None,
+        'EXPORT_PROFILE':False
     }
 
     cfg_file = qc.forward_slashify(cfg_file)
@@ -122,6 +134,14 @@ def load_cfg(cfg_file):
     elif cfg.CLASSIFIER == 'rLDA' and not hasattr(cfg, 'RLDA_REGULARIZE_COEFF'):
         raise RuntimeError('"RLDA_REGULARIZE_COEFF" not defined in config.')
 
+    # feature parameters check
+    if cfg.FEATURES == 'TIMELAG':
+        if cfg.TIMELAG is None:
+            raise RuntimeError('"TIMELAG" not defined in config.')
+        for v in ['wlen', 'wstep', 'downsample']:
+            if v not in cfg.TIMELAG:
+                raise RuntimeError('%s not defined in TIMELAG.' % v)
+
     if cfg.CV_PERFORM is not None:
         if not hasattr(cfg, 'CV_RANDOM_SEED'):
             cfg.CV_RANDOM_SEED = None
@@ -138,42 +158,40 @@ def load_cfg(cfg_file):
     return cfg
 
 
-def get_psd_feature(epochs_train, window, psdparam, feat_picks=None, n_jobs=1):
+def get_psd_feature(epochs_train, window, psdparam, feat_picks=None, n_jobs=1, pool=None):
     """
     params
     ======
       epochs_train: mne.Epochs object or list of mne.Epochs object.
       window: time window range for computing PSD. Can be [a,b] or [ [a1,b1], [a1,b2], ...]
+      pool: multiprocessing.Pool object shared across PSD computations. Created if None.
     """
 
     if type(window[0]) is list:
         sfreq = epochs_train[0].info['sfreq']
         wlen = []
         w_frames = []
-        # multiple PSD estimators, defined for each epoch
         if type(psdparam) is list:
-            '''
-            TODO: implement multi-window PSD for each epoch
-            assert len(psdparam) == len(window)
-            for i, p in enumerate(psdparam):
-                if p['wlen'] is None:
-                    wl = window[i][1] - window[i][0]
-                else:
-                    wl = p['wlen']
-                wlen.append(wl)
-                w_frames.append(int(sfreq * wl))
-            '''
-            raise NotImplementedError('Multiple psd function not implemented yet.')
+            raise ValueError('PSD must be a single dict shared by all epochs.')
+        if type(psdparam['wlen']) is list:
+            raise ValueError('Multiple window lengths (PSD wlen list) are not supported with multiple epochs.')
         # same PSD estimator for all epochs
-        else:
-            for i, e in enumerate(window):
-                if psdparam['wlen'] is None:
-                    wl = window[i][1] - window[i][0]
-                else:
-                    wl = psdparam['wlen']
-                assert wl > 0
-                wlen.append(wl)
-                w_frames.append(int(sfreq * wl))
+        for i, e in enumerate(window):
+            if psdparam['wlen'] is None:
+                wl = window[i][1] - window[i][0]
+            else:
+                wl = psdparam['wlen']
+            if wl <= 0:
+                raise ValueError('Window length must be positive: %s' % wl)
+            wlen.append(wl)
+            w_frames.append(int(sfreq * wl))
+    elif type(psdparam['wlen']) is list:
+        # multiple window lengths aligned at their ends, i.e. multi-scale PSD
+        sfreq = epochs_train.info['sfreq']
+        wlen = psdparam['wlen']
+        if max(wlen) > window[1] - window[0]:
+            raise ValueError('Window length %.3f is longer than the epoch %s.' % (max(wlen), window))
+        w_frames = [int(sfreq * wl) for wl in wlen]
     else:
         sfreq = epochs_train.info['sfreq']
         wlen = window[1] - window[0]
@@ -186,22 +204,34 @@ def get_psd_feature(epochs_train, window, psdparam, feat_picks=None, n_jobs=1):
                                      n_jobs=1, normalization='length', verbose='WARNING')
 
     print('\n>> Computing PSD for training set')
-    if type(epochs_train) is list:
-        X_all = []
-        for i, ep in enumerate(epochs_train):
-            X, Y_data = pu.get_psd(ep, psde, w_frames[i], psdparam['wstep'], feat_picks, n_jobs=n_jobs)
-            X_all.append(X)
-        # concatenate along the feature dimension
-        # feature index order: window block x channel block x frequency block
-        # feature vector = [window1, window2, ...]
-        # where windowX = [channel1, channel2, ...]
-        # where channelX = [freq1, freq2, ...]
-        X_data = np.concatenate(X_all, axis=2)
+    if pool is None:
+        pool_local = mp.Pool(n_jobs)
     else:
-        # feature index order: channel block x frequency block
-        # feature vector = [channel1, channel2, ...]
-        # where channelX = [freq1, freq2, ...]
-        X_data, Y_data = pu.get_psd(epochs_train, psde, w_frames, psdparam['wstep'], feat_picks, n_jobs=n_jobs)
+        pool_local = pool
+    try:
+        if type(epochs_train) is list:
+            X_all = []
+            for i, ep in enumerate(epochs_train):
+                X, Y_data = pu.get_psd(ep, psde, w_frames[i], psdparam['wstep'], feat_picks, n_jobs=n_jobs,
+                                       pool=pool_local)
+                X_all.append(X)
+            # concatenate along the feature dimension
+            # feature index order: window block x channel block x frequency block
+            # feature vector = [window1, window2, ...]
+            # where windowX = [channel1, channel2, ...]
+            # where channelX = [freq1, freq2, ...]
+            X_data = np.concatenate(X_all, axis=2)
+        else:
+            # feature index order: channel block x frequency block
+            # feature vector = [channel1, channel2, ...]
+            # where channelX = [freq1, freq2, ...]
+            # with multiple window lengths, channelX = [window1 freqs, window2 freqs, ...]
+            X_data, Y_data = pu.get_psd(epochs_train, psde, w_frames, psdparam['wstep'], feat_picks, n_jobs=n_jobs,
+                                        pool=pool_local)
+    finally:
+        if pool is None:
+            pool_local.close()
+            pool_local.join()
 
     # return a class-like data structure
     return dict(X_data=X_data, Y_data=Y_data, wlen=wlen, w_frames=w_frames, psde=psde)
@@ -209,10 +239,10 @@ def get_psd_feature(epochs_train, window, psdparam, feat_picks=None, n_jobs=1):
 
 def get_timelags(epochs, wlen, wstep, downsample=1, picks=None):
     """
-    (DEPRECATED FUNCTION)
     Get concatenated timelag features
 
-    TODO: Unit test.
+    Signals are downsampled by averaging every n samples and sliced into windows
+    aligned at the end of each epoch, without copying data for each window.
 
     Params
     ======
@@ -220,52 +250,86 @@ def get_timelags(epochs, wlen, wstep, downsample=1, picks=None):
     wlen: window length (# time points) in downsampled data
     wstep: window step in downsampled data
     downsample: downsample signal to be 1/downsample length
-    picks: ignored for now
+    picks: channel picks
 
     Returns
     =======
-    X: [epochs] x [windows] x [channels*freqs]
+    X: [epochs] x [windows] x [channels*lags]
     y: [epochs] x [labels]
     """
 
-    wlen = int(wlen)
-    wstep = int(wstep)
-    downsample = int(downsample)
-    X_data = None
-    y_data = None
     labels = epochs.events[:, -1]  # every epoch must have event id
     epochs_data = epochs.get_data()
-    n_channels = epochs_data.shape[1]
-    # trim to the nearest divisible length
-    epoch_ds_len = int(epochs_data.shape[2] / downsample)
-    epoch_len = downsample * epoch_ds_len
-    range_epochs = np.arange(epochs_data.shape[0])
-    range_channels = np.arange(epochs_data.shape[1])
-    range_windows = np.arange(epoch_ds_len - wlen, 0, -wstep)
-    X_data = np.zeros((len(range_epochs), len(range_windows), wlen * n_channels))
-
-    # for each epoch
-    for ep in range_epochs:
-        epoch = epochs_data[ep, :, :epoch_len]
-        ds = qc.average_every_n(epoch.reshape(-1), downsample)  # flatten to 1-D, then downsample
-        epoch_ds = ds.reshape(n_channels, -1)  # recover structure to channel x samples
-        # for each window over all channels
-        for i in range(len(range_windows)):
-            w = range_windows[i]
-            X = epoch_ds[:, w:w + wlen].reshape(1, -1)  # our feature vector
-            X_data[ep, i, :] = X
-
-        # fill labels
-        y = np.empty((1, len(range_windows)))  # 1 x windows
-        y.fill(labels[ep])
-        if y_data is None:
-            y_data = y
-        else:
-            y_data = np.concatenate((y_data, y), axis=0)
+    if picks is not None:
+        epochs_data = epochs_data[:, picks]
+    n_epochs, n_channels = epochs_data.shape[:2]
+
+    # [epochs] x [channels] x [windows] x [lags]
+    epochs_ds = pu.decimate_mean(epochs_data, downsample)
+    windows = pu.sliding_windows(epochs_ds, wlen, wstep)
+    n_windows = windows.shape[2]
+
+    # feature vector = [channel1, channel2, ...] where channelX = [lag1, lag2, ...]
+    X_data = windows.transpose(0, 2, 1, 3).reshape(n_epochs, n_windows, n_channels * int(wlen))
+    y_data = np.repeat(labels.reshape(-1, 1), n_windows, axis=1).astype(np.float64)
 
     return X_data, y_data
 
 
+def get_timelag_feature(epochs_train, window, tlparam, feat_picks=None):
+    """
+    Compute timelag features
+
+    Params
+    ======
+    epochs_train: mne.Epochs object
+    window: [tmin, tmax] epoch range
+    tlparam: {'wlen':window length in seconds, 'wstep':window step in frames,
+              'downsample':number of samples to average}
+    feat_picks: channels to compute features from. If None, use all channels.
+
+    Returns
+    =======
+    dict of X_data, Y_data, wlen, w_frames, downsample
+    """
+    if type(window[0]) is list:
+        raise NotImplementedError('MULTIPLE EPOCHS NOT IMPLEMENTED YET FOR TIMELAG FEATURE.')
+    sfreq = epochs_train.info['sfreq']
+    downsample = int(tlparam['downsample'])
+    wlen = tlparam['wlen']
+    if wlen > window[1] - window[0]:
+        raise ValueError('Window length %.3f is longer than the epoch %s.' % (wlen, window))
+    w_lags = int(sfreq * wlen / downsample)  # window length in downsampled data
+    w_step = max(1, int(tlparam['wstep'] / downsample))
+
+    print('\n>> Computing timelag features for training set')
+    X_data, Y_data = get_timelags(epochs_train, w_lags, w_step, downsample, feat_picks)
+
+    # w_frames: window length in the original sampling rate needed for a feature vector
+    return dict(X_data=X_data, Y_data=Y_data, wlen=wlen, w_frames=w_lags * downsample,
+                downsample=downsample, psde=None)
+
+
+def get_psd_freqs(w_frames, sfreq, fmin, fmax):
+    """
+    Frequencies of PSD features computed by PSDEstimator
+
+    Params
+    ======
+    w_frames: window length in samples or list of window lengths (multi-scale PSD)
+    sfreq: sampling rate
+    fmin, fmax: frequency range
+
+    Returns
+    =======
+    Array of frequencies in the same order as the features of a channel
+    """
+    if type(w_frames) is list:
+        return np.concatenate([get_psd_freqs(w, sfreq, fmin, fmax) for w in w_frames])
+    freqs = np.fft.rfftfreq(int(w_frames), 1.0 / sfreq)
+    return freqs[(freqs >= fmin) & (freqs <= fmax)]
+
+
 def feature2chz(x, fqlist, ch_names):
     """
     Label channel, frequency pair for PSD feature indices
@@ -293,79 +357,105 @@ def feature2chz(x, fqlist, ch_names):
     return ch_names[ch], hz
 
 
-def balance_samples(X, Y, balance_type, verbose=False):
-    if balance_type == 'OVER':
-        """
-        Oversample from classes that lack samples
-        """
-        label_set = np.unique(Y)
-        max_set = []
-        X_balanced = np.array(X)
-        Y_balanced = np.array(Y)
-
-        # find a class with maximum number of samples
-        for c in label_set:
-            yl = np.where(Y == c)[0]
-            if len(max_set) == 0 or len(yl) > max_set[1]:
-                max_set = [c, len(yl)]
-
-        for c in label_set:
-            if c == max_set[0]: continue
-            yl = np.where(Y == c)[0]
-            extra_samples = max_set[1] - len(yl)
-            extra_idx = np.random.choice(yl, extra_samples)
-            X_balanced = np.append(X_balanced, X[extra_idx], axis=0)
-            Y_balanced = np.append(Y_balanced, Y[extra_idx], axis=0)
+def balance_index(Y, balance_type, random_state=None):
+    """
+    Generate sample indices that balance the number of samples among classes
+
+    Params
+    ======
+    Y: vector of labels
+    balance_type: balancing method
+        'OVER': oversample classes to match the largest class
+        'UNDER': undersample classes to match the smallest class
+        {label:weight, ...}: resample each class to weight x (number of samples of the largest class).
+                             Classes not listed have weight 1.
+    random_state: None, integer seed or np.random.RandomState object
+
+    Returns
+    =======
+    Index array. Use X[index] and Y[index] to get balanced samples.
+    """
+    if isinstance(random_state, np.random.RandomState):
+        rng = random_state
+    else:
+        rng = np.random.RandomState(random_state)
+    Y = np.ravel(Y)
+    label_set = np.unique(Y)
+    class_index = [np.where(Y == c)[0] for c in label_set]
+    counts = np.array([len(yl) for yl in class_index])
 
+    if balance_type == 'OVER':
+        targets = [counts.max()] * len(label_set)
     elif balance_type == 'UNDER':
-        """
-        Undersample from classes that are excessive
-        """
-        label_set = np.unique(Y)
-        min_set = []
-
-        # find a class with minimum number of samples
-        for c in label_set:
-            yl = np.where(Y == c)[0]
-            if len(min_set) == 0 or len(yl) < min_set[1]:
-                min_set = [c, len(yl)]
-
-        yl = np.where(Y == min_set[0])[0]
-        X_balanced = np.array(X[yl])
-        Y_balanced = np.array(Y[yl])
-
-        for c in label_set:
-            if c == min_set[0]: continue
-            yl = np.where(Y == c)[0]
-            reduced_idx = np.random.choice(yl, min_set[1])
-            X_balanced = np.append(X_balanced, X[reduced_idx], axis=0)
-            Y_balanced = np.append(Y_balanced, Y[reduced_idx], axis=0)
+        targets = [counts.min()] * len(label_set)
+    elif type(balance_type) is dict:
+        targets = [int(round(balance_type.get(c, 1.0) * counts.max())) for c in label_set]
     else:
-        raise ValueError('Unknown balancing type ' % balance_type)
+        raise ValueError('Unknown balancing type %s' % balance_type)
+
+    index = []
+    for yl, n in zip(class_index, targets):
+        if n == len(yl):
+            index.append(yl)
+        elif n < len(yl):
+            index.append(np.sort(rng.choice(yl, n, replace=False)))
+        else:
+            # keep all samples and add random duplicates
+            index.append(yl)
+            index.append(rng.choice(yl, n - len(yl), replace=True))
+    return np.concatenate(index)
+
+
+def balance_samples(X, Y, balance_type, verbose=False, label_names=None, random_state=None):
+    """
+    Balance the number of samples among classes. See balance_index() for parameters.
+
+    Params
+    ======
+    label_names: {label:name} used when verbose is True
+    """
+    index = balance_index(Y, balance_type, random_state)
+    X_balanced = X[index]
+    Y_balanced = Y[index]
 
     if verbose is True:
+        if label_names is None:
+            label_names = {c:'%s' % c for c in np.unique(Y)}
         print('\n>> Number of trials BEFORE balancing')
-        for c in label_set:
-            print('%s: %d' % (cfg.tdef.by_value[c], len(np.where(Y == c)[0])))
+        for c in np.unique(Y):
+            print('%s: %d' % (label_names[c], np.count_nonzero(Y == c)))
         print('\n>> Number of trials AFTER balancing')
-        for c in label_set:
-            print('%s: %d' % (cfg.tdef.by_value[c], len(np.where(Y_balanced == c)[0])))
+        for c in np.unique(Y):
+            print('%s: %d' % (label_names[c], np.count_nonzero(Y_balanced == c)))
 
     return X_balanced, Y_balanced
 
 
-def crossval_epochs(cv, epochs_data, labels, cls, label_names=None, do_balance=False, n_jobs=None, ignore_thres=None, decision_thres=None):
+def crossval_epochs(cv, epochs_data, labels, cls, label_names=None, do_balance=False, n_jobs=None, ignore_thres=None,
+                    decision_thres=None, backend='multiprocessing', balance_seed=None, profiler=None, cv_pool=None):
     """
     Epoch-based cross-validation used by cross_validate().
 
     Params
     ======
-    cv: scikit-learn cross-validation object
+    cv: scikit-learn cross-validation object or list of (train, test) epoch indices
     epochs_data: np.array of [epochs x samples x features]
     cls: classifier
     labels: vector of integer labels
     label_names: associated label names {0:'Left', 1:'Right', ...}
-    do_balance: oversample or undersample to match the number of samples among classes
+    do_balance: oversample or undersample to match the number of samples among classes. See balance_index().
+    balance_seed: random seed for balancing. Fold k uses balance_seed + k.
+    n_jobs: total number of cores shared between folds and the classifier
+    backend: how folds are run in parallel
+        'multiprocessing': worker processes. Data are shared once through a memory-mapped
+                           file and only the fold indices are sent to workers.
+        'threading': worker threads sharing the data in memory. Suitable for classifiers
+                     that release the GIL during fitting.
+        'sequential': folds are run one by one and all cores are given to the classifier.
+    profiler: qc.StageProfiler object to record the time and memory usage of each fold
+    cv_pool: fold workers created with create_cv_pool() from the same epochs_data and labels
+             to be reused across calls. If None, workers are created and removed in this call.
+             backend is ignored and the number of workers is taken from it if given.
 
     """
 
@@ -379,45 +469,57 @@ def crossval_epochs(cv, epochs_data, labels, cls, label_names=None, do_balance=F
 
     if n_jobs is None:
         n_jobs = mp.cpu_count()
+    if backend not in ['multiprocessing', 'threading', 'sequential']:
+        raise ValueError('Unknown cross-validation backend %s' % backend)
 
-    if n_jobs > 1:
-        print('crossval_epochs(): Using %d cores' % n_jobs)
-        pool = mp.Pool(n_jobs)
-        results = []
-
-    # for classifier itself, single core is usually faster
-    cls.n_jobs = 1
-
-    if SKLEARN_OLD:
+    if type(cv) is list:
         splits = cv
+    elif SKLEARN_OLD:
+        splits = list(cv)
     else:
-        splits = cv.split(epochs_data, labels[:, 0])
-    for train, test in splits:
-        X_train = np.concatenate(epochs_data[train])
-        X_test = np.concatenate(epochs_data[test])
-        Y_train = np.concatenate(labels[train])
-        Y_test = np.concatenate(labels[test])
-        if do_balance != False:
-            X_train, Y_train = balance_samples(X_train, Y_train, do_balance)
-            X_test, Y_test = balance_samples(X_test, Y_test, do_balance)
-
-        if n_jobs > 1:
-            results.append(pool.apply_async(fit_predict_thres,
-                                            [cls, X_train, Y_train, X_test, Y_test, cnum, label_set, ignore_thres, decision_thres]))
-        else:
-            score, cm = fit_predict_thres(cls, X_train, Y_train, X_test, Y_test, cnum, label_set, ignore_thres, decision_thres)
-            scores.append(score)
-            cm_sum += cm
-        cnum += 1
-
-    if n_jobs > 1:
-        pool.close()
-        pool.join()
+        splits = list(cv.split(epochs_data, labels[:, 0]))
 
-        for r in results:
-            score, cm = r.get()
+    # split cores between folds and the classifier to avoid oversubscription
+    if cv_pool is not None:
+        n_workers = cv_pool['n_workers']
+        backend = cv_pool['backend']
+    else:
+        n_workers = get_cv_workers(n_jobs, len(splits), backend)
+    n_jobs_cls = max(1, n_jobs // n_workers)
+    print('crossval_epochs(): %d fold workers (%s), %d cores per classifier' %\
+          (n_workers, backend, n_jobs_cls if hasattr(cls, 'n_jobs') else 1))
+
+    if n_workers == 1:
+        for train, test in splits:
+            score, cm, stats = fit_predict_fold(epochs_data, labels, train, test, get_fold_classifier(cls, n_jobs_cls),
+                                                cnum, label_set, do_balance, ignore_thres, decision_thres,
+                                                balance_seed, profile=True)
+            if profiler is not None:
+                profiler.add('cv_fold', **stats)
             scores.append(score)
             cm_sum += cm
+            cnum += 1
+    else:
+        pool_owner = cv_pool is None
+        if pool_owner:
+            cv_pool = create_cv_pool(epochs_data, labels, n_workers, backend)
+        try:
+            results = []
+            for train, test in splits:
+                results.append(cv_pool['pool'].apply_async(fit_predict_fold,
+                    [cv_pool['X_arg'], cv_pool['Y_arg'], train, test, get_fold_classifier(cls, n_jobs_cls), cnum,
+                     label_set, do_balance, ignore_thres, decision_thres, balance_seed, True]))
+                cnum += 1
+            for r in results:
+                score, cm, stats = r.get()
+                if profiler is not None:
+                    profiler.add('cv_fold', **stats)
+                scores.append(score)
+                cm_sum += cm
+        finally:
+            # remove the temporary files even if a fold failed
+            if pool_owner:
+                remove_cv_pool(cv_pool)
 
     # confusion matrix
     cm_sum = cm_sum.astype('float')
@@ -456,26 +558,10 @@ def crossval_epochs(cv, epochs_data, labels, cls, label_names=None, do_balance=F
     return np.array(scores), cm_txt
 
 
-def balance_tpr(cfg, featdata):
+def init_classifier(cfg):
     """
-    Find the threshold of class index 0 that yields equal number of true positive samples of each class.
-    Currently only available for binary classes.
-
-    Params
-    ======
-    cfg: config module
-    feetdata: feature data computed using compute_features()
+    Create a classifier object defined in the config
     """
-
-    n_jobs = cfg.N_JOBS
-    if n_jobs is None:
-        n_jobs = mp.cpu_count()
-    if n_jobs > 1:
-        print('balance_tpr(): Using %d cores' % n_jobs)
-        pool = mp.Pool(n_jobs)
-        results = []
-
-    # Init a classifier
     if cfg.CLASSIFIER == 'GB':
         cls = GradientBoostingClassifier(loss='deviance', learning_rate=cfg.GB['learning_rate'],
                                          n_estimators=cfg.GB['trees'], subsample=1.0, max_depth=cfg.GB['max_depth'],
@@ -491,36 +577,75 @@ def balance_tpr(cfg, featdata):
                                      max_depth=cfg.RF['max_depth'], n_jobs=cfg.N_JOBS, random_state=cfg.RF['seed'],
                                      oob_score=True, class_weight='balanced_subsample')
     elif cfg.CLASSIFIER == 'LDA':
-        cls = LDA()
+        # covariance is kept for online adaptation
+        cls = LDA(store_covariance=True)
     elif cfg.CLASSIFIER == 'rLDA':
         cls = rLDA(cfg.RLDA_REGULARIZE_COEFF)
     else:
         raise ValueError('Unknown classifier type %s' % cfg.CLASSIFIER)
+    return cls
 
-    # Setup features
-    X_data = featdata['X_data']
-    Y_data = featdata['Y_data']
-    wlen = featdata['wlen']
-    if cfg.PSD['wlen'] is None:
-        cfg.PSD['wlen'] = wlen
 
-    # Choose CV type
-    ntrials, nsamples, fsize = X_data.shape
+def get_cv(cfg, Y_data, verbose=True):
+    """
+    Create a cross-validation object defined in the config
+
+    Params
+    ======
+    cfg: config module
+    Y_data: label array of [epochs x samples]
+    """
     if cfg.CV_PERFORM == 'LeaveOneOut':
-        print('\n>> %d-fold leave-one-out cross-validation' % ntrials)
+        if verbose:
+            print('\n>> %d-fold leave-one-out cross-validation' % len(Y_data))
         if SKLEARN_OLD:
             cv = LeaveOneOut(len(Y_data))
         else:
             cv = LeaveOneOut()
     elif cfg.CV_PERFORM == 'StratifiedShuffleSplit':
-        print(
-            '\n>> %d-fold stratified cross-validation with test set ratio %.2f' % (cfg.CV_FOLDS, cfg.CV_TEST_RATIO))
+        if verbose:
+            print('\n>> %d-fold stratified cross-validation with test set ratio %.2f' % (cfg.CV_FOLDS, cfg.CV_TEST_RATIO))
         if SKLEARN_OLD:
             cv = StratifiedShuffleSplit(Y_data[:, 0], cfg.CV_FOLDS, test_size=cfg.CV_TEST_RATIO, random_state=cfg.CV_RANDOM_SEED)
         else:
             cv = StratifiedShuffleSplit(n_splits=cfg.CV_FOLDS, test_size=cfg.CV_TEST_RATIO, random_state=cfg.CV_RANDOM_SEED)
     else:
         raise NotImplementedError('%s is not supported yet. Sorry.' % cfg.CV_PERFORM)
+    return cv
+
+
+def balance_tpr(cfg, featdata):
+    """
+    Find the threshold of class index 0 that yields equal number of true positive samples of each class.
+    Currently only available for binary classes.
+
+    Params
+    ======
+    cfg: config module
+    feetdata: feature data computed using compute_features()
+    """
+
+    n_jobs = cfg.N_JOBS
+    if n_jobs is None:
+        n_jobs = mp.cpu_count()
+    if n_jobs > 1:
+        print('balance_tpr(): Using %d cores' % n_jobs)
+        pool = mp.Pool(n_jobs)
+        results = []
+
+    # Init a classifier
+    cls = init_classifier(cfg)
+
+    # Setup features
+    X_data = featdata['X_data']
+    Y_data = featdata['Y_data']
+    wlen = featdata['wlen']
+    if cfg.FEATURES == 'PSD' and cfg.PSD['wlen'] is None:
+        cfg.PSD['wlen'] = wlen
+
+    # Choose CV type
+    ntrials, nsamples, fsize = X_data.shape
+    cv = get_cv(cfg, Y_data)
     print('%d trials, %d samples per trial, %d feature dimension' % (ntrials, nsamples, fsize))
 
     # For classifier itself, single core is usually faster
@@ -589,6 +714,138 @@ def get_predict_proba(cls, X_train, Y_train, X_test, Y_test, cnum):
     return Y_pred[:,0]
 
 
+def fold_samples(epochs_data, labels, epochs, do_balance=False, random_state=None):
+    """
+    Gather samples of the given epochs with a single indexing operation,
+    optionally balanced among classes.
+
+    Returns
+    =======
+    X: [samples x features]
+    Y: [samples]
+    """
+    n_windows = labels.shape[1]
+    Y = labels[epochs].reshape(-1)
+    if do_balance != False:
+        index = balance_index(Y, do_balance, random_state)
+    else:
+        index = np.arange(len(Y))
+    ep_index = np.asarray(epochs)[index // n_windows]
+    win_index = index % n_windows
+    return epochs_data[ep_index, win_index], Y[index]
+
+
+def get_cv_workers(n_jobs, n_splits, backend='multiprocessing'):
+    """
+    Returns the number of folds run in parallel by crossval_epochs()
+    """
+    if n_jobs is None:
+        n_jobs = mp.cpu_count()
+    if backend == 'sequential' or n_jobs == 1:
+        return 1
+    return min(n_jobs, n_splits)
+
+
+def create_cv_pool(epochs_data, labels, n_workers, backend='multiprocessing'):
+    """
+    Create fold workers for crossval_epochs() which can be reused across calls on the same data
+
+    With the multiprocessing backend, the data are shared with workers once through
+    memory-mapped files and only the fold indices are sent for each fold.
+
+    Params
+    ======
+    epochs_data: np.array of [epochs x samples x features]
+    labels: np.array of [epochs x samples]
+    n_workers: number of folds run in parallel
+    backend: 'multiprocessing' | 'threading'. See crossval_epochs().
+
+    Returns
+    =======
+    dict to be passed to crossval_epochs() and removed with remove_cv_pool()
+    """
+    if backend not in ['multiprocessing', 'threading']:
+        raise ValueError('Unknown fold worker backend %s' % backend)
+    cv_pool = dict(n_workers=n_workers, backend=backend, pool=None, X_shared=None, Y_shared=None)
+    try:
+        if backend == 'multiprocessing':
+            cv_pool['X_shared'] = pu.create_shared_array(epochs_data.shape, epochs_data.dtype, epochs_data)
+            cv_pool['Y_shared'] = pu.create_shared_array(labels.shape, labels.dtype, labels)
+            cv_pool['X_arg'] = pu.shared_array_info(cv_pool['X_shared'])
+            cv_pool['Y_arg'] = pu.shared_array_info(cv_pool['Y_shared'])
+            cv_pool['pool'] = mp.Pool(n_workers)
+        else:
+            from multiprocessing.pool import ThreadPool
+            cv_pool['X_arg'] = epochs_data
+            cv_pool['Y_arg'] = labels
+            cv_pool['pool'] = ThreadPool(n_workers)
+    except:
+        remove_cv_pool(cv_pool)
+        raise
+    return cv_pool
+
+
+def remove_cv_pool(cv_pool):
+    """
+    Stop the workers and remove the shared files created by create_cv_pool()
+    """
+    if cv_pool['pool'] is not None:
+        cv_pool['pool'].terminate()
+        cv_pool['pool'].join()
+        cv_pool['pool'] = None
+    for key in ['X_shared', 'Y_shared']:
+        if cv_pool[key] is not None:
+            pu.remove_shared_array(cv_pool[key])
+            cv_pool[key] = None
+
+
+def get_fold_classifier(cls, n_jobs=1):
+    """
+    Returns an unfitted copy of cls using n_jobs cores.
+
+    Each fold fits its own copy so that folds running in parallel threads do not
+    share an estimator and the caller's classifier is not modified.
+    Classifiers not following the scikit-learn API (e.g. rLDA) are deep-copied.
+    """
+    fold_cls = clone(cls, safe=False)
+    if hasattr(fold_cls, 'n_jobs'):
+        fold_cls.n_jobs = n_jobs
+    return fold_cls
+
+
+def fit_predict_fold(epochs_data, labels, train, test, cls, cnum, label_list, do_balance=False, ignore_thres=None,
+                     decision_thres=None, balance_seed=None, profile=False):
+    """
+    Build training and testing sets of a fold from epoch indices and call fit_predict_thres().
+
+    Params
+    ======
+    epochs_data: np.array of [epochs x samples x features] or its pu.shared_array_info()
+    labels: np.array of [epochs x samples] or its pu.shared_array_info()
+    train, test: epoch indices of training and testing sets
+    profile: if True, also return a dict of the fold number, elapsed seconds, process id
+             and peak memory so far of the process running the fold
+
+    See crossval_epochs() and fit_predict_thres() for the other parameters.
+    """
+    timer = qc.Timer()
+    if type(epochs_data) is tuple:
+        epochs_data = pu.open_shared_array(epochs_data)
+    if type(labels) is tuple:
+        labels = pu.open_shared_array(labels)
+    if balance_seed is None:
+        rng = np.random.RandomState()
+    else:
+        rng = np.random.RandomState(balance_seed + cnum)
+    X_train, Y_train = fold_samples(epochs_data, labels, train, do_balance, rng)
+    X_test, Y_test = fold_samples(epochs_data, labels, test, do_balance, rng)
+    score, cm = fit_predict_thres(cls, X_train, Y_train, X_test, Y_test, cnum, label_list, ignore_thres, decision_thres)
+    if profile:
+        _, peak = qc.get_memory_usage()
+        return score, cm, dict(sec=timer.sec(), fold=cnum, pid=os.getpid(), worker_peak_so_far_mb=peak)
+    return score, cm
+
+
 def fit_predict_thres(cls, X_train, Y_train, X_test, Y_test, cnum, label_list, ignore_thres=None, decision_thres=None):
     """
     Any likelihood lower than a threshold is not counted as classification score
@@ -627,20 +884,102 @@ def fit_predict_thres(cls, X_train, Y_train, X_test, Y_test, cnum, label_list, i
     return score, cm
 
 
-def compute_features(cfg):
+def get_feature_cache_key(cfg, ftrain):
+    """
+    Compute the feature cache key from the input files and the feature-related settings.
+
+    Files are identified by their path, size and modification time so that the
+    key can be computed without reading the data.
+
+    Params
+    ======
+    cfg: config module loaded with load_cfg()
+    ftrain: list of input file paths
+
+    Returns
+    =======
+    Hex digest string
+    """
+    sha = hashlib.sha1()
+    files = list(ftrain)
+    if cfg.LOAD_EVENTS_FILE is not None:
+        files.append(cfg.LOAD_EVENTS_FILE)
+    for f in files:
+        st = os.stat(f)
+        sha.update(('%s|%d|%d\n' % (os.path.realpath(f), st.st_size, int(st.st_mtime))).encode('utf-8'))
+    params = ['FEATURES', 'EPOCH', 'PSD', 'TIMELAG', 'SP_FILTER', 'TP_FILTER', 'NOTCH_FILTER', 'CHANNEL_PICKS',
+              'EXCLUDES', 'REF_CH_OLD', 'REF_CH_NEW', 'MULTIPLIER']
+    for key in params:
+        value = getattr(cfg, key)
+        if type(value) is dict:
+            value = sorted(value.items())
+        sha.update(('%s=%r\n' % (key, value)).encode('utf-8'))
+    sha.update(('TRIGGER_DEF=%r\n' % sorted(cfg.TRIGGER_DEF)).encode('utf-8'))
+    return sha.hexdigest()
+
+
+def load_feature_cache(cache_dir, key):
+    """
+    Load cached features. X_data and Y_data are memory-mapped in read-only mode.
+
+    Returns
+    =======
+    featdata dict or None if the cache does not exist
+    """
+    prefix = '%s/%s' % (cache_dir, key)
+    if not (os.path.exists(prefix + '-info.pkl') and os.path.exists(prefix + '-X.npy') and os.path.exists(prefix + '-Y.npy')):
+        return None
+    featdata = qc.load_obj(prefix + '-info.pkl')
+    featdata['X_data'] = np.load(prefix + '-X.npy', mmap_mode='r')
+    featdata['Y_data'] = np.load(prefix + '-Y.npy', mmap_mode='r')
+    return featdata
+
+
+def save_feature_cache(cache_dir, key, featdata):
+    """
+    Save features into cache_dir. X_data and Y_data are saved as .npy files to be
+    memory-mapped later. The info file is written last to mark a complete entry.
+    """
+    qc.make_dirs(cache_dir)
+    prefix = '%s/%s' % (cache_dir, key)
+    np.save(prefix + '-X.npy', featdata['X_data'])
+    np.save(prefix + '-Y.npy', featdata['Y_data'])
+    info = {k:v for k, v in featdata.items() if k not in ['X_data', 'Y_data']}
+    qc.save_obj(prefix + '-info.pkl', info)
+
+
+def compute_features(cfg, profiler=None):
+    if profiler is None:
+        profiler = qc.StageProfiler()
+
     # Load file list
     ftrain = []
     for f in qc.get_file_list(cfg.DATADIR, fullpath=True):
-        if f[-4:] in ['.fif', '.fiff']:
+        if f[-4:] in ['.fif', 'fiff', 'vhdr']:
             ftrain.append(f)
 
+    # Reuse previously computed features if available
+    if cfg.FEATURE_CACHE is not None:
+        cache_dir = qc.forward_slashify(cfg.FEATURE_CACHE)
+        cache_key = get_feature_cache_key(cfg, ftrain)
+        with profiler.stage('load_feature_cache'):
+            featdata = load_feature_cache(cache_dir, cache_key)
+        if featdata is not None:
+            qc.print_c('compute_features(): Loaded cached features %s/%s' % (cache_dir, cache_key), 'G')
+            if cfg.FEATURES == 'PSD' and cfg.PSD['wlen'] is None and type(cfg.EPOCH[0]) is not list:
+                # get_psd_feature() sets the window length to the epoch length in this case
+                cfg.PSD['wlen'] = featdata['wlen']
+            return featdata
+
     # Preprocessing, epoching and PSD computation
     if len(ftrain) > 1 and cfg.CHANNEL_PICKS is not None and type(cfg.CHANNEL_PICKS[0]) == int:
         raise RuntimeError(
             'When loading multiple EEG files, CHANNEL_PICKS must be list of string, not integers because they may have different channel order.')
-    raw, events = pu.load_multi(ftrain)
+    with profiler.stage('load_multi', n_files=len(ftrain)):
+        raw, events = pu.load_multi(ftrain, n_jobs=cfg.N_JOBS)
     if cfg.REF_CH_NEW is not None:
-        pu.rereference(raw, ref_new=cfg.REF_CH_NEW, ref_old=cfg.REF_CH_OLD)
+        with profiler.stage('rereference'):
+            pu.rereference(raw, ref_new=cfg.REF_CH_NEW, ref_old=cfg.REF_CH_OLD)
     if cfg.LOAD_EVENTS_FILE is not None:
         events = mne.read_events(cfg.LOAD_EVENTS_FILE)
     triggers = {cfg.tdef.by_value[c]:c for c in set(cfg.TRIGGER_DEF)}
@@ -687,24 +1026,28 @@ def compute_features(cfg):
         # Experimental: multiple epoch ranges
         if type(cfg.EPOCH[0]) is list:
             epochs_train = []
-            for ep in cfg.EPOCH:
-                epoch = Epochs(raw, events, triggers, tmin=ep[0], tmax=ep[1],
-                    proj=False, picks=picks, baseline=None, preload=True,
-                    verbose=False, detrend=None)
+            for i, ep in enumerate(cfg.EPOCH):
+                with profiler.stage('epochs', epoch_range=i):
+                    epoch = Epochs(raw, events, triggers, tmin=ep[0], tmax=ep[1],
+                        proj=False, picks=picks, baseline=None, preload=True,
+                        verbose=False, detrend=None)
                 # Channels are already selected by 'picks' param so use all channels.
-                pu.preprocess(epoch, spatial=cfg.SP_FILTER, spatial_ch=None,
-                              spectral=cfg.TP_FILTER, spectral_ch=None, notch=cfg.NOTCH_FILTER,
-                              notch_ch=None, multiplier=cfg.MULTIPLIER, n_jobs=cfg.N_JOBS)
+                with profiler.stage('preprocess', epoch_range=i):
+                    pu.preprocess(epoch, spatial=cfg.SP_FILTER, spatial_ch=None,
+                                  spectral=cfg.TP_FILTER, spectral_ch=None, notch=cfg.NOTCH_FILTER,
+                                  notch_ch=None, multiplier=cfg.MULTIPLIER, n_jobs=cfg.N_JOBS)
                 epochs_train.append(epoch)
         else:
             # Usual method: single epoch range
-            epochs_train = Epochs(raw, events, triggers, tmin=cfg.EPOCH[0],
-                tmax=cfg.EPOCH[1], proj=False, picks=picks, baseline=None,
-                preload=True, verbose=False, detrend=None)
+            with profiler.stage('epochs'):
+                epochs_train = Epochs(raw, events, triggers, tmin=cfg.EPOCH[0],
+                    tmax=cfg.EPOCH[1], proj=False, picks=picks, baseline=None,
+                    preload=True, verbose=False, detrend=None)
             # Channels are already selected by 'picks' param so use all channels.
-            pu.preprocess(epochs_train, spatial=cfg.SP_FILTER, spatial_ch=None,
-                          spectral=cfg.TP_FILTER, spectral_ch=None, notch=cfg.NOTCH_FILTER, notch_ch=None,
-                          multiplier=cfg.MULTIPLIER, n_jobs=cfg.N_JOBS)
+            with profiler.stage('preprocess'):
+                pu.preprocess(epochs_train, spatial=cfg.SP_FILTER, spatial_ch=None,
+                              spectral=cfg.TP_FILTER, spectral_ch=None, notch=cfg.NOTCH_FILTER, notch_ch=None,
+                              multiplier=cfg.MULTIPLIER, n_jobs=cfg.N_JOBS)
     except:
         qc.print_c('\n*** (trainer.py) ERROR OCCURRED WHILE EPOCHING ***\n', 'R')
         # Catch and throw errors from child processes
@@ -718,12 +1061,18 @@ def compute_features(cfg):
 
     # Compute features
     if cfg.FEATURES == 'PSD':
-        featdata = get_psd_feature(epochs_train, cfg.EPOCH, cfg.PSD, feat_picks=None, n_jobs=cfg.N_JOBS)
+        # a single pool of workers is used for the whole PSD computation
+        with profiler.stage('get_psd'):
+            pool = mp.Pool(cfg.N_JOBS)
+            try:
+                featdata = get_psd_feature(epochs_train, cfg.EPOCH, cfg.PSD, feat_picks=None, n_jobs=cfg.N_JOBS,
+                                           pool=pool)
+            finally:
+                pool.close()
+                pool.join()
     elif cfg.FEATURES == 'TIMELAG':
-        '''
-        TODO: Implement multiple epochs for timelag feature
-        '''
-        raise NotImplementedError('MULTIPLE EPOCHS NOT IMPLEMENTED YET FOR TIMELAG FEATURE.')
+        with profiler.stage('get_timelags'):
+            featdata = get_timelag_feature(epochs_train, cfg.EPOCH, cfg.TIMELAG, feat_picks=None)
     elif cfg.FEATURES == 'WAVELET':
         '''
         TODO: Implement multiple epochs for wavelet feature
@@ -735,65 +1084,40 @@ def compute_features(cfg):
     featdata['picks'] = picks
     featdata['sfreq'] = raw.info['sfreq']
     featdata['ch_names'] = raw.ch_names
+
+    if cfg.FEATURE_CACHE is not None:
+        with profiler.stage('save_feature_cache'):
+            save_feature_cache(cache_dir, cache_key, featdata)
+        qc.print_c('compute_features(): Saved features to cache %s/%s' % (cache_dir, cache_key), 'G')
     return featdata
 
 
-def cross_validate(cfg, featdata, cv_file=None):
+def cross_validate(cfg, featdata, cv_file=None, profiler=None):
     """
     Perform cross validation
+
+    If profiler (qc.StageProfiler) is given, the time and memory of each fold are recorded.
     """
     # Init a classifier
-    if cfg.CLASSIFIER == 'GB':
-        cls = GradientBoostingClassifier(loss='deviance', learning_rate=cfg.GB['learning_rate'],
-                                         n_estimators=cfg.GB['trees'], subsample=1.0, max_depth=cfg.GB['max_depth'],
-                                         random_state=cfg.GB['seed'], max_features='sqrt', verbose=0, warm_start=False,
-                                         presort='auto')
-    elif cfg.CLASSIFIER == 'XGB':
-        cls = XGBClassifier(loss='deviance', learning_rate=cfg.GB['learning_rate'],
-                                         n_estimators=cfg.GB['trees'], subsample=1.0, max_depth=cfg.GB['max_depth'],
-                                         random_state=cfg.GB['seed'], max_features='sqrt', verbose=0, warm_start=False,
-                                         presort='auto')
-    elif cfg.CLASSIFIER == 'RF':
-        cls = RandomForestClassifier(n_estimators=cfg.RF['trees'], max_features='auto',
-                                     max_depth=cfg.RF['max_depth'], n_jobs=cfg.N_JOBS, random_state=cfg.RF['seed'],
-                                     oob_score=True, class_weight='balanced_subsample')
-    elif cfg.CLASSIFIER == 'LDA':
-        cls = LDA()
-    elif cfg.CLASSIFIER == 'rLDA':
-        cls = rLDA(cfg.RLDA_REGULARIZE_COEFF)
-    else:
-        raise ValueError('Unknown classifier type %s' % cfg.CLASSIFIER)
+    cls = init_classifier(cfg)
 
     # Setup features
     X_data = featdata['X_data']
     Y_data = featdata['Y_data']
     wlen = featdata['wlen']
-    if cfg.PSD['wlen'] is None:
+    if cfg.FEATURES == 'PSD' and cfg.PSD['wlen'] is None:
         cfg.PSD['wlen'] = wlen
 
     # Choose CV type
     ntrials, nsamples, fsize = X_data.shape
-    if cfg.CV_PERFORM == 'LeaveOneOut':
-        print('\n>> %d-fold leave-one-out cross-validation' % ntrials)
-        if SKLEARN_OLD:
-            cv = LeaveOneOut(len(Y_data))
-        else:
-            cv = LeaveOneOut()
-    elif cfg.CV_PERFORM == 'StratifiedShuffleSplit':
-        print(
-            '\n>> %d-fold stratified cross-validation with test set ratio %.2f' % (cfg.CV_FOLDS, cfg.CV_TEST_RATIO))
-        if SKLEARN_OLD:
-            cv = StratifiedShuffleSplit(Y_data[:, 0], cfg.CV_FOLDS, test_size=cfg.CV_TEST_RATIO, random_state=cfg.CV_RANDOM_SEED)
-        else:
-            cv = StratifiedShuffleSplit(n_splits=cfg.CV_FOLDS, test_size=cfg.CV_TEST_RATIO, random_state=cfg.CV_RANDOM_SEED)
-    else:
-        raise NotImplementedError('%s is not supported yet. Sorry.' % cfg.CV_PERFORM)
+    cv = get_cv(cfg, Y_data)
     print('%d trials, %d samples per trial, %d feature dimension' % (ntrials, nsamples, fsize))
 
     # Do it!
     timer_cv = qc.Timer()
     scores, cm_txt = crossval_epochs(cv, X_data, Y_data, cls, cfg.tdef.by_value, cfg.BALANCE_SAMPLES, n_jobs=cfg.N_JOBS,
-                                     ignore_thres=cfg.CV_IGNORE_THRES, decision_thres=cfg.CV_DECISION_THRES)
+                                     ignore_thres=cfg.CV_IGNORE_THRES, decision_thres=cfg.CV_DECISION_THRES,
+                                     backend=cfg.CV_BACKEND, balance_seed=cfg.BALANCE_SEED, profiler=profiler)
     t_cv = timer_cv.sec()
 
     # Export results
@@ -810,13 +1134,23 @@ def cross_validate(cfg, featdata, cv_file=None):
     txt += 'Spectral filter: %s\n' % cfg.TP_FILTER
     txt += 'Notch filter: %s\n' % cfg.NOTCH_FILTER
     txt += 'Channels: ' + ','.join([str(featdata['ch_names'][p]) for p in featdata['picks']]) + '\n'
-    txt += 'PSD range: %.1f - %.1f Hz\n' % (cfg.PSD['fmin'], cfg.PSD['fmax'])
-    txt += 'Window step: %.2f msec\n' % (1000.0 * cfg.PSD['wstep'] / featdata['sfreq'])
+    if cfg.FEATURES == 'TIMELAG':
+        txt += 'Timelag downsampling: %d\n' % cfg.TIMELAG['downsample']
+        txt += 'Window step: %.2f msec\n' % (1000.0 * cfg.TIMELAG['wstep'] / featdata['sfreq'])
+    else:
+        txt += 'PSD range: %.1f - %.1f Hz\n' % (cfg.PSD['fmin'], cfg.PSD['fmax'])
+        txt += 'Window step: %.2f msec\n' % (1000.0 * cfg.PSD['wstep'] / featdata['sfreq'])
     txt += 'Reference channels: %s\n' % cfg.REF_CH_NEW
-    if type(wlen) is list:
+    if cfg.FEATURES == 'TIMELAG':
+        txt += 'Window size: %.1f msec\n' % (wlen * 1000.0)
+        txt += 'Epoch range: %s sec\n' % (cfg.EPOCH)
+    elif type(cfg.EPOCH[0]) is list:
         for i, w in enumerate(wlen):
             txt += 'Window size: %.1f msec\n' % (w * 1000.0)
             txt += 'Epoch range: %s sec\n' % (cfg.EPOCH[i])
+    elif type(wlen) is list:
+        txt += 'Window sizes: %s msec\n' % ', '.join(['%.1f' % (w * 1000.0) for w in wlen])
+        txt += 'Epoch range: %s sec\n' % (cfg.EPOCH)
     else:
         txt += 'Window size: %.1f msec\n' % (cfg.PSD['wlen'] * 1000.0)
         txt += 'Epoch range: %s sec\n' % (cfg.EPOCH)
@@ -854,50 +1188,38 @@ def cross_validate(cfg, featdata, cv_file=None):
         fout.close()
 
 
-def train_decoder(cfg, featdata, feat_file=None):
+def train_decoder(cfg, featdata, feat_file=None, profiler=None):
     """
     Train the final decoder using all data
+
+    If profiler (qc.StageProfiler) is given, the time and memory of fitting are recorded.
     """
+    if profiler is None:
+        profiler = qc.StageProfiler()
+
     # Init a classifier
-    if cfg.CLASSIFIER == 'GB':
-        cls = GradientBoostingClassifier(loss='deviance', learning_rate=cfg.GB['learning_rate'],
-                                         n_estimators=cfg.GB['trees'], subsample=1.0, max_depth=cfg.GB['max_depth'],
-                                         random_state=cfg.GB['seed'], max_features='sqrt', verbose=0, warm_start=False,
-                                         presort='auto')
-    elif cfg.CLASSIFIER == 'XGB':
-        cls = XGBClassifier(loss='deviance', learning_rate=cfg.GB['learning_rate'],
-                                         n_estimators=cfg.GB['trees'], subsample=1.0, max_depth=cfg.GB['max_depth'],
-                                         random_state=cfg.GB['seed'], max_features='sqrt', verbose=0, warm_start=False,
-                                         presort='auto')
-    elif cfg.CLASSIFIER == 'RF':
-        cls = RandomForestClassifier(n_estimators=cfg.RF['trees'], max_features='auto',
-                                     max_depth=cfg.RF['max_depth'], n_jobs=cfg.N_JOBS, random_state=cfg.RF['seed'],
-                                     oob_score=True, class_weight='balanced_subsample')
-    elif cfg.CLASSIFIER == 'LDA':
-        cls = LDA()
-    elif cfg.CLASSIFIER == 'rLDA':
-        cls = rLDA(cfg.RLDA_REGULARIZE_COEFF)
-    else:
-        raise ValueError('Unknown classifier %s' % cfg.CLASSIFIER)
+    cls = init_classifier(cfg)
 
     # Setup features
     X_data = featdata['X_data']
     Y_data = featdata['Y_data']
     wlen = featdata['wlen']
-    if cfg.PSD['wlen'] is None:
+    if cfg.FEATURES == 'PSD' and cfg.PSD['wlen'] is None:
         cfg.PSD['wlen'] = wlen
     w_frames = featdata['w_frames']
     ch_names = featdata['ch_names']
     X_data_merged = np.concatenate(X_data)
     Y_data_merged = np.concatenate(Y_data)
     if cfg.BALANCE_SAMPLES:
-        X_data_merged, Y_data_merged = balance_samples(X_data_merged, Y_data_merged, cfg.BALANCE_SAMPLES, verbose=True)
+        X_data_merged, Y_data_merged = balance_samples(X_data_merged, Y_data_merged, cfg.BALANCE_SAMPLES, verbose=True,
+                                                       label_names=cfg.tdef.by_value, random_state=cfg.BALANCE_SEED)
 
     # Start training the decoder
     print('\n>> Training the decoder')
     timer = qc.Timer()
     cls.n_jobs = cfg.N_JOBS
-    cls.fit(X_data_merged, Y_data_merged)
+    with profiler.stage('fit', n_samples=X_data_merged.shape[0], n_features=X_data_merged.shape[1]):
+        cls.fit(X_data_merged, Y_data_merged)
     print('Trained %d samples x %d dimension in %.1f sec' %\
           (X_data_merged.shape[0], X_data_merged.shape[1], timer.sec()))
     cls.n_jobs = 1 # always set n_jobs=1 for testing
@@ -912,26 +1234,26 @@ def train_decoder(cfg, featdata, feat_file=None):
                     notch=cfg.NOTCH_FILTER, notch_ch=featdata['picks'], multiplier=cfg.MULTIPLIER,
                     ref_old=cfg.REF_CH_OLD, ref_new=cfg.REF_CH_NEW)
     elif cfg.FEATURES == 'TIMELAG':
-        data = dict(cls=cls, parameters=cfg.TIMELAG)
+        data = dict(cls=cls, ch_names=ch_names, psde=None, sfreq=featdata['sfreq'],
+                    picks=featdata['picks'], classes=classes, epochs=cfg.EPOCH, w_frames=w_frames,
+                    w_seconds=wlen, wstep=cfg.TIMELAG['wstep'], downsample=featdata['downsample'],
+                    spatial=cfg.SP_FILTER, spatial_ch=featdata['picks'], spectral=cfg.TP_FILTER,
+                    spectral_ch=featdata['picks'], notch=cfg.NOTCH_FILTER, notch_ch=featdata['picks'],
+                    multiplier=cfg.MULTIPLIER, ref_old=cfg.REF_CH_OLD, ref_new=cfg.REF_CH_NEW)
+    data['features'] = cfg.FEATURES
     clsfile = '%s/classifier/classifier-%s.pkl' % (cfg.DATADIR, platform.architecture()[0])
     qc.make_dirs('%s/classifier' % cfg.DATADIR)
     qc.save_obj(clsfile, data)
     print('Decoder saved to %s' % clsfile)
 
-    # Reverse-lookup frequency from FFT
-    fq = 0
-    if type(cfg.PSD['wlen']) == list:
-        fq_res = 1.0 / cfg.PSD['wlen'][0]
-    else:
-        fq_res = 1.0 / cfg.PSD['wlen']
-    fqlist = []
-    while fq <= cfg.PSD['fmax']:
-        if fq >= cfg.PSD['fmin']:
-            fqlist.append(fq)
-        fq += fq_res
-
     # Show top distinctive features
     if cfg.FEATURES == 'PSD':
+        # Reverse-lookup frequency from FFT
+        if type(cfg.EPOCH[0]) is list:
+            fqlist = get_psd_freqs(w_frames[0], featdata['sfreq'], cfg.PSD['fmin'], cfg.PSD['fmax'])
+        else:
+            fqlist = get_psd_freqs(w_frames, featdata['sfreq'], cfg.PSD['fmin'], cfg.PSD['fmax'])
+
         print('\n>> Good features ordered by importance')
         if cfg.CLASSIFIER in ['RF', 'GB', 'XGB']:
             keys, values = qc.sort_by_value(list(cls.feature_importances_), rev=True)
@@ -948,13 +1270,13 @@ def train_decoder(cfg, featdata, feat_file=None):
             else:
                 gfout = open(feat_file, 'w')
 
-        if type(wlen) is not list:
+        if type(cfg.EPOCH[0]) is not list:
             ch_names = [ch_names[c] for c in featdata['picks']]
         else:
             ch_names = []
             for w in range(len(wlen)):
                 for c in featdata['picks']:
-                    ch_names.append('w%d-%s' % (w, ch_names[c]))
+                    ch_names.append('w%d-%s' % (w, featdata['ch_names'][c]))
 
         chlist, hzlist = feature2chz(keys, fqlist, ch_names=ch_names)
         valnorm = values[:cfg.FEAT_TOPN].copy()
@@ -975,24 +1297,376 @@ def train_decoder(cfg, featdata, feat_file=None):
             gfout.close()
         print()
 
+        # Export compact models using only the best features
+        if cfg.FEAT_PRUNE is not None:
+            prune_decoder(cfg, featdata, data)
+
+
+# parameters affecting features; features are recomputed only when these change
+FEATURE_PARAMS = ['FEATURES', 'EPOCH', 'PSD', 'TIMELAG', 'SP_FILTER', 'TP_FILTER', 'NOTCH_FILTER', 'CHANNEL_PICKS',
+                  'EXCLUDES', 'REF_CH_OLD', 'REF_CH_NEW', 'MULTIPLIER']
+
+
+def set_cfg_param(cfg, name, value):
+    """
+    Set a config parameter. Dictionary items are given as 'VAR.key', e.g. 'RF.trees'.
+    Dictionaries are copied before being modified so that the original values are kept.
+    """
+    if '.' in name:
+        var, key = name.split('.', 1)
+        d = dict(getattr(cfg, var))
+        d[key] = value
+        setattr(cfg, var, d)
+    else:
+        setattr(cfg, name, value)
+
+
+def get_search_candidates(search):
+    """
+    Generate parameter sets from the SEARCH config
+
+    Params
+    ======
+    search: dict with the following keys
+        params: {parameter name: list of values or (low, high) tuple for a uniform random range}
+                (low, high) of integers is sampled as integers including high (e.g. n_estimators)
+        method: 'grid' (all combinations) or 'random' (sample n_iter sets)
+        n_iter: number of random samples
+        seed: random seed
+
+    Returns
+    =======
+    list of {parameter name: value}
+    """
+    names = sorted(search['params'].keys())
+    method = search.get('method', 'grid')
+    if method == 'grid':
+        for n in names:
+            if type(search['params'][n]) is not list:
+                raise ValueError('Grid search parameter %s must be a list of values.' % n)
+        values = [search['params'][n] for n in names]
+        return [dict(zip(names, v)) for v in itertools.product(*values)]
+    elif method == 'random':
+        rng = np.random.RandomState(search.get('seed', None))
+        candidates = []
+        for i in range(search.get('n_iter', 10)):
+            c = {}
+            for n in names:
+                space = search['params'][n]
+                if type(space) is tuple:
+                    if all(isinstance(v, (int, np.integer)) for v in space):
+                        c[n] = int(rng.randint(space[0], space[1] + 1))
+                    else:
+                        c[n] = rng.uniform(space[0], space[1])
+                else:
+                    c[n] = space[rng.randint(len(space))]
+            candidates.append(c)
+        return candidates
+    else:
+        raise ValueError('Unknown search method %s' % method)
+
+
+def search_params(cfg, search_file=None):
+    """
+    Search for the best parameters defined in cfg.SEARCH using cross-validation.
+
+    Features are computed once for each distinct set of feature parameters
+    (see FEATURE_PARAMS) and shared by all classifier parameters.
+    With successive halving, all candidates are first evaluated on a subset of folds
+    and only the best 1/eta of them are evaluated on more folds in the next round.
+
+    cfg.SEARCH keys
+    ===============
+    params, method, n_iter, seed: see get_search_candidates()
+    halving: use successive halving (default: False)
+    eta: reduction factor of successive halving (default: 3)
+
+    Returns
+    =======
+    list of (candidate, mean accuracy, std, number of folds) sorted by accuracy
+    """
+    if cfg.CV_PERFORM is None:
+        raise RuntimeError('CV_PERFORM must be defined to search parameters.')
+    search = cfg.SEARCH
+    candidates = get_search_candidates(search)
+    eta = search.get('eta', 3)
+    print('\n>> Searching %d parameter sets' % len(candidates))
+
+    # group candidates by feature parameters
+    groups = {}
+    for i, c in enumerate(candidates):
+        feat_key = repr(sorted([(k, v) for k, v in c.items() if k.split('.')[0] in FEATURE_PARAMS]))
+        groups.setdefault(feat_key, []).append(i)
+
+    # keep original values to restore after each evaluation
+    touched = set([k.split('.')[0] for k in search['params']])
+    cfg_orig = {k:getattr(cfg, k, None) for k in touched}
+    cfg_orig['PSD'] = dict(cfg.PSD)
+
+    def restore_cfg():
+        for k, v in cfg_orig.items():
+            setattr(cfg, k, v)
+        cfg.PSD = dict(cfg_orig['PSD'])
+
+    fold_scores = [[] for c in candidates]
+    for feat_key in groups:
+        members = groups[feat_key]
+        for k, v in candidates[members[0]].items():
+            if k.split('.')[0] in FEATURE_PARAMS:
+                set_cfg_param(cfg, k, v)
+        qc.print_c('\n>> Computing features for %s' % feat_key, 'W')
+        featdata = compute_features(cfg)
+        cv = get_cv(cfg, featdata['Y_data'], verbose=False)
+        if SKLEARN_OLD:
+            splits = list(cv)
+        else:
+            splits = list(cv.split(featdata['X_data'], featdata['Y_data'][:, 0]))
+
+        # number of folds used in each round
+        if search.get('halving', False):
+            n_rounds = max(1, int(math.ceil(math.log(len(members), eta))))
+            round_folds = [max(1, int(len(splits) / eta ** (n_rounds - r - 1))) for r in range(n_rounds)]
+        else:
+            round_folds = [len(splits)]
+
+        # share the features with fold workers once for all candidates of the group
+        n_workers = get_cv_workers(cfg.N_JOBS, len(splits), cfg.CV_BACKEND)
+        cv_pool = None
+        if n_workers > 1:
+            cv_pool = create_cv_pool(featdata['X_data'], featdata['Y_data'], n_workers, cfg.CV_BACKEND)
+        try:
+            alive = list(members)
+            for r, n_folds in enumerate(round_folds):
+                for i in alive:
+                    done = len(fold_scores[i])
+                    if done >= n_folds:
+                        continue
+                    for k, v in candidates[i].items():
+                        if k.split('.')[0] not in FEATURE_PARAMS:
+                            set_cfg_param(cfg, k, v)
+                    cls = init_classifier(cfg)
+                    scores, _ = crossval_epochs(splits[done:n_folds], featdata['X_data'], featdata['Y_data'], cls,
+                                                cfg.tdef.by_value, cfg.BALANCE_SAMPLES, n_jobs=cfg.N_JOBS,
+                                                ignore_thres=cfg.CV_IGNORE_THRES, decision_thres=cfg.CV_DECISION_THRES,
+                                                backend=cfg.CV_BACKEND, balance_seed=cfg.BALANCE_SEED, cv_pool=cv_pool)
+                    fold_scores[i].extend(list(scores))
+                    print('Parameters %s: %.3f (%d folds)' % (candidates[i], np.mean(fold_scores[i]), len(fold_scores[i])))
+                    for k in candidates[i]:
+                        if k.split('.')[0] not in FEATURE_PARAMS:
+                            setattr(cfg, k.split('.')[0], cfg_orig[k.split('.')[0]])
+                if r < len(round_folds) - 1:
+                    alive = sorted(alive, key=lambda i: np.mean(fold_scores[i]), reverse=True)
+                    alive = alive[:max(1, int(math.ceil(len(alive) / eta)))]
+        finally:
+            if cv_pool is not None:
+                remove_cv_pool(cv_pool)
+        restore_cfg()
+        del featdata
+
+    # rank by the number of evaluated folds first, then by accuracy
+    results = [(candidates[i], np.mean(fold_scores[i]), np.std(fold_scores[i]), len(fold_scores[i]))
+               for i in range(len(candidates))]
+    results = sorted(results, key=lambda x: (x[3], x[1]), reverse=True)
+
+    txt = '\n>> Parameter search results (%s, %s)\n' % (search.get('method', 'grid'),
+        'successive halving' if search.get('halving', False) else 'all folds')
+    txt += 'Rank  Accuracy  Std    Folds  Parameters\n'
+    for rank, (c, acc, std, nf) in enumerate(results):
+        txt += '%-4d  %.3f     %.3f  %-5d  %s\n' % (rank + 1, acc, std, nf, ', '.join(['%s=%s' % (k, c[k]) for k in sorted(c)]))
+    print(txt)
+
+    if search_file is None:
+        qc.make_dirs('%s/classifier' % cfg.DATADIR)
+        search_file = '%s/classifier/search_result.txt' % cfg.DATADIR
+    with open(search_file, 'w') as fout:
+        fout.write(txt)
+    print('Search results saved to %s' % search_file)
+    return results
+
+
+def get_feature_ranking(cls):
+    """
+    Returns feature indices sorted by importance in descending order.
+    Linear models are ranked by the absolute values of their weights.
+    """
+    if hasattr(cls, 'feature_importances_'):
+        importance = np.array(cls.feature_importances_)
+    elif hasattr(cls, 'coef_'):
+        importance = np.abs(np.array(cls.coef_)).sum(axis=0)
+    elif hasattr(cls, 'w'):
+        importance = np.abs(np.array(cls.w)).reshape(-1)
+    else:
+        raise NotImplementedError('Cannot rank features of %s' % type(cls))
+    return np.argsort(importance)[::-1]
+
+
+def measure_latency(psde, cls, n_channels, w_frames, feat_index=None, repeats=50):
+    """
+    Measure the online computation time of PSD and classification of a single window
+
+    Returns
+    =======
+    Median latency in milliseconds
+    """
+    rng = np.random.RandomState(0)
+    times = []
+    for i in range(repeats):
+        w = rng.randn(1, n_channels, w_frames)
+        t = timeit.default_timer()
+        feats = psde.transform(w).reshape(1, -1)
+        if feat_index is not None:
+            feats = feats[:, feat_index]
+        cls.predict_proba(feats)
+        times.append(timeit.default_timer() - t)
+    return np.median(times) * 1000.0
+
+
+def prune_decoder(cfg, featdata, model):
+    """
+    Retrain the decoder on the top-K features for each K in cfg.FEAT_PRUNE and export compact models.
+
+    Each exported model computes PSD only over the channels and the frequency range
+    containing the selected features. Preprocessing channels are not changed.
+    The accuracy-latency tradeoff is written to classifier/prune_result.txt.
+
+    Params
+    ======
+    cfg: config module
+    featdata: feature data computed using compute_features()
+    model: exported full model dictionary
+    """
+    if type(featdata['wlen']) is list:
+        raise NotImplementedError('Feature pruning is not supported for multiple epoch ranges or window lengths.')
+    X_data = featdata['X_data']
+    Y_data = featdata['Y_data']
+    picks = featdata['picks']
+    w_frames = featdata['w_frames']
+    sfreq = featdata['sfreq']
+
+    # frequency bins of the full PSD estimator
+    freqs = get_psd_freqs(w_frames, sfreq, cfg.PSD['fmin'], cfg.PSD['fmax'])
+    n_freqs = len(freqs)
+    assert n_freqs * len(picks) == X_data.shape[2]
+
+    ranking = get_feature_ranking(model['cls'])
+    if cfg.CV_PERFORM is not None:
+        cv = get_cv(cfg, Y_data, verbose=False)
+        if SKLEARN_OLD:
+            splits = list(cv)
+        else:
+            splits = list(cv.split(X_data, Y_data[:, 0]))
+
+    print('\n>> Pruning features')
+    results = []
+    cls_full = init_classifier(cfg)
+    if cfg.CV_PERFORM is not None:
+        scores, _ = crossval_epochs(splits, X_data, Y_data, cls_full, cfg.tdef.by_value, cfg.BALANCE_SAMPLES,
+                                    n_jobs=cfg.N_JOBS, backend=cfg.CV_BACKEND, balance_seed=cfg.BALANCE_SEED)
+    else:
+        scores = [np.nan]
+    latency = measure_latency(model['psde'], model['cls'], len(picks), w_frames)
+    results.append((X_data.shape[2], len(picks), n_freqs, np.mean(scores), np.std(scores), latency))
+
+    for k in sorted(cfg.FEAT_PRUNE):
+        if k >= X_data.shape[2]:
+            qc.print_c('prune_decoder(): K=%d is not smaller than the number of features. Skipped.' % k, 'Y')
+            continue
+        feats = np.sort(ranking[:k])
+        ch_pos = np.unique(feats // n_freqs)
+        fq_pos = feats % n_freqs
+        fq_lo, fq_hi = fq_pos.min(), fq_pos.max()
+        n_freqs_k = fq_hi - fq_lo + 1
+        # feature indices in the reduced [channels x frequencies] PSD
+        ch_map = {c:i for i, c in enumerate(ch_pos)}
+        feat_index = np.array([ch_map[f // n_freqs] * n_freqs_k + (f % n_freqs) - fq_lo for f in feats])
+
+        # cross-validate and train on the selected features
+        X_k = np.ascontiguousarray(X_data[:, :, feats])
+        cls = init_classifier(cfg)
+        if cfg.CV_PERFORM is not None:
+            scores, _ = crossval_epochs(splits, X_k, Y_data, cls, cfg.tdef.by_value, cfg.BALANCE_SAMPLES,
+                                        n_jobs=cfg.N_JOBS, backend=cfg.CV_BACKEND, balance_seed=cfg.BALANCE_SEED)
+        else:
+            scores = [np.nan]
+        X_merged = np.concatenate(X_k)
+        Y_merged = np.concatenate(Y_data)
+        if cfg.BALANCE_SAMPLES:
+            X_merged, Y_merged = balance_samples(X_merged, Y_merged, cfg.BALANCE_SAMPLES, random_state=cfg.BALANCE_SEED)
+        cls = init_classifier(cfg)
+        cls.n_jobs = cfg.N_JOBS
+        cls.fit(X_merged, Y_merged)
+        cls.n_jobs = 1
+
+        # PSD estimator covering only the selected frequency range
+        psde = mne.decoding.PSDEstimator(sfreq=sfreq, fmin=freqs[fq_lo], fmax=freqs[fq_hi], bandwidth=None,
+                                         adaptive=False, low_bias=True, n_jobs=1, normalization='length',
+                                         verbose='WARNING')
+        # the reduced estimator must produce exactly the selected frequency bins or feat_index is invalid
+        n_freqs_out = psde.transform(np.zeros((1, len(ch_pos), w_frames))).shape[2]
+        if n_freqs_out != n_freqs_k:
+            raise RuntimeError('prune_decoder(): Reduced PSD estimator of top-%d decoder outputs %d frequency bins instead of %d.'
+                               % (k, n_freqs_out, n_freqs_k))
+        latency = measure_latency(psde, cls, len(ch_pos), w_frames, feat_index)
+        results.append((k, len(ch_pos), n_freqs_k, np.mean(scores), np.std(scores), latency))
+
+        data = dict(model)
+        data.update(cls=cls, psde=psde, picks=[picks[c] for c in ch_pos], feat_index=feat_index)
+        clsfile = '%s/classifier/classifier-%s-top%d.pkl' % (cfg.DATADIR, platform.architecture()[0], k)
+        qc.save_obj(clsfile, data)
+        print('Top-%d decoder saved to %s' % (k, clsfile))
+
+    txt = 'Features  Channels  Freq bins  CV accuracy (std)  Latency (ms)\n'
+    for k, n_ch, n_fq, acc, std, lat in results:
+        txt += '%-8d  %-8d  %-9d  %.3f (%.3f)      %.2f\n' % (k, n_ch, n_fq, acc, std, lat)
+    txt += '\nLatency: median PSD and classification time of a single window.\n'
+    txt += 'The first row is the full model.\n'
+    print(txt)
+    prune_file = '%s/classifier/prune_result.txt' % cfg.DATADIR
+    with open(prune_file, 'w') as fout:
+        fout.write(txt)
+    print('Pruning results saved to %s' % prune_file)
+
 
 def run_trainer(cfg_file, interactive=False, cv_file=None, feat_file=None):
     # Check config module
     cfg = load_cfg(cfg_file)
 
+    # Search parameters instead of training
+    if cfg.SEARCH is not None:
+        search_params(cfg)
+        return
+
+    # Record the time and memory of each stage
+    profiler = qc.StageProfiler()
+
     # Extract features
-    featdata = compute_features(cfg)
+    featdata = compute_features(cfg, profiler=profiler)
 
     # Find optimal threshold for TPR balancing
     #balance_tpr(cfg, featdata)
 
     # Perform cross validation
     if cfg.CV_PERFORM is not None:
-        cross_validate(cfg, featdata, cv_file=cv_file)
+        with profiler.stage('cross_validate'):
+            cross_validate(cfg, featdata, cv_file=cv_file, profiler=profiler)
 
     # Train a decoder
     if cfg.EXPORT_CLS is True:
-        train_decoder(cfg, featdata, feat_file=feat_file)
+        with profiler.stage('train_decoder'):
+            train_decoder(cfg, featdata, feat_file=feat_file, profiler=profiler)
+
+    # Export timing breakdown next to the cross-validation result
+    profiler.print_summary()
+    if cfg.EXPORT_PROFILE:
+        if cv_file is not None:
+            profile_file = '%s/profile.json' % os.path.dirname(os.path.abspath(cv_file))
+        elif cfg.EXPORT_CLS is True:
+            qc.make_dirs('%s/classifier' % cfg.DATADIR)
+            profile_file = '%s/classifier/profile.json' % cfg.DATADIR
+        else:
+            profile_file = '%s/profile.json' % cfg.DATADIR
+        profiler.save_json(profile_file)
+        print('Profile saved to %s' % profile_file)
 
 
 def config_run(cfg_file):
@@ -207,6 +207,10 @@ class Feedback:
                 else:
                     raise RuntimeError('Unknown truedirection %s' % true_label)
 
+                # collect features of this trial for online adaptation
+                if self.cfg.ADAPTIVE is not None:
+                    decoder.adapt_begin()
+
                 self.tm_watchdog.reset()
                 self.tm_trigger.reset()
 
@@ -261,6 +265,12 @@ class Feedback:
                         self.logf.write('%s detected as %s (%d)\n\n' % (true_label, bar_label, bar_score))
                         self.logf.flush()
 
+                    # update the decoder with the true label
+                    if self.cfg.ADAPTIVE is not None:
+                        n_adapt = decoder.adapt_end(true_label_index)
+                        if self.logf is not None:
+                            self.logf.write('Adapted with %d samples\n' % n_adapt)
+
                     # end of trial
                     state = 'feedback'
                     self.tm_trigger.reset()
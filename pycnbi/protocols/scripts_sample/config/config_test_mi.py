@@ -2,7 +2,7 @@
 CLS_MI = r'D:\data\MI\q5\2016\train\classifier\classifier-64bit.pcl'
 
 # trigger device
-TRIGGER_DEVICE = 'ARDUINO'  # None | 'ARDUINO' | 'USB2LPT' | 'DESKTOP' | 'FAKE'
+TRIGGER_DEVICE = 'ARDUINO'  # None | 'ARDUINO' | 'USB2LPT' | 'DESKTOP' | 'SOFTWARE' | 'LSL' | 'FAKE'
 TRIGGER_DEF = 'triggerdef_16'  # see full list: ROOT/Triggers/triggerdef_*.py
 
 # define bar direction for each class label: (bar direction, class label)
@@ -27,6 +27,10 @@ REFRESH_RATE = 30  # maximum refresh rate in Hz
 # evidence accumulation parameter
 PROB_ACC_ALPHA = 0.8  # p_new= p_old * alpha + p_new * (1-alpha)
 
+# online adaptation of LDA/rLDA classifiers using the true labels of trials
+# None or dict(uc_mu=0.01, uc_cov=0.001). The adapted classifier is saved next to CLS_MI.
+ADAPTIVE = None
+
 # bar bias: None or (direction, probability)
 BAR_BIAS = None  # ('U',0.01)
 
@@ -1,4 +1,4 @@
-# Trigger device type ['ARDUINO', 'USB2LPT', 'SOFTWARE', 'DESKTOP', None]
+# Trigger device type ['ARDUINO', 'USB2LPT', 'SOFTWARE', 'LSL', 'DESKTOP', None]
 TRIGGER_DEVICE = None
 TRIGGER_DEF = 'triggerdef_16'  # full list: pycnbi.ROOT/Triggers/*.ini
 
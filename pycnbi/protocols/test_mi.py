@@ -94,7 +94,8 @@ def load_cfg(cfg_module):
         'SCREEN_POS':(0, 0),
         'WITH_REX':False,
         'DEBUG_PROBS':False,
-        'LOG_PROBS':False
+        'LOG_PROBS':False,
+        'ADAPTIVE':None
     }
 
     if not (hasattr(cfg, 'BAR_STEP') or hasattr(cfg, 'BAR_STEP_LEFT') or\
@@ -148,6 +149,8 @@ def config_run(cfg_module):
     decoder = BCIDecoderDaemon(cfg.CLS_MI, buffer_size=1.0, fake=(cfg.FAKE_CLS is not None),
                                amp_name=amp_name, amp_serial=amp_serial, fake_dirs=fake_dirs,
                                parallel=cfg.PARALLEL_DECODING, alpha_new=cfg.PROB_ALPHA_NEW)
+    if cfg.ADAPTIVE is not None:
+        decoder.adapt_init(**cfg.ADAPTIVE)
 
     # OLD: requires trigger values to be always defined
     #labels = [tdef.by_value[x] for x in decoder.get_labels()]
@@ -268,6 +271,9 @@ def config_run(cfg_module):
     visual.finish()
     if decoder:
         decoder.stop()
+        if cfg.ADAPTIVE is not None:
+            fdir, fname, fext = qc.parse_path_list(cfg.CLS_MI)
+            decoder.save_model(time.strftime('%s%s-adapted-%%Y%%m%%d-%%H%%M%%S.%s' % (fdir, fname, fext), time.localtime()))
 
     '''
     # automatic thresholding
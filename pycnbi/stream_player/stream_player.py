@@ -5,14 +5,33 @@ Stream Player
 
 Stream signals from a recorded file on LSL network.
 
-For Windows users, make sure to use the provided time resolution
-tweak tool to set to 500us time resolution of the OS.
+StreamPlayer class plays a file in a background thread and can be controlled
+programmatically: playback speed, seeking to a time or an event, and looping
+a segment. Several files can be played at the same time as separate LSL
+servers using play_files(). stream_player() is the interactive front-end.
+
+Long recordings can be played with lazy=True. Instead of loading the whole
+file into memory, blocks of read_ahead seconds are read on demand from a
+non-preloaded MNE Raw object, so the startup time does not depend on the
+recording length. With cache_dir, the signals are converted once into a
+float32 binary file in cache_dir which is memory-mapped in later runs.
+
+Chunks are sent on an absolute schedule: the player sleeps until spin_sec
+before each deadline and busy-waits for the rest, which gives sub-millisecond
+accuracy at low cpu usage. Deviations of the actual push times from the
+schedule are available from get_timing_stats(). On Linux and OS X no OS
+tweak is needed. For Windows users, the provided time resolution tweak tool
+(500us time resolution of the OS) is still recommended, otherwise increase
+spin_sec up to the timer resolution (~16 ms).
 
 Kyuhwa Lee, 2015
 
 """
 
+import os
+import json
 import time
+import threading
 import numpy as np
 import pylsl
 import pycnbi.utils.q_common as qc
@@ -20,109 +39,524 @@ import pycnbi.utils.pycnbi_utils as pu
 from pycnbi.triggers.trigger_def import trigger_def
 from builtins import input
 
-def stream_player(server_name, fif_file, chunk_size, auto_restart=True, high_resolution=False, verbose=None, trigger_file=None):
+# perf_counter() is not available in Python 2
+try:
+    clock = time.perf_counter
+except AttributeError:
+    clock = time.time
+
+
+def sleep_until(t_target, spin_sec=0.002):
+    """
+    Wait until clock() reaches t_target
+
+    Sleeps until spin_sec seconds before t_target and busy-waits for the rest,
+    so that the inaccuracy of time.sleep() does not delay the wake-up.
+    """
+    t_wait = t_target - clock() - spin_sec
+    if t_wait > 0:
+        time.sleep(t_wait)
+    while clock() < t_target:
+        pass
+
+
+class StreamPlayer(object):
+    """
+    Play a recorded file on LSL network in a background thread
+
+    Usage:
+        player = StreamPlayer('StreamPlayer', 'record.fif', speed=10.0)
+        player.seek_event(3)  # start from the first event with value 3
+        player.set_segment(10.0, 20.0)  # loop between 10 and 20 seconds
+        player.start()
+        ...
+        player.stop()
+
+    """
+
+    def __init__(self, server_name, fif_file, chunk_size=8, speed=1.0, loop=True, high_resolution=False,
+                 verbose=None, trigger_file=None, lazy=False, read_ahead=2.0, cache_dir=None, spin_sec=0.002):
+        """
+        Params
+        ======
+
+        server_name: LSL server name.
+        fif_file: fif file to replay.
+        chunk_size: number of samples to send at once (usually 16-32 is good enough).
+        speed: playback speed multiplier, e.g. 0.5 for half speed, 10 for 10 times faster than real-time.
+        loop: play from beginning (or the segment start) again after reaching the end.
+        high_resolution: busy-wait for the whole interval instead of sleeping. Uses 100% of a cpu core
+                         and is rarely needed since the default scheduler already spins before deadlines.
+        spin_sec: busy-wait this many seconds before each deadline after sleeping.
+        trigger_file: used to convert event numbers into event strings for readability.
+        verbose:
+            'timestamp': show timestamp each time data is pushed out
+            'events': show non-zero events whenever pushed out
+        lazy: read data on demand instead of loading the whole file into memory.
+        read_ahead: length of the data block read at once in seconds when lazy=True.
+        cache_dir: if not None and lazy=True, convert the file into a float32 binary cache
+                   in this directory once and memory-map it afterwards.
+        """
+        self.server_name = server_name
+        self.fif_file = fif_file
+        self.chunk_size = chunk_size
+        self.loop = loop
+        self.high_resolution = high_resolution
+        self.spin_sec = spin_sec
+        self.verbose = verbose
+        self.tdef = None if trigger_file is None else trigger_def(trigger_file)
+        self.set_speed(speed)
+        self.raw = None
+        self.block = None
+        self.block_start = 0
+
+        if not lazy:
+            self.load()
+        elif cache_dir is None:
+            self.load_lazy(read_ahead)
+        else:
+            self.load_cache(cache_dir)
+        self.print_info()
+
+        # playback state shared with the streaming thread
+        self.lock = threading.Lock()
+        self.running = threading.Event()
+        self.finished = threading.Event()
+        self.thread = None
+        self.pos = 0  # index of the next sample to be sent
+        self.seg_start = 0
+        self.seg_end = self.n_samples
+        self.rebase = True  # reset the time reference at the next chunk
+        self.reset_timing_stats()
+
+        self.outlet = self.create_outlet()
+
+    def print(self, *args):
+        qc.print_c('[StreamPlayer:%s] ' % self.server_name, color='w', end='')
+        print(*args)
+
+    def load(self):
+        raw, events = pu.load_raw(self.fif_file)
+        if raw is None:
+            raise RuntimeError('Error while loading %s' % self.fif_file)
+        self.sfreq = raw.info['sfreq']  # sampling frequency
+        self.ch_names = raw.ch_names
+        self.n_channels = len(raw.ch_names)  # number of channels
+        try:
+            self.event_ch = raw.ch_names.index('TRIGGER')
+        except ValueError:
+            self.event_ch = None
+
+        # samples x channels array in the outlet's data type. Each chunk is a contiguous
+        # slice of it, which pylsl pushes directly from the buffer without building lists.
+        self.data = np.ascontiguousarray(raw._data.T, dtype=np.float32)
+        self.n_samples = self.data.shape[0]
+
+        # event onsets as sample indices for printing events without scanning each chunk
+        if len(events) > 0:
+            self.ev_index = events[:, 0] - raw.first_samp
+            self.ev_value = events[:, 2]
+        else:
+            self.ev_index = np.zeros(0, dtype=int)
+            self.ev_value = np.zeros(0, dtype=int)
+
+    def load_lazy(self, read_ahead):
+        """
+        Open the file without reading the signals. Events are searched when first needed.
+        """
+        if not os.path.exists(self.fif_file):
+            raise IOError('File %s not found' % self.fif_file)
+        self.raw = pu.read_raw(self.fif_file, preload=False)
+        self.sfreq = self.raw.info['sfreq']
+        self.ch_names = self.raw.ch_names
+        self.n_channels = len(self.ch_names)
+        try:
+            self.event_ch = self.ch_names.index('TRIGGER')
+        except ValueError:
+            self.event_ch = None
+        self.n_samples = self.raw.n_times
+        self.block_len = max(self.chunk_size, int(round(read_ahead * self.sfreq)))
+        self.ev_index = None
+        self.ev_value = None
+
+    def load_cache(self, cache_dir):
+        """
+        Memory-map the binary cache of the file. The cache is created if it does not
+        exist or the source file has been modified since it was created.
+        """
+        if not os.path.exists(self.fif_file):
+            raise IOError('File %s not found' % self.fif_file)
+        basename = '%s/%s' % (cache_dir, qc.parse_path(self.fif_file).name)
+        source = dict(path=os.path.abspath(self.fif_file), size=os.path.getsize(self.fif_file),
+                      mtime=os.path.getmtime(self.fif_file))
+        header = None
+        if os.path.exists(basename + '.play.hdr') and os.path.exists(basename + '.play.dat'):
+            with open(basename + '.play.hdr') as f:
+                header = json.load(f)
+            if header['source'] != source:
+                header = None
+        if header is None:
+            qc.make_dirs(cache_dir)
+            header = self.create_cache(basename + '.play.dat', source)
+            with open(basename + '.play.hdr', 'w') as f:
+                json.dump(header, f, indent=2)
+        else:
+            print('Using cache %s.play.dat' % basename)
+
+        self.sfreq = header['sfreq']
+        self.ch_names = [str(c) for c in header['ch_names']]
+        self.n_channels = len(self.ch_names)
+        self.event_ch = header['event_ch']
+        self.n_samples = header['n_samples']
+        # copy-on-write mapping: pylsl's push_chunk() needs writable buffers, but the
+        # cache file is never modified since the data are only read
+        self.data = np.memmap(basename + '.play.dat', dtype=np.float32, mode='c',
+                              shape=(self.n_samples, self.n_channels))
+        events = np.array(header['events'], dtype=int).reshape(-1, 2)
+        self.ev_index = events[:, 0]
+        self.ev_value = events[:, 1]
+
+    def create_cache(self, cache_file, source, block_sec=60.0):
+        """
+        Convert the file into a samples x channels float32 binary file block by block
+
+        Returns
+        =======
+        cache header
+        """
+        print('Creating cache %s' % cache_file)
+        self.raw = pu.read_raw(self.fif_file, preload=False)
+        self.sfreq = self.raw.info['sfreq']
+        n_samples = self.raw.n_times
+        ch_names = self.raw.ch_names
+        try:
+            event_ch = ch_names.index('TRIGGER')
+        except ValueError:
+            event_ch = None
+        self.block_len = int(round(block_sec * self.sfreq))
+        self.n_samples = n_samples
+        ev_index, ev_value = [], []
+        tch = event_ch
+        trigger_last = 0
+        with open(cache_file, 'wb') as f:
+            for start in range(0, n_samples, self.block_len):
+                self.read_block(start)
+                f.write(self.block.tobytes())
+                if tch is not None:
+                    idx, val = self.find_onsets(self.block[:, tch], trigger_last)
+                    ev_index.extend(idx + start)
+                    ev_value.extend(val)
+                    trigger_last = self.block[-1, tch]
+        self.raw = None
+        self.block = None
+        return dict(source=source, sfreq=self.sfreq, ch_names=ch_names,
+                    event_ch=event_ch, n_samples=n_samples,
+                    events=[[int(i), int(v)] for i, v in zip(ev_index, ev_value)])
+
+    @staticmethod
+    def find_onsets(trigger, trigger_last=0):
+        """
+        Find sample indices and values of trigger value changes to non-zero values
+        """
+        trigger = np.concatenate(([trigger_last], trigger))
+        onsets = np.where((trigger[1:] != trigger[:-1]) & (trigger[1:] != 0))[0]
+        return onsets, trigger[onsets + 1].astype(int)
+
+    def read_block(self, start):
+        """
+        Read block_len samples from start into the read-ahead buffer
+        """
+        stop = min(start + self.block_len, self.n_samples)
+        self.block = np.ascontiguousarray(self.raw.get_data(start=start, stop=stop).T, dtype=np.float32)
+        self.block_start = start
+
+    def get_chunk(self, idx_from, idx_to):
+        if self.raw is None:
+            return self.data[idx_from:idx_to]
+        if self.block is None or idx_from < self.block_start or idx_to > self.block_start + len(self.block):
+            self.read_block(idx_from)
+        return self.block[idx_from - self.block_start:idx_to - self.block_start]
+
+    def find_events(self):
+        """
+        Search events in lazy mode by reading the trigger channel block by block
+        """
+        ev_index, ev_value = [], []
+        tch = self.event_ch
+        if tch is not None:
+            trigger_last = 0
+            for start in range(0, self.n_samples, self.block_len):
+                stop = min(start + self.block_len, self.n_samples)
+                trigger = self.raw.get_data(picks=[tch], start=start, stop=stop)[0]
+                idx, val = self.find_onsets(trigger, trigger_last)
+                ev_index.extend(idx + start)
+                ev_value.extend(val)
+                trigger_last = trigger[-1]
+        self.ev_index = np.array(ev_index, dtype=int)
+        self.ev_value = np.array(ev_value, dtype=int)
+
+    def get_events(self):
+        """
+        Returns
+        =======
+        event onset sample indices, event values
+        """
+        if self.ev_index is None:
+            self.find_events()
+        return self.ev_index, self.ev_value
+
+    def print_info(self):
+        print('Successfully loaded %s\n' % self.fif_file)
+        print('Server name: %s' % self.server_name)
+        print('Sampling frequency %.1f Hz' % self.sfreq)
+        print('Number of channels : %d' % self.n_channels)
+        print('Chunk size : %d' % self.chunk_size)
+        for i, ch in enumerate(self.ch_names):
+            print(i, ch)
+        print('Trigger channel : %s' % self.event_ch)
+
+    def create_outlet(self):
+        # set server information
+        sinfo = pylsl.StreamInfo(self.server_name, channel_count=self.n_channels, channel_format='float32',\
+            nominal_srate=self.sfreq, type='EEG', source_id=self.server_name)
+        desc = sinfo.desc()
+        channel_desc = desc.append_child("channels")
+        for ch in self.ch_names:
+            channel_desc.append_child('channel').append_child_value('label', str(ch))\
+                .append_child_value('type','EEG').append_child_value('unit','microvolts')
+        desc.append_child('amplifier').append_child('settings').append_child_value('is_slave', 'false')
+        desc.append_child('acquisition').append_child_value('manufacturer', 'PyCNBI').append_child_value('serial_number', 'N/A')
+        return pylsl.StreamOutlet(sinfo, chunk_size=self.chunk_size)
+
+    def set_speed(self, speed):
+        """
+        Set the playback speed multiplier
+        """
+        if speed <= 0:
+            raise ValueError('Playback speed must be positive.')
+        self.speed = float(speed)
+        self.rebase = True
+
+    def seek(self, sec):
+        """
+        Move to the given time in seconds from the beginning of the file
+        """
+        pos = int(round(sec * self.sfreq))
+        if not 0 <= pos < self.n_samples:
+            raise ValueError('Time %.3f sec is out of range (0 - %.3f sec).' % (sec, self.n_samples / self.sfreq))
+        with self.lock:
+            self.pos = pos
+            self.rebase = True
+
+    def seek_event(self, value, nth=0, pre_sec=0.0):
+        """
+        Move to the onset of the nth (0-based) event with the given value
+
+        pre_sec: start playing this many seconds before the event onset
+        """
+        ev_index, ev_value = self.get_events()
+        onsets = ev_index[ev_value == value]
+        if len(onsets) <= nth:
+            raise ValueError('Event %s #%d not found. There are %d such events.' % (value, nth, len(onsets)))
+        self.seek(max(0, onsets[nth] / self.sfreq - pre_sec))
+
+    def set_segment(self, start_sec=None, end_sec=None):
+        """
+        Play only between start_sec and end_sec. None means the beginning or the end of the file.
+        With loop=True, the segment is played repeatedly.
+        """
+        seg_start = 0 if start_sec is None else int(round(start_sec * self.sfreq))
+        seg_end = self.n_samples if end_sec is None else min(self.n_samples, int(round(end_sec * self.sfreq)))
+        if not 0 <= seg_start < seg_end:
+            raise ValueError('Wrong segment range %s - %s' % (start_sec, end_sec))
+        with self.lock:
+            self.seg_start = seg_start
+            self.seg_end = seg_end
+            if not seg_start <= self.pos < seg_end:
+                self.pos = seg_start
+            self.rebase = True
+
+    def get_position(self):
+        """
+        Current playback position in seconds
+        """
+        return self.pos / self.sfreq
+
+    def start(self):
+        """
+        Start streaming in a background thread. Returns immediately.
+        """
+        if self.is_running():
+            return
+        self.finished.clear()
+        self.running.set()
+        self.rebase = True
+        self.thread = threading.Thread(target=self.play)
+        self.thread.daemon = True
+        self.thread.start()
+        self.print('Streaming started')
+
+    def stop(self):
+        """
+        Stop streaming. The position is kept, so start() resumes from where it stopped.
+        """
+        self.running.clear()
+        if self.thread is not None and self.thread is not threading.current_thread():
+            self.thread.join()
+
+    def is_running(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    def wait(self, timeout=None):
+        """
+        Wait until the end of data is reached when loop=False. Returns False on timeout.
+        """
+        return self.finished.wait(timeout)
+
+    def reset_timing_stats(self):
+        self.t_n = 0
+        self.t_sum = 0.0
+        self.t_sumsq = 0.0
+        self.t_max = 0.0
+        self.t_drift = 0.0
+
+    def get_timing_stats(self):
+        """
+        Deviations of the actual push times from the schedule in milliseconds
+
+        Returns
+        =======
+        dict with the following keys:
+        n_chunks: number of chunks sent since the last reset
+        mean_ms: average delay
+        jitter_ms: standard deviation of the delay
+        max_ms: maximum delay
+        drift_ms: delay of the last chunk. As the schedule is absolute, this is the cumulative
+                  drift since the last time reference reset (start, seek, speed change or loop).
+        """
+        n = self.t_n
+        if n == 0:
+            return dict(n_chunks=0, mean_ms=0.0, jitter_ms=0.0, max_ms=0.0, drift_ms=0.0)
+        mean = self.t_sum / n
+        var = max(0.0, self.t_sumsq / n - mean ** 2)
+        return dict(n_chunks=n, mean_ms=mean * 1000.0, jitter_ms=var ** 0.5 * 1000.0,
+                    max_ms=self.t_max * 1000.0, drift_ms=self.t_drift * 1000.0)
+
+    def print_timing_stats(self):
+        st = self.get_timing_stats()
+        self.print('%d chunks, delay mean %.3f ms, jitter %.3f ms, max %.3f ms, drift %.3f ms' %\
+            (st['n_chunks'], st['mean_ms'], st['jitter_ms'], st['max_ms'], st['drift_ms']))
+
+    def print_events(self, idx_from, idx_to):
+        ev_index, ev_value = self.get_events()
+        ev_from, ev_to = np.searchsorted(ev_index, [idx_from, idx_to])
+        event_values = set(ev_value[ev_from:ev_to])
+        if len(event_values) > 0:
+            if self.tdef is None:
+                print('Events: %s' % event_values)
+            else:
+                print('Events:', end=' ')
+                for event in event_values:
+                    print('%s' % self.tdef.by_value[event], end=' ')
+                print()
+
+    def play(self):
+        """
+        Streaming loop running in the background thread
+        """
+        while self.running.is_set():
+            with self.lock:
+                if self.rebase:
+                    # time reference: the sample at pos_ref is sent at t_ref
+                    t_ref = clock()
+                    pos_ref = self.pos
+                    t_sample = 1.0 / (self.sfreq * self.speed)
+                    self.rebase = False
+                idx_current = self.pos
+                idx_next = min(idx_current + self.chunk_size, self.seg_end)
+                self.pos = idx_next
+            chunk = self.get_chunk(idx_current, idx_next)
+
+            t_send = t_ref + (idx_current - pos_ref) * t_sample
+            if self.high_resolution:
+                while clock() < t_send:
+                    pass
+            else:
+                sleep_until(t_send, self.spin_sec)
+            t_push = clock()
+            if len(chunk) > 0:
+                self.outlet.push_chunk(chunk)
+
+            delay = t_push - t_send
+            self.t_n += 1
+            self.t_sum += delay
+            self.t_sumsq += delay * delay
+            self.t_drift = delay
+            if delay > self.t_max:
+                self.t_max = delay
+            if self.verbose == 'timestamp':
+                print('[%8.3fs] sent %d samples (delay %.3f ms)' % (t_push, len(chunk), delay * 1000.0))
+            elif self.verbose == 'events' and self.event_ch is not None:
+                self.print_events(idx_current, idx_next)
+
+            if idx_next >= self.seg_end:
+                with self.lock:
+                    self.pos = self.seg_start
+                    self.rebase = True
+                if self.loop:
+                    self.print('Reached the end of data. Restarting.')
+                else:
+                    self.print('Reached the end of data.')
+                    self.print_timing_stats()
+                    self.running.clear()
+                    self.finished.set()
+
+
+def play_files(fif_files, server_names=None, start=True, **kwargs):
     """
+    Play multiple files at the same time, each on its own LSL server
+
     Params
     ======
+    fif_files: list of fif files
+    server_names: list of LSL server names. Default: StreamPlayer1, StreamPlayer2, ...
+    start: start streaming immediately
+    kwargs: parameters passed to StreamPlayer
 
-    server_name: LSL server name.
-    fif_file: fif file to replay.
-    chunk_size: number of samples to send at once (usually 16-32 is good enough).
-    auto_restart: play from beginning again after reaching the end.
-    high_resolution: use perf_counter() instead of sleep() for higher time resolution
-                     but uses much more cpu due to polling.
-    trigger_file: used to convert event numbers into event strings for readability.
-    verbose:
-        'timestamp': show timestamp each time data is pushed out
-        'events': show non-zero events whenever pushed out
+    Returns
+    =======
+    list of StreamPlayer objects
     """
-    raw, events = pu.load_raw(fif_file)
-    sfreq = raw.info['sfreq']  # sampling frequency
-    n_channels = len(raw.ch_names)  # number of channels
-    if trigger_file is not None:
-        tdef = trigger_def(trigger_file)
-    try:
-        event_ch = raw.ch_names.index('TRIGGER')
-    except ValueError:
-        event_ch = None
-    if raw is not None:
-        print('Successfully loaded %s\n' % fif_file)
-        print('Server name: %s' % server_name)
-        print('Sampling frequency %.1f Hz' % sfreq)
-        print('Number of channels : %d' % n_channels)
-        print('Chunk size : %d' % chunk_size)
-        for i, ch in enumerate(raw.ch_names):
-            print(i, ch)
-        print('Trigger channel : %s' % event_ch)
-    else:
-        raise RuntimeError('Error while loading %s' % fif_file)
-
-    # set server information
-    sinfo = pylsl.StreamInfo(server_name, channel_count=n_channels, channel_format='float32',\
-        nominal_srate=sfreq, type='EEG', source_id=server_name)
-    desc = sinfo.desc()
-    channel_desc = desc.append_child("channels")
-    for ch in raw.ch_names:
-        channel_desc.append_child('channel').append_child_value('label', str(ch))\
-            .append_child_value('type','EEG').append_child_value('unit','microvolts')
-    desc.append_child('amplifier').append_child('settings').append_child_value('is_slave', 'false')
-    desc.append_child('acquisition').append_child_value('manufacturer', 'PyCNBI').append_child_value('serial_number', 'N/A')
-    outlet = pylsl.StreamOutlet(sinfo, chunk_size=chunk_size)
+    if server_names is None:
+        server_names = ['StreamPlayer%d' % (i + 1) for i in range(len(fif_files))]
+    if len(server_names) != len(fif_files):
+        raise ValueError('The number of server names must match the number of files.')
+    players = [StreamPlayer(name, f, **kwargs) for name, f in zip(server_names, fif_files)]
+    if start:
+        for p in players:
+            p.start()
+    return players
+
 
+def stream_player(server_name, fif_file, chunk_size, auto_restart=True, high_resolution=False, verbose=None,
+                  trigger_file=None, lazy=False, cache_dir=None):
+    """
+    Interactive stream player. See StreamPlayer for the parameters.
+
+    auto_restart: play from beginning again after reaching the end.
+    """
+    player = StreamPlayer(server_name, fif_file, chunk_size, loop=auto_restart, high_resolution=high_resolution,
+                          verbose=verbose, trigger_file=trigger_file, lazy=lazy, cache_dir=cache_dir)
     input('Press Enter to start streaming.')
-    print('Streaming started')
-
-    idx_chunk = 0
-    t_chunk = chunk_size / sfreq
-    finished = False
-    if high_resolution:
-        t_start = time.perf_counter()
-    else:
-        t_start = time.time()
-    
-    # start streaming
-    while True:
-        idx_current = idx_chunk * chunk_size
-        chunk = raw._data[:, idx_current:idx_current + chunk_size]
-        data = chunk.transpose().tolist()
-        if idx_current >= raw._data.shape[1] - chunk_size:
-            finished = True
-        if high_resolution:
-            # if a resolution over 2 KHz is needed
-            t_sleep_until = t_start + idx_chunk * t_chunk
-            while time.perf_counter() < t_sleep_until:
-                pass
-        else:
-            # time.sleep() can have 500 us resolution using the tweak tool provided.
-            t_wait = t_start + idx_chunk * t_chunk - time.time()
-            if t_wait > 0.001:
-                time.sleep(t_wait)
-        outlet.push_chunk(data)
-        if verbose == 'timestamp':
-            print('[%8.3fs] sent %d samples' % (time.perf_counter(), len(data)))
-        elif verbose == 'events' and event_ch is not None:
-            event_values = set(chunk[event_ch]) - set([0])
-            if len(event_values) > 0:
-                if trigger_file is None:
-                    print('Events: %s' % event_values)
-                else:
-                    print('Events:', end=' ')
-                    for event in event_values:
-                        print('%s' % tdef.by_value[event], end=' ')
-                    print()
-        idx_chunk += 1
-
-        if finished:
-            if auto_restart is False:
+    player.start()
+    try:
+        while True:
+            if player.wait(1.0):
                 input('Reached the end of data. Press Enter to restart or Ctrl+C to stop.')
-            else:
-                print('Reached the end of data. Restarting.')
-            idx_chunk = 0
-            finished = False
-            if high_resolution:
-                t_start = time.perf_counter()
-            else:
-                t_start = time.time()
+                player.start()
+    except KeyboardInterrupt:
+        player.stop()
+        player.print_timing_stats()
 
 # sample code
 if __name__ == '__main__':
@@ -0,0 +1,203 @@
+from __future__ import print_function, division
+
+"""
+Synthetic amplifier server
+
+Streams synthetic motor imagery-like signals on LSL network for load testing
+StreamReceiver, decoders and the viewer at rates beyond those of recorded
+files (up to hundreds of channels and tens of kHz).
+
+Signals are generated in the same way as utils/synthetic_eeg.py: 1/f noise
+plus an ongoing rhythm whose power is attenuated over class-specific channel
+groups during imagery periods. Trials (rest followed by imagery of a random
+class) are repeated and their onsets are written to the trigger channel 0.
+To keep up with high rates, a bank of bank_sec seconds of noise and rhythm
+is generated once and cycled. Optionally, dropouts of the amplifier are
+simulated by not sending data for dropout_sec seconds at random times.
+
+Timing, seeking, speed control and timing statistics are inherited from
+StreamPlayer.
+
+"""
+
+import numpy as np
+import pycnbi.utils.cnbi_lsl as cnbi_lsl
+from pycnbi.stream_player.stream_player import StreamPlayer
+from pycnbi.utils.synthetic_eeg import pink_noise
+from scipy.signal import butter, lfilter
+
+
+class SyntheticPlayer(StreamPlayer):
+    """
+    Stream synthetic signals in a background thread
+
+    Usage:
+        player = SyntheticPlayer('StreamPlayerSynthetic', n_channels=256, sfreq=10000, chunk_size=64)
+        player.start()
+        ...
+        player.stop()
+        print(player.get_timing_stats(), player.n_dropped)
+
+    """
+
+    def __init__(self, server_name='StreamPlayerSynthetic', n_channels=64, sfreq=512, chunk_size=16,
+                 labels=None, rest_sec=3.0, mi_sec=5.0, band=(8.0, 13.0), erd=0.5, amplitude=10.0,
+                 duration=3600.0, bank_sec=1.0, dropout_rate=0.0, dropout_sec=0.1, seed=0, **kwargs):
+        """
+        Params
+        ======
+        server_name: LSL server name. Names containing StreamPlayer are recognized by StreamReceiver.
+        n_channels: number of EEG channels excluding the trigger channel (up to 512)
+        sfreq: sampling rate (up to 20 kHz)
+        chunk_size: number of samples to send at once
+        labels: list of trigger values for each class. Default: LEFT_GO and RIGHT_GO of triggerdef_16.ini
+        rest_sec: length of rest period before each imagery period
+        mi_sec: length of imagery period
+        band: frequency band of the modulated rhythm
+        erd: relative band power attenuation during imagery of a class (0-1)
+        amplitude: signal amplitude in microvolts
+        duration: length of the trial schedule in seconds. It is repeated with loop=True.
+        bank_sec: length of the generated signal bank cycled during streaming
+        dropout_rate: average number of dropouts per second
+        dropout_sec: length of each dropout
+        seed: random seed
+        kwargs: parameters passed to StreamPlayer (speed, loop, high_resolution, verbose, spin_sec, ...)
+        """
+        if not 0 < n_channels <= 512:
+            raise ValueError('Number of channels must be between 1 and 512.')
+        if not 0 < sfreq <= 20000:
+            raise ValueError('Sampling rate must be between 0 and 20000 Hz.')
+        if not 0 <= erd < 1:
+            raise ValueError('erd must be in [0, 1).')
+        if labels is None:
+            from pycnbi.triggers.trigger_def import trigger_def
+            tdef = trigger_def('triggerdef_16.ini')
+            labels = [tdef.LEFT_GO, tdef.RIGHT_GO]
+        self.n_eeg = n_channels
+        self.sfreq = float(sfreq)
+        self.labels = list(labels)
+        self.rest_sec = rest_sec
+        self.mi_sec = mi_sec
+        self.band = band
+        self.erd = erd
+        self.amplitude = amplitude
+        self.duration = duration
+        self.bank_sec = bank_sec
+        self.dropout_rate = dropout_rate
+        self.dropout_len = int(round(dropout_sec * sfreq))
+        self.rng = np.random.RandomState(seed)
+        self.dropout_until = 0
+        self.n_dropouts = 0
+        self.n_dropped = 0  # number of samples not sent due to dropouts
+        super(SyntheticPlayer, self).__init__(server_name, None, chunk_size=chunk_size, **kwargs)
+
+    def load(self):
+        """
+        Generate the signal bank and the trial schedule
+        """
+        sfreq = self.sfreq
+        self.ch_names = ['TRIGGER'] + ['CH%d' % (x + 1) for x in range(self.n_eeg)]
+        self.n_channels = len(self.ch_names)
+        self.event_ch = 0
+        self.n_samples = int(round(self.duration * sfreq))
+
+        # signal bank: samples x channels, scaled to the output amplitude
+        self.bank_len = max(self.chunk_size, int(round(self.bank_sec * sfreq)))
+        b, a = butter(4, [self.band[0] / (sfreq / 2.0), self.band[1] / (sfreq / 2.0)], btype='band')
+        rhythm = lfilter(b, a, self.rng.randn(self.n_eeg, self.bank_len), axis=1)
+        rhythm /= rhythm.std(axis=1, keepdims=True)
+        self.rhythm = np.ascontiguousarray(rhythm.T * (2.0 * self.amplitude), dtype=np.float32)
+        del rhythm
+        self.noise = np.ascontiguousarray(pink_noise(self.n_eeg, self.bank_len, self.rng).T * self.amplitude,
+                                          dtype=np.float32)
+
+        # rhythm gain of each class: attenuated over the class channel group
+        self.gains = []
+        for chs in np.array_split(np.arange(self.n_eeg), len(self.labels)):
+            gain = np.ones(self.n_eeg, dtype=np.float32)
+            gain[chs] = np.sqrt(1.0 - self.erd)
+            self.gains.append(gain)
+
+        # trial schedule
+        rest_len = int(round(self.rest_sec * sfreq))
+        self.mi_len = int(round(self.mi_sec * sfreq))
+        n_trials = max(0, (self.n_samples - rest_len) // (rest_len + self.mi_len))
+        self.ev_index = rest_len + np.arange(n_trials) * (rest_len + self.mi_len)
+        self.ev_value = np.array(self.labels)[self.rng.randint(len(self.labels), size=n_trials)]
+        self.ev_class = np.array([self.labels.index(v) for v in self.ev_value], dtype=int)
+
+    def print_info(self):
+        print('Server name: %s' % self.server_name)
+        print('Sampling frequency %.1f Hz' % self.sfreq)
+        print('Number of channels : %d + trigger' % self.n_eeg)
+        print('Chunk size : %d' % self.chunk_size)
+        print('Classes : %s' % self.labels)
+        print('Throughput : %.1f samples/s, %.1f MB/s' % (self.sfreq * self.speed,
+            self.sfreq * self.speed * self.n_channels * 4 / 1048576.0))
+        if self.dropout_rate > 0:
+            print('Dropouts : %.2f/s, %d samples each' % (self.dropout_rate, self.dropout_len))
+
+    def create_outlet(self):
+        return cnbi_lsl.start_server(self.server_name, n_channels=self.n_channels, channel_format='float32',
+                                     nominal_srate=self.sfreq, stype='EEG', ch_names=self.ch_names,
+                                     chunk_size=self.chunk_size)
+
+    def get_chunk(self, idx_from, idx_to):
+        n = idx_to - idx_from
+        if self.dropout_rate > 0:
+            if idx_from < self.dropout_until:
+                self.n_dropped += n
+                return self.noise[:0]
+            if self.rng.rand() < self.dropout_rate * n / self.sfreq:
+                self.dropout_until = idx_from + self.dropout_len
+                self.n_dropouts += 1
+                self.n_dropped += n
+                return self.noise[:0]
+
+        rows = np.arange(idx_from, idx_to) % self.bank_len
+        chunk = np.zeros((n, self.n_channels), dtype=np.float32)
+        eeg = chunk[:, 1:]
+
+        # modulate the rhythm if an imagery period is in progress
+        ev_from, ev_to = np.searchsorted(self.ev_index, [idx_from, idx_to])
+        i = np.searchsorted(self.ev_index, idx_from, side='right') - 1
+        if i >= 0 and idx_from < self.ev_index[i] + self.mi_len:
+            np.multiply(self.rhythm[rows], self.gains[self.ev_class[i]], out=eeg)
+        else:
+            eeg[:] = self.rhythm[rows]
+        eeg += self.noise[rows]
+
+        # triggers
+        chunk[self.ev_index[ev_from:ev_to] - idx_from, 0] = self.ev_value[ev_from:ev_to]
+        return chunk
+
+
+def synthetic_player(server_name='StreamPlayerSynthetic', **kwargs):
+    """
+    Stream synthetic signals until Ctrl+C is pressed. See SyntheticPlayer for the parameters.
+    """
+    player = SyntheticPlayer(server_name, **kwargs)
+    player.start()
+    try:
+        while True:
+            player.wait(1.0)
+    except KeyboardInterrupt:
+        player.stop()
+        player.print_timing_stats()
+        if player.dropout_rate > 0:
+            player.print('%d dropouts, %d samples dropped' % (player.n_dropouts, player.n_dropped))
+
+
+# sample code
+if __name__ == '__main__':
+    import sys
+    n_channels = 64
+    sfreq = 512
+    chunk_size = 16
+    if len(sys.argv) > 1:
+        n_channels = int(sys.argv[1])
+    if len(sys.argv) > 2:
+        sfreq = float(sys.argv[2])
+    if len(sys.argv) > 3:
+        chunk_size = int(sys.argv[3])
+    synthetic_player(n_channels=n_channels, sfreq=sfreq, chunk_size=chunk_size)
@@ -21,8 +21,9 @@ Note:
   it's not needed but when you use software trigger, you will need this offset to
   synchronize the event timings.
 
-TODO:
-   Restrict buffer size.
+- Throughput counters (samples, chunks, processing time and timestamp gaps) are
+  updated by acquire() and can be read with get_stats(). Gaps are estimated from
+  timestamps, assuming that the server streams in real time.
 
 Kyuhwa Lee, 2017
 Swiss Federal Institute of Technology Lausanne (EPFL)
@@ -82,6 +83,7 @@ class StreamReceiver:
         self.timestamps = []
         self.watchdog = qc.Timer()
         self.multiplier = 1  # 10**6 for uV unit (automatically updated for openvibe servers)
+        self.reset_stats()
 
         self.connect()
 
@@ -223,6 +225,9 @@ class StreamReceiver:
 
         self.winsize = int(round(self.winsec * sample_rate))
         self.bufsize = int(round(self.bufsec * sample_rate))
+        if 0 < self.bufsize < self.winsize:
+            self.print('Buffer size is smaller than the window size. Setting to %.1f sec.' % self.winsec, 'Y')
+            self.bufsize = self.winsize
         self.sample_rate = sample_rate
         self.connected = True
         self.inlets = inlets  # NOTE: not picklable!
@@ -281,6 +286,7 @@ class StreamReceiver:
         else:
             self.print('Warning: Timeout occurred while acquiring data. Amp driver bug ?')
             return np.zeros((0, len(self.ch_list))), []
+        t_start = time.time()
         data = np.array(chunk)
 
         # BioSemi has pull-up resistor instead of pull-down
@@ -306,9 +312,10 @@ class StreamReceiver:
         chunk = data.tolist()
         self.buffers[0].extend(chunk)
         self.timestamps[0].extend(tslist)
-        if self.bufsize > 0 and len(self.timestamps) > self.bufsize:
-            self.buffers[0] = self.buffers[0][-self.bufsize:]
-            self.timestamps[0] = self.timestamps[0][-self.bufsize:]
+        if self.bufsize > 0 and len(self.timestamps[0]) > self.bufsize:
+            # trim in place to keep memory usage constant
+            del self.buffers[0][:-self.bufsize]
+            del self.timestamps[0][:-self.bufsize]
 
         if DEBUG_TIME_OFFSET and timestamp_offset is True:
             timestamp_offset = False
@@ -321,6 +328,16 @@ class StreamReceiver:
             else:
                 qc.print_c('(Synchronized)', 'g')
 
+        # throughput counters
+        if self.ts_last is not None:
+            gap = int(round((tslist[0] - self.ts_last) * self.sample_rate)) - 1
+            if gap > 0:
+                self.n_gaps += 1
+                self.n_lost += gap
+        self.ts_last = tslist[-1]
+        self.n_samples += len(tslist)
+        self.n_chunks += 1
+
         # if we have multiple synchronized amps
         if len(self.inlets) > 1:
             for i in range(1, len(self.inlets)):
@@ -328,11 +345,47 @@ class StreamReceiver:
                 self.buffers[i].extend(chunk)
                 self.timestamps[i].extend(tslist)
                 if self.bufsize > 0 and len(self.buffers[i]) > self.bufsize:
-                    self.buffers[i] = self.buffers[i][-self.bufsize:]
+                    del self.buffers[i][:-self.bufsize]
+                    del self.timestamps[i][:-self.bufsize]
+
+        self.acquire_sec += time.time() - t_start
 
         # data= array[samples, channels], tslist=[samples]
         return (data, tslist)
 
+    def reset_stats(self):
+        """
+        Reset throughput counters
+        """
+        self.stats_timer = qc.Timer()
+        self.n_samples = 0
+        self.n_chunks = 0
+        self.n_gaps = 0
+        self.n_lost = 0
+        self.acquire_sec = 0.0
+        self.ts_last = None
+
+    def get_stats(self):
+        """
+        Throughput since the last reset_stats()
+
+        Returns:
+            dict with the following keys:
+            sec: elapsed time
+            n_samples, n_chunks: number of samples and chunks received
+            samples_per_sec, chunks_per_sec, mb_per_sec: receiving rates
+            acquire_ms: average processing time of a chunk in acquire() excluding the waiting time
+            n_gaps: number of discontinuities found in timestamps
+            n_lost: estimated number of samples lost in the gaps
+        """
+        sec = self.stats_timer.sec()
+        n_channels = len(self.ch_list) if self.connected else 0
+        return dict(sec=sec, n_samples=self.n_samples, n_chunks=self.n_chunks,
+                    samples_per_sec=self.n_samples / sec, chunks_per_sec=self.n_chunks / sec,
+                    mb_per_sec=self.n_samples * n_channels * 8 / sec / 1048576.0,
+                    acquire_ms=1000.0 * self.acquire_sec / max(1, self.n_chunks),
+                    n_gaps=self.n_gaps, n_lost=self.n_lost)
+
     def check_connect(self):
         """
         Check connection and automatically connect if not connected
@@ -0,0 +1,474 @@
+from __future__ import print_function, division
+
+"""
+multi_recorder.py
+
+Record multiple LSL streams (EEG amps, marker streams, decoder outputs, ...)
+into a single HDF5 container file.
+
+Each stream is received by its own thread and written as a separate group:
+  /streams/NAME/data: samples x channels (numeric or string)
+  /streams/NAME/timestamps: LSL timestamps of samples
+  /streams/NAME/clock_offsets: [LSL local time, time correction] pairs
+  attributes: name, type, source_id, hostname, sample_rate, channel_format, ch_names
+
+Datasets are chunked and extended as data arrive, so the memory usage does not
+grow with the recording length or the number of streams. As in XDF, timestamps
+are stored as received and clock offsets are recorded periodically, so that
+streams from different machines can be synchronized offline.
+
+Marker streams recorded together with an EEG stream replace separately logged
+software trigger files (-eve.txt). Use h5_to_raw() or h5_to_fif() to create a
+raw object whose trigger channel contains the recorded markers.
+
+Requires h5py.
+
+Command-line arguments:
+  Names of LSL streams to record. If no argument is supplied, you will be
+  prompted to select from a list of available LSL streams.
+
+Example:
+  python multi_recorder.py openvibeSignals StreamPlayerMarkers
+
+"""
+
+import os
+import sys
+import time
+import json
+import threading
+import pylsl
+import numpy as np
+import multiprocessing as mp
+import pycnbi.utils.q_common as qc
+import pycnbi.utils.pycnbi_utils as pu
+from builtins import input
+
+# interval for synchronizing the file to the disk and measuring clock offsets
+FLUSH_SEC = 1.0
+CLOCK_OFFSET_SEC = 5.0
+
+# channel formats of streams regarded as marker streams by default
+MARKER_FORMATS = [pylsl.cf_string, pylsl.cf_int8, pylsl.cf_int16, pylsl.cf_int32, pylsl.cf_int64]
+
+
+def lsl_ch_names(inlet):
+    """
+    Channel names of a stream, or default names if the stream has no channel description
+    """
+    try:
+        ch_names = pu.lsl_channel_list(inlet)
+    except AttributeError:
+        ch_names = []
+    n_channels = inlet.info().channel_count()
+    if len(ch_names) != n_channels:
+        ch_names = ['CH%d' % (x + 1) for x in range(n_channels)]
+    return ch_names
+
+
+class StreamThread(threading.Thread):
+    """
+    Receive a single LSL stream and append its chunks to an HDF5 group
+
+    """
+
+    def __init__(self, info, h5file, key, lock, running, chunk_rows=1024):
+        """
+        Params
+        ------
+        info: pylsl.StreamInfo object
+        h5file: h5py.File object
+        key: group name of the stream
+        lock: lock shared by all stream threads to access the file
+        running: threading.Event which is cleared to stop
+        chunk_rows: number of samples of an HDF5 chunk
+        """
+        super(StreamThread, self).__init__()
+        self.daemon = True
+        self.info = info
+        self.h5file = h5file
+        self.key = key
+        self.lock = lock
+        self.running = running
+        self.chunk_rows = chunk_rows
+        self.n_samples = 0
+        self.error = None
+
+    def create_group(self, inlet):
+        import h5py
+        info = inlet.info()
+        n_channels = info.channel_count()
+        channel_format = info.channel_format()
+        if channel_format == pylsl.cf_string:
+            dtype = h5py.special_dtype(vlen=str)
+        elif channel_format == pylsl.cf_float32:
+            dtype = np.float32
+        else:
+            dtype = np.float64
+        self.is_string = channel_format == pylsl.cf_string
+        with self.lock:
+            group = self.h5file.create_group('streams/%s' % self.key)
+            group.attrs['name'] = info.name()
+            group.attrs['type'] = info.type()
+            group.attrs['source_id'] = info.source_id()
+            group.attrs['hostname'] = info.hostname()
+            group.attrs['sample_rate'] = info.nominal_srate()
+            group.attrs['channel_format'] = channel_format
+            group.attrs['ch_names'] = json.dumps(lsl_ch_names(inlet))
+            rows = self.chunk_rows if info.nominal_srate() > 0 else 64
+            self.ds_data = group.create_dataset('data', (0, n_channels), maxshape=(None, n_channels),
+                                                dtype=dtype, chunks=(rows, n_channels))
+            self.ds_ts = group.create_dataset('timestamps', (0,), maxshape=(None,), dtype=np.float64,
+                                              chunks=(rows,))
+            self.ds_offset = group.create_dataset('clock_offsets', (0, 2), maxshape=(None, 2),
+                                                  dtype=np.float64, chunks=(64, 2))
+
+    def append(self, ds, values):
+        n = ds.shape[0]
+        ds.resize(n + len(values), axis=0)
+        ds[n:] = values
+
+    def run(self):
+        try:
+            inlet = pylsl.StreamInlet(self.info)
+            self.create_group(inlet)
+            t_offset = 0
+            while self.running.is_set():
+                if pylsl.local_clock() >= t_offset:
+                    try:
+                        offset = inlet.time_correction(timeout=1.0)
+                        with self.lock:
+                            self.append(self.ds_offset, [[pylsl.local_clock(), offset]])
+                    except pylsl.TimeoutError:
+                        pass
+                    t_offset = pylsl.local_clock() + CLOCK_OFFSET_SEC
+                # blocks up to timeout seconds, so idle streams do not use CPU
+                chunk, tslist = inlet.pull_chunk(timeout=0.1)
+                if len(tslist) == 0:
+                    continue
+                if self.is_string:
+                    data = np.array(chunk, dtype=object)
+                else:
+                    data = np.array(chunk, dtype=self.ds_data.dtype)
+                with self.lock:
+                    self.append(self.ds_data, data)
+                    self.append(self.ds_ts, tslist)
+                self.n_samples += len(tslist)
+        except Exception as e:
+            self.error = e
+            qc.print_c('[StreamThread] Error while recording %s: %s' % (self.key, e), 'R')
+
+
+class MultiStreamRecorder(object):
+    """
+    Record multiple LSL streams into a single HDF5 file
+
+    Usage:
+        recorder = MultiStreamRecorder('record.h5', ['openvibeSignals', 'StreamPlayerMarkers'])
+        recorder.start()
+        ...
+        recorder.stop()
+
+    """
+
+    def __init__(self, filename, stream_names=None, timeout=5.0):
+        """
+        Params
+        ------
+        filename: output HDF5 file name
+        stream_names: names of streams to record. None: all available streams.
+        timeout: seconds to wait for the streams to appear on the network
+        """
+        try:
+            import h5py
+        except ImportError:
+            raise ImportError('MultiStreamRecorder requires h5py. Install it with "pip install h5py".')
+        self.filename = filename
+        self.stream_names = stream_names
+        self.timeout = timeout
+        self.threads = []
+        self.lock = threading.Lock()
+        self.running = threading.Event()
+        self.h5file = None
+
+    def print(self, msg, color='W'):
+        qc.print_c('[MultiStreamRecorder] %s' % msg, color)
+
+    def resolve(self):
+        """
+        Find the streams to record
+        """
+        timer = qc.Timer()
+        while True:
+            infos = pylsl.resolve_streams()
+            if self.stream_names is None:
+                if len(infos) > 0:
+                    return infos
+            else:
+                found = [si for si in infos if si.name() in self.stream_names]
+                if len(set([si.name() for si in found])) == len(set(self.stream_names)):
+                    return found
+            if timer.sec() > self.timeout:
+                names = [si.name() for si in infos]
+                raise RuntimeError('Streams %s not found. Available streams: %s' % (self.stream_names, names))
+            time.sleep(0.5)
+
+    def start(self):
+        import h5py
+        infos = self.resolve()
+        qc.make_dirs(os.path.dirname(os.path.abspath(self.filename)))
+        self.h5file = h5py.File(self.filename, 'w')
+        self.h5file.attrs['start_time'] = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime())
+        self.running.set()
+        keys = []
+        for si in infos:
+            # keep stream names unique
+            key = si.name().replace('/', '_')
+            if key in keys:
+                key = '%s-%d' % (key, keys.count(key) + 1)
+            keys.append(key)
+            self.print('Recording %s (type %s, %d channels, %.1f Hz) @ %s' %\
+                       (si.name(), si.type(), si.channel_count(), si.nominal_srate(), si.hostname()))
+            thread = StreamThread(si, self.h5file, key, self.lock, self.running)
+            thread.start()
+            self.threads.append(thread)
+        self.flush_timer = qc.Timer()
+
+    def flush(self):
+        """
+        Synchronize the file to the disk
+        """
+        with self.lock:
+            self.h5file.flush()
+        self.flush_timer.reset()
+
+    def get_status(self):
+        """
+        Number of samples received for each stream
+        """
+        return {t.key:t.n_samples for t in self.threads}
+
+    def update(self):
+        """
+        Call periodically from the main loop to flush data to disk
+        """
+        if self.flush_timer.sec() >= FLUSH_SEC:
+            self.flush()
+        for t in self.threads:
+            if t.error is not None:
+                raise RuntimeError('Stream %s stopped: %s' % (t.key, t.error))
+
+    def stop(self):
+        self.running.clear()
+        for t in self.threads:
+            t.join()
+        with self.lock:
+            self.h5file.attrs['end_time'] = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime())
+            self.h5file.close()
+        self.print('Saved to %s' % self.filename)
+
+
+def load_h5(filename):
+    """
+    Load a recording of MultiStreamRecorder
+
+    Returns
+    -------
+    {stream_name: dict(data, timestamps, clock_offsets, sample_rate, type, channel_format, ch_names)}
+    """
+    import h5py
+    streams = {}
+    with h5py.File(filename, 'r') as f:
+        for key in f['streams']:
+            g = f['streams'][key]
+            streams[key] = dict(data=g['data'][()], timestamps=g['timestamps'][()],
+                                clock_offsets=g['clock_offsets'][()], sample_rate=float(g.attrs['sample_rate']),
+                                type=g.attrs['type'], channel_format=int(g.attrs['channel_format']),
+                                ch_names=json.loads(g.attrs['ch_names']))
+    return streams
+
+
+def is_marker_stream(stream):
+    """
+    True if a stream loaded by load_h5() is a marker stream, i.e. its type is Markers or
+    it has string or integer values at irregular rate. Decoder outputs (float values) are excluded.
+    """
+    if stream['type'] == 'Markers':
+        return True
+    return stream['sample_rate'] == 0 and stream['channel_format'] in MARKER_FORMATS
+
+
+def marker_to_int(value, marker_map=None):
+    """
+    Convert a marker value into an integer trigger value
+
+    Strings are looked up in marker_map first, then parsed as integers.
+    Returns None if the value is not an integer and not in marker_map.
+    """
+    if isinstance(value, bytes):
+        value = value.decode('utf-8')
+    if marker_map is not None and value in marker_map:
+        return int(marker_map[value])
+    try:
+        value = float(value)
+    except (TypeError, ValueError):
+        return None
+    if value != int(value):
+        return None
+    return int(value)
+
+
+def nearest_index(ts, values):
+    """
+    Indices of the elements of the sorted array ts nearest to each of values
+    """
+    if len(ts) == 1:
+        return np.zeros(len(values), dtype=int)
+    index = np.clip(np.searchsorted(ts, values), 1, len(ts) - 1)
+    prev_nearer = (values - ts[index - 1]) <= (ts[index] - values)
+    return index - prev_nearer.astype(int)
+
+
+def h5_to_raw(filename, eeg_stream=None, marker_streams=None, marker_map=None):
+    """
+    Create an mne.io.RawArray object from a recording of MultiStreamRecorder
+
+    Markers are placed in the trigger channel (index 0) at the sample nearest to
+    their timestamps after correcting the clock offset of each stream.
+
+    Params
+    ------
+    filename: HDF5 file
+    eeg_stream: name of the signal stream. None: the stream with the highest sampling rate.
+    marker_streams: list of marker stream names. None: streams of Markers type and irregular-rate
+                    streams of string or integer values (see is_marker_stream()).
+    marker_map: {label:trigger value} for string markers which are not integers, e.g. {'left':3}.
+                Markers that are neither integers nor in marker_map are skipped with a warning.
+
+    Returns
+    -------
+    raw: mne.io.RawArray object. First channel (index 0) is always trigger channel.
+    events: mne-compatible events array
+    """
+    import mne
+    from pycnbi.stream_receiver.stream_receiver import find_trigger_channel
+    streams = load_h5(filename)
+    if eeg_stream is None:
+        eeg_stream = max(streams, key=lambda k: streams[k]['sample_rate'])
+    if marker_streams is None:
+        marker_streams = [k for k in streams if k != eeg_stream and is_marker_stream(streams[k])]
+    eeg = streams[eeg_stream]
+    if len(eeg['timestamps']) == 0:
+        raise RuntimeError('Stream %s has no data.' % eeg_stream)
+
+    def clock_offset(stream):
+        offsets = stream['clock_offsets']
+        return np.median(offsets[:, 1]) if len(offsets) > 0 else 0.0
+
+    # move the trigger channel to index 0
+    signals = eeg['data'].T.astype(np.float64)
+    ch_names = list(eeg['ch_names'])
+    tch = find_trigger_channel(ch_names)
+    if tch is None:
+        signals = np.concatenate((np.zeros((1, signals.shape[1])), signals), axis=0)
+        ch_names = ['TRIGGER'] + ch_names
+    elif tch != 0:
+        signals = np.concatenate((signals[[tch]], np.delete(signals, tch, axis=0)), axis=0)
+        ch_names = ['TRIGGER'] + ch_names[:tch] + ch_names[tch + 1:]
+    else:
+        ch_names[0] = 'TRIGGER'
+
+    # add markers to the trigger channel
+    eeg_ts = eeg['timestamps'] + clock_offset(eeg)
+    for key in marker_streams:
+        m = streams[key]
+        if len(m['timestamps']) == 0:
+            continue
+        m_ts = m['timestamps'] + clock_offset(m)
+        valid = (m_ts >= eeg_ts[0]) & (m_ts <= eeg_ts[-1])
+        if not valid.all():
+            qc.print_c('h5_to_raw(): Dropped %d markers of %s outside the signal range.' % (np.sum(~valid), key), 'Y')
+        index = nearest_index(eeg_ts, m_ts)
+        skipped = set()
+        for i, value in zip(index[valid], m['data'][valid, 0]):
+            trigger = marker_to_int(value, marker_map)
+            if trigger is None:
+                skipped.add(value)
+                continue
+            signals[0, i] = trigger
+        if len(skipped) > 0:
+            qc.print_c('h5_to_raw(): Skipped markers of %s which are not integers nor in marker_map: %s' %\
+                       (key, sorted(skipped, key=str)), 'Y')
+
+    ch_types = ['stim'] + ['eeg'] * (len(ch_names) - 1)
+    info = mne.create_info(ch_names, eeg['sample_rate'], ch_types)
+    raw = mne.io.RawArray(signals, info)
+    events = mne.find_events(raw, stim_channel='TRIGGER', shortest_event=1, uint_cast=True, consecutive=True)
+    return raw, events
+
+
+def h5_to_fif(filename, outfile=None, eeg_stream=None, marker_streams=None, marker_map=None):
+    """
+    Convert a recording of MultiStreamRecorder into a fif file. See h5_to_raw().
+    """
+    raw, events = h5_to_raw(filename, eeg_stream, marker_streams, marker_map)
+    if outfile is None:
+        outfile = os.path.splitext(filename)[0] + '.fif'
+    raw.save(outfile, overwrite=True, fmt='single')
+    print('Saved to %s (%d events)' % (outfile, len(events)))
+    return outfile
+
+
+def record(state, record_dir, stream_names):
+    filename = time.strftime(record_dir + "/%Y%m%d-%H%M%S-raw.h5", time.localtime())
+    qc.print_c('>> Output file: %s' % (filename), 'W')
+    recorder = MultiStreamRecorder(filename, stream_names)
+    recorder.start()
+    qc.print_c('\n>> Recording started (PID %d).' % os.getpid(), 'W')
+    qc.print_c('\n>> Press Enter to stop recording', 'G')
+    tm = qc.Timer(autoreset=True)
+    status_timer = qc.Timer()
+    try:
+        while state.value == 1:
+            recorder.update()
+            if status_timer.sec() >= 1:
+                print('RECORDING %s' % ', '.join(['%s:%d' % (k, v) for k, v in sorted(recorder.get_status().items())]))
+                status_timer.reset()
+            tm.sleep_atleast(0.1)
+    finally:
+        recorder.stop()
+
+
+def main(record_dir):
+    if len(sys.argv) > 1:
+        stream_names = sys.argv[1:]
+    else:
+        infos = pylsl.resolve_streams()
+        for i, si in enumerate(infos):
+            qc.print_c('%d: %s (type %s) @ %s' % (i, si.name(), si.type(), si.hostname()), 'W')
+        index = input('Stream indices separated by space? Hit enter to record all streams.\n>> ')
+        if index.strip() == '':
+            stream_names = None
+        else:
+            stream_names = [infos[int(x)].name() for x in index.split()]
+    qc.print_c('\nOutput directory: %s' % (record_dir), 'W')
+
+    # spawn the recorder as a child process
+    qc.print_c('\n>> Press Enter to start recording.', 'G')
+    input()
+    state = mp.Value('i', 1)
+    proc = mp.Process(target=record, args=[state, record_dir, stream_names])
+    proc.start()
+    time.sleep(1)
+    input()
+    state.value = 0
+    qc.print_c('(main) Waiting for recorder process to finish.', 'W')
+    proc.join(10)
+    if proc.is_alive():
+        qc.print_c('>> ERROR: Recorder process not finishing.', 'R')
+        proc.terminate()
+    print('>> Done.')
+
+
+if __name__ == '__main__':
+    main(os.getcwd() + '/records')
@@ -14,10 +14,14 @@ Command-line arguments:
 Example:
   python stream_recorder.py openvibeSignals
 
-TODO:
-- Support HDF output.
-- Write simulatenously while receivng data.
-- Support multiple amps.
+Signals are written to disk while receiving data using constant memory
+(see stream_writer.py). With output='fif', they are converted into fif format
+when the recording stops. With output='brainvision', channel reordering and
+trigger markers are written during the recording and the BrainVision file
+(.vhdr) can be loaded by MNE or pycnbi_utils.load_raw() without conversion.
+
+To record multiple streams (amps, markers, decoder outputs) into a single
+HDF5 file, use multi_recorder.py.
 
 
 Kyuhwa Lee, 2014
@@ -49,17 +53,25 @@ import pycnbi.utils.pycnbi_utils as pu
 from pycnbi.utils.convert2fif import pcl2fif
 from pycnbi.utils.cnbi_lsl import start_server
 from pycnbi.stream_receiver.stream_receiver import StreamReceiver
+from pycnbi.stream_recorder.stream_writer import StreamWriter
 from builtins import input
 
-def record(state, amp_name, amp_serial, record_dir, eeg_only):
+def record(state, amp_name, amp_serial, record_dir, eeg_only, output='fif'):
     # set data file name
-    filename = time.strftime(record_dir + "/%Y%m%d-%H%M%S-raw.pcl", time.localtime())
+    if output == 'fif':
+        filename = time.strftime(record_dir + "/%Y%m%d-%H%M%S-raw.dat", time.localtime())
+        fmt = 'dat'
+    elif output == 'brainvision':
+        filename = time.strftime(record_dir + "/%Y%m%d-%H%M%S-raw.eeg", time.localtime())
+        fmt = 'brainvision'
+    else:
+        raise ValueError('Unknown output format %s' % output)
     qc.print_c('>> Output file: %s' % (filename), 'W')
 
     # test writability
     try:
         qc.make_dirs(record_dir)
-        open(filename, 'w').write('The data will written when the recording is finished.')
+        open(filename, 'w').close()
     except:
         raise RuntimeError('Problem writing to %s. Check permission.' % filename)
 
@@ -68,39 +80,50 @@ def record(state, amp_name, amp_serial, record_dir, eeg_only):
         source_id=filename, stype='Markers')
 
     # connect to EEG stream server
-    sr = StreamReceiver(amp_name=amp_name, amp_serial=amp_serial, eeg_only=eeg_only)
+    # data are written to disk while receiving, so only a bounded buffer is kept in memory.
+    # it must hold all the samples received while connecting (window_size plus the last chunk),
+    # which are written from the buffer once. Afterwards the chunks returned by acquire() are written.
+    sr = StreamReceiver(window_size=1, buffer_size=10, amp_name=amp_name, amp_serial=amp_serial, eeg_only=eeg_only)
+
+    # channels = total channels from amp, including trigger channel
+    writer = StreamWriter(filename, sr.get_sample_rate(), sr.get_channel_names(), fmt=fmt)
+
+    # samples received while connecting
+    buffers, times = sr.get_buffer()
+    if sr.n_samples > len(times):
+        qc.print_c('Warning: %d samples received while connecting were trimmed from the buffer.' %
+                   (sr.n_samples - len(times)), 'Y')
+    writer.write(buffers, times.reshape(-1))
 
     # start recording
     qc.print_c('\n>> Recording started (PID %d).' % os.getpid(), 'W')
     qc.print_c('\n>> Press Enter to stop recording', 'G')
     tm = qc.Timer(autoreset=True)
     next_sec = 1
-    while state.value == 1:
-        sr.acquire()
-        if sr.get_buflen() > next_sec:
-            duration = str(datetime.timedelta(seconds=int(sr.get_buflen())))
-            print('RECORDING %s' % duration)
-            next_sec += 1
-        tm.sleep_atleast(0.01)
-
-    # record stop
-    qc.print_c('>> Stop requested. Copying buffer', 'G')
-    buffers, times = sr.get_buffer()
-    signals = buffers
-    events = None
-
-    # channels = total channels from amp, including trigger channel
-    data = {'signals':signals, 'timestamps':times, 'events':events,
-            'sample_rate':sr.get_sample_rate(), 'channels':sr.get_num_channels(),
-            'ch_names':sr.get_channel_names()}
-    qc.print_c('Saving raw data ...', 'W')
-    qc.save_obj(filename, data)
-    print('Saved to %s\n' % filename)
-
-    qc.print_c('Converting raw file into a fif format.', 'W')
-    pcl2fif(filename)
+    try:
+        while state.value == 1:
+            data, tslist = sr.acquire()
+            writer.write(data, tslist)
+            if writer.get_duration() > next_sec:
+                duration = str(datetime.timedelta(seconds=int(writer.get_duration())))
+                print('RECORDING %s' % duration)
+                next_sec += 1
+            tm.sleep_atleast(0.01)
+    finally:
+        # record stop
+        writer.close()
+    qc.print_c('>> Stop requested. %d samples saved to %s\n' % (writer.n_samples, filename), 'G')
+
+    if output == 'fif':
+        qc.print_c('Converting raw file into a fif format.', 'W')
+        pcl2fif(filename)
+    else:
+        print('BrainVision header: %s.vhdr' % filename[:-4])
 
-def main(record_dir, eeg_only=False):
+def main(record_dir, eeg_only=False, output='fif'):
+    """
+    output: 'fif' | 'brainvision'. See the module docstring.
+    """
     # configure LSL server name and device serial if available
     if len(sys.argv) == 2:
         amp_name = sys.argv[1]
@@ -117,7 +140,7 @@ def main(record_dir, eeg_only=False):
     qc.print_c('\n>> Press Enter to start recording.', 'G')
     key = input()
     state = mp.Value('i', 1)
-    proc = mp.Process(target=record, args=[state, amp_name, amp_serial, record_dir, eeg_only])
+    proc = mp.Process(target=record, args=[state, amp_name, amp_serial, record_dir, eeg_only, output])
     proc.start()
 
     # clean up
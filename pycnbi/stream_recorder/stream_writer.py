@@ -0,0 +1,305 @@
+from __future__ import print_function, division
+
+"""
+stream_writer.py
+
+Write streamed signals to disk while recording.
+
+A recording consists of three files sharing the same base name:
+  BASE.dat: signals in binary format (samples x channels, row-major)
+  BASE.ts: LSL timestamps of samples in float64 binary format
+  BASE.hdr: header in JSON format (sampling rate, channel names, data type, ...)
+
+With fmt='brainvision', signals are written to BASE.eeg instead, together with
+BrainVision header (BASE.vhdr) and marker (BASE.vmrk) files, so that the
+recording can be read by MNE (mne.io.read_raw_brainvision() or
+pycnbi_utils.load_raw()) as soon as the recording stops. Trigger onsets in
+channel 0 are written to the marker file during the recording.
+
+Chunks are appended to the end of the files as they arrive and the files are
+synchronized to the disk periodically, so the memory usage is constant
+regardless of the recording length and at most fsync_sec seconds of data are
+lost if the recording process crashes. The number of samples is inferred from
+the file sizes when loading, thus a recording that was not closed properly
+can still be loaded.
+
+"""
+
+import os
+import json
+import time
+import numpy as np
+import pycnbi.utils.q_common as qc
+
+FORMAT_VERSION = 1
+
+
+class StreamWriter(object):
+    """
+    Append signal chunks and their timestamps to binary files
+
+    """
+
+    def __init__(self, filename, sample_rate, ch_names, dtype='float32', fsync_sec=1.0, fmt='dat'):
+        """
+        Params
+        ------
+        filename: signal file name (.dat or .eeg). Timestamp (.ts) and header (.hdr) files
+                  are created in the same directory.
+        sample_rate: sampling rate
+        ch_names: channel names. The first channel should be the trigger channel.
+        dtype: data type of the signal file. Must be float32 for BrainVision format.
+        fsync_sec: interval for synchronizing the files to the disk in seconds
+        fmt: 'dat' | 'brainvision'
+        """
+        if fmt not in ['dat', 'brainvision']:
+            raise ValueError('Unknown output format %s' % fmt)
+        self.filename = filename
+        self.basename = filename[:-4] if filename[-4:] in ['.dat', '.eeg'] else filename
+        self.fmt = fmt
+        self.sample_rate = sample_rate
+        self.ch_names = list(ch_names)
+        self.n_channels = len(self.ch_names)
+        self.dtype = np.dtype(dtype)
+        self.fsync_sec = fsync_sec
+        self.n_samples = 0
+        self.n_markers = 0
+        self.trigger_last = 0
+        if fmt == 'brainvision':
+            if self.dtype != np.float32:
+                raise ValueError('BrainVision output supports only float32 data type.')
+            self.data_file = self.basename + '.eeg'
+        else:
+            self.data_file = self.basename + '.dat'
+
+        qc.make_dirs(os.path.dirname(os.path.abspath(filename)))
+        self.header = dict(format_version=FORMAT_VERSION, sample_rate=sample_rate, ch_names=self.ch_names,
+                           n_channels=self.n_channels, dtype=self.dtype.str, n_samples=None,
+                           data_file=os.path.basename(self.data_file),
+                           start_time=time.strftime('%Y-%m-%d %H:%M:%S', time.localtime()), end_time=None)
+        self.write_header()
+        self.fsig = open(self.data_file, 'wb')
+        self.fts = open(self.basename + '.ts', 'wb')
+        self.fmrk = None
+        if fmt == 'brainvision':
+            self.write_vhdr()
+            self.fmrk = open(self.basename + '.vmrk', 'w')
+            self.fmrk.write('Brain Vision Data Exchange Marker File, Version 1.0\n\n')
+            self.fmrk.write('[Common Infos]\nCodepage=UTF-8\nDataFile=%s\n\n' % os.path.basename(self.data_file))
+            self.fmrk.write('[Marker Infos]\n')
+            self.write_marker('New Segment', '', 0)
+        self.fsync_timer = qc.Timer()
+
+    def write_header(self):
+        with open(self.basename + '.hdr', 'w') as f:
+            json.dump(self.header, f, indent=2)
+            f.flush()
+            os.fsync(f.fileno())
+
+    def write_vhdr(self):
+        """
+        Write BrainVision header. The number of samples is not needed as it is
+        inferred from the data file size by readers.
+        """
+        with open(self.basename + '.vhdr', 'w') as f:
+            f.write('Brain Vision Data Exchange Header File Version 1.0\n')
+            f.write('; Data written by PyCNBI stream_recorder\n\n')
+            f.write('[Common Infos]\n')
+            f.write('Codepage=UTF-8\n')
+            f.write('DataFile=%s\n' % os.path.basename(self.data_file))
+            f.write('MarkerFile=%s\n' % os.path.basename(self.basename + '.vmrk'))
+            f.write('DataFormat=BINARY\n')
+            f.write('DataOrientation=MULTIPLEXED\n')
+            f.write('NumberOfChannels=%d\n' % self.n_channels)
+            # sampling interval in microseconds
+            f.write('SamplingInterval=%s\n\n' % repr(1000000.0 / self.sample_rate))
+            f.write('[Binary Infos]\n')
+            f.write('BinaryFormat=IEEE_FLOAT_32\n\n')
+            f.write('[Channel Infos]\n')
+            # values are stored without scaling, as in fif files converted by pcl2fif()
+            for i, ch in enumerate(self.ch_names):
+                f.write('Ch%d=%s,,1,V\n' % (i + 1, ch.replace(',', '\\1')))
+            f.flush()
+            os.fsync(f.fileno())
+
+    def write_marker(self, mtype, desc, index):
+        """
+        Write a BrainVision marker at a 0-based sample index
+        """
+        self.n_markers += 1
+        self.fmrk.write('Mk%d=%s,%s,%d,1,0\n' % (self.n_markers, mtype, desc, index + 1))
+
+    def write_events(self, trigger):
+        """
+        Write the onsets of trigger value changes in a chunk to the marker file
+        """
+        trigger = np.concatenate(([self.trigger_last], trigger))
+        onsets = np.where((trigger[1:] != trigger[:-1]) & (trigger[1:] != 0))[0]
+        for i in onsets:
+            self.write_marker('Stimulus', 'S%3d' % int(trigger[i + 1]), self.n_samples + i)
+        self.trigger_last = trigger[-1]
+
+    def write(self, data, timestamps):
+        """
+        Append a chunk
+
+        Params
+        ------
+        data: samples x channels
+        timestamps: list or array of sample timestamps
+        """
+        if len(timestamps) == 0:
+            return
+        data = np.asarray(data, dtype=self.dtype)
+        if data.shape[1] != self.n_channels:
+            raise ValueError('Chunk has %d channels while the header has %d channels.' % (data.shape[1], self.n_channels))
+        if data.shape[0] != len(timestamps):
+            raise ValueError('Chunk has %d samples but %d timestamps.' % (data.shape[0], len(timestamps)))
+        self.fsig.write(np.ascontiguousarray(data).tobytes())
+        self.fts.write(np.asarray(timestamps, dtype=np.float64).tobytes())
+        if self.fmrk is not None:
+            self.write_events(data[:, 0])
+        self.n_samples += data.shape[0]
+        if self.fsync_timer.sec() >= self.fsync_sec:
+            self.sync()
+
+    def sync(self):
+        """
+        Flush the Python buffers and synchronize the files to the disk
+        """
+        for f in [self.fsig, self.fts, self.fmrk]:
+            if f is None:
+                continue
+            f.flush()
+            os.fsync(f.fileno())
+        self.fsync_timer.reset()
+
+    def get_duration(self):
+        """
+        Recorded length in seconds
+        """
+        return self.n_samples / self.sample_rate
+
+    def close(self):
+        self.sync()
+        self.fsig.close()
+        self.fts.close()
+        if self.fmrk is not None:
+            self.fmrk.close()
+        self.header['n_samples'] = self.n_samples
+        self.header['end_time'] = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime())
+        self.write_header()
+
+
+def load_stream(filename, mmap=True):
+    """
+    Load a recording written by StreamWriter
+
+    Params
+    ------
+    filename: signal file name (.dat or .eeg)
+    mmap: if True, signals are memory-mapped instead of being loaded into memory
+
+    Returns
+    -------
+    dict having the same keys as the pickle files of earlier versions of stream_recorder:
+    signals (samples x channels), timestamps (samples x 1), events, sample_rate, channels, ch_names
+    """
+    basename = filename[:-4] if filename[-4:] in ['.dat', '.eeg'] else filename
+    with open(basename + '.hdr') as f:
+        header = json.load(f)
+    dtype = np.dtype(str(header['dtype']))
+    n_channels = header['n_channels']
+    data_file = '%s/%s' % (os.path.dirname(os.path.abspath(basename)), header.get('data_file', os.path.basename(basename) + '.dat'))
+
+    # infer the number of samples from the file sizes in case the recording was interrupted
+    n_sig = os.path.getsize(data_file) // (dtype.itemsize * n_channels)
+    n_ts = os.path.getsize(basename + '.ts') // 8
+    n_samples = min(n_sig, n_ts)
+    if header['n_samples'] is None:
+        qc.print_c('load_stream(): %s was not closed properly. Recovered %d samples.' % (filename, n_samples), 'Y')
+    elif header['n_samples'] != n_samples:
+        qc.print_c('load_stream(): Header has %d samples but %d samples were found.' % (header['n_samples'], n_samples), 'Y')
+
+    if n_samples == 0:
+        signals = np.zeros((0, n_channels), dtype=dtype)
+    elif mmap:
+        signals = np.memmap(data_file, dtype=dtype, mode='r', shape=(n_samples, n_channels))
+    else:
+        signals = np.fromfile(data_file, dtype=dtype, count=n_samples * n_channels).reshape(n_samples, n_channels)
+    timestamps = np.fromfile(basename + '.ts', dtype=np.float64, count=n_samples).reshape(-1, 1)
+
+    return dict(signals=signals, timestamps=timestamps, events=None, sample_rate=header['sample_rate'],
+                channels=n_channels, ch_names=[str(c) for c in header['ch_names']])
+
+
+def load_record(filename):
+    """
+    Load a recording of stream_recorder in either stream (.dat, .eeg) or pickle (.pcl) format
+
+    Returns
+    -------
+    See load_stream()
+    """
+    if filename[-4:] in ['.dat', '.eeg']:
+        return load_stream(filename)
+    return qc.load_obj(filename)
+
+
+def check_brainvision(dirname, sample_rate=512, n_channels=8, n_samples=5000, chunk_size=32):
+    """
+    Round-trip check of BrainVision output
+
+    Synthetic signals with triggers in channel 0 are written chunk by chunk and read back
+    without preloading using pycnbi_utils.read_raw(), read_raw_into() and load_multi().
+
+    Params
+    ------
+    dirname: directory where the test recording is written
+    sample_rate, n_channels, n_samples, chunk_size: recording parameters
+
+    Raises RuntimeError if the signals, channels or events read differ from those written.
+    """
+    import pycnbi.utils.pycnbi_utils as pu
+    rng = np.random.RandomState(0)
+    ch_names = ['TRIGGER'] + ['CH%d' % (x + 1) for x in range(n_channels - 1)]
+    data = rng.randn(n_samples, n_channels).astype(np.float32)
+    data[:, 0] = 0
+    ev_index = np.arange(sample_rate // 2, n_samples, sample_rate)
+    ev_value = rng.randint(1, 256, size=len(ev_index))
+    data[ev_index, 0] = ev_value
+    timestamps = np.arange(n_samples) / float(sample_rate)
+
+    filename = '%s/brainvision-check.eeg' % dirname
+    writer = StreamWriter(filename, sample_rate, ch_names, fmt='brainvision')
+    for start in range(0, n_samples, chunk_size):
+        writer.write(data[start:start + chunk_size], timestamps[start:start + chunk_size])
+    writer.close()
+    vhdr = writer.basename + '.vhdr'
+
+    raw = pu.read_raw(vhdr, preload=False)
+    if raw.ch_names != ch_names:
+        raise RuntimeError('Channel names %s differ from %s.' % (raw.ch_names, ch_names))
+    if raw.n_times != n_samples:
+        raise RuntimeError('%d samples were read instead of %d.' % (raw.n_times, n_samples))
+    if pu.find_event_channel(raw) != 0:
+        raise RuntimeError('Trigger channel was not found in channel 0.')
+
+    signals = np.empty((n_channels, n_samples))
+    events = pu.read_raw_into(vhdr, signals)
+    if not np.allclose(signals, data.T):
+        raise RuntimeError('Signals read differ from those written.')
+    if not (np.array_equal(events[:, 0], ev_index) and np.array_equal(events[:, 2], ev_value)):
+        raise RuntimeError('Events read differ from those written.')
+
+    raw_merged, events_merged = pu.load_multi([vhdr, vhdr])
+    if raw_merged.n_times != 2 * n_samples or len(events_merged) != 2 * len(ev_index):
+        raise RuntimeError('load_multi() did not concatenate the recording correctly.')
+    print('BrainVision round-trip check passed: %d channels, %d samples, %d events.' %
+          (n_channels, n_samples, len(ev_index)))
+
+
+# sample code
+if __name__ == '__main__':
+    import tempfile
+    check_brainvision(tempfile.mkdtemp())
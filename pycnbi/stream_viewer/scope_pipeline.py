@@ -0,0 +1,448 @@
+from __future__ import print_function, division
+
+"""
+Scope pipeline
+
+Acquisition and filtering of the EEG scope running in a worker thread,
+independently of the GUI. Chunks received by StreamReceiver are band-pass
+filtered and re-referenced (CAR), then written to a lock-protected plotting
+ring buffer together with its min/max envelope, and trigger onsets are
+detected. The GUI (stream_viewer.Scope) only reads from the pipeline, so GUI
+stalls and slow repaints do not delay acquisition.
+
+The pipeline does not depend on Qt and can run headless for automated
+monitoring: see run_headless(), or use get_window(), pop_updates() and
+add_callback() directly.
+
+"""
+
+DEBUG_TRIGGER = False
+PLOT_BINS_MIN = 500  # minimum number of min/max bins per curve
+
+import sys
+import math
+import time
+import threading
+import traceback
+import numpy as np
+import pycnbi.utils.q_common as qc
+import pycnbi.utils.pycnbi_utils as pu
+from scipy.signal import butter, sosfilt, buttord
+from pycnbi.stream_receiver.stream_receiver import StreamReceiver
+
+
+class ScopePipeline(object):
+    """
+    Acquire, filter and buffer signals in a worker thread
+
+    All the buffers are protected by self.lock. Methods called by other threads
+    acquire the lock and return copies.
+
+    """
+
+    def __init__(self, sr, seconds=10, plot_width=PLOT_BINS_MIN):
+        """
+        Params
+        ======
+        sr: connected StreamReceiver object
+        seconds: length of the plotting window in seconds
+        plot_width: plot width in pixels, used to set the number of envelope bins
+        """
+        self.sr = sr
+        self.sfreq = int(sr.get_sample_rate())
+        self.eeg_channels = sr.get_eeg_channels()
+        self.tr_channel = sr.get_trigger_channel()
+        self.n_channels = len(self.eeg_channels)
+        self.lock = threading.Lock()
+
+        # filters
+        self.sos = None
+        self.zi = None
+        self.apply_car = False
+        self.car_channels = np.arange(self.n_channels)
+
+        # events and counters
+        self.last_tri = 0
+        self.n_received = 0  # total number of samples received
+        self.n_new = 0  # number of samples received since the last pop_updates()
+        self.events = []  # [sample index, value, timestamp] detected since the last pop_updates()
+        self.callbacks = []
+
+        self.plot_width = max(PLOT_BINS_MIN, int(plot_width))
+        self.init_plot_buffer(self.sfreq * seconds)
+
+        self.running = threading.Event()
+        self.thread = None
+
+    def print(self, *args):
+        qc.print_c('[ScopePipeline] ', color='w', end='')
+        print(*args)
+
+    #
+    #	Worker thread
+    #
+    def start(self):
+        if self.thread is not None and self.thread.is_alive():
+            return
+        self.running.set()
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.running.clear()
+        if self.thread is not None:
+            self.thread.join()
+
+    def run(self):
+        while self.running.is_set():
+            try:
+                data, ts_list = self.sr.acquire(blocking=False)
+                if len(ts_list) == 0:
+                    time.sleep(0.001)
+                    continue
+                self.process(data, ts_list)
+            except:
+                traceback.print_exc()
+                self.print('Error in the acquisition thread. Continuing.')
+                time.sleep(0.1)
+
+    def add_callback(self, func):
+        """
+        Register func(eeg, tri, timestamps), which is called from the worker thread with each
+        filtered chunk. eeg: samples x channels, tri: samples, timestamps: samples.
+        """
+        self.callbacks.append(func)
+
+    #
+    #	Filtering and buffering
+    #
+    def process(self, data, ts_list):
+        """
+        Filter a chunk and write it to the buffers
+        """
+        tri = data[:, self.tr_channel]
+        eeg = data[:, self.eeg_channels]
+        ts = np.array(ts_list)
+
+        # filter outside the lock using the current filter settings
+        with self.lock:
+            sos, zi = self.sos, self.zi
+            apply_car, car = self.apply_car, self.car_channels
+        if sos is not None:
+            # all channels at once, keeping the filter states between chunks
+            eeg, zi = sosfilt(sos, eeg, axis=0, zi=zi)
+        # We only apply CAR if there are at least 2 channels. Otherwise it makes no sense
+        if apply_car and len(car) > 1:
+            eeg[:, car] -= np.mean(eeg[:, car], axis=1, keepdims=True)
+
+        # trigger onsets
+        trigger = np.concatenate(([self.last_tri], tri))
+        onsets = np.where((trigger[1:] != trigger[:-1]) & (trigger[1:] != 0))[0]
+        self.last_tri = trigger[-1]
+
+        with self.lock:
+            if self.sos is sos:
+                self.zi = zi
+            self.write_plot_data(eeg, ts)
+            for i in onsets:
+                self.events.append([self.n_received + i, int(tri[i]), ts[i]])
+                if DEBUG_TRIGGER:
+                    self.print('Received trigger', int(tri[i]))
+            self.n_received += len(ts)
+            self.n_new += len(ts)
+
+        for func in self.callbacks:
+            func(eeg, tri, ts)
+
+    def set_bandpass(self, highcut=None, lowcut=None):
+        """
+        Set band-pass filter with highpass cutoff highcut and lowpass cutoff lowcut.
+        Filter is disabled if None.
+        """
+        if highcut is None or lowcut is None:
+            sos, zi = None, None
+        else:
+            sos, zi = self.butter_bandpass(highcut, lowcut, self.sfreq, self.n_channels)
+        with self.lock:
+            self.sos, self.zi = sos, zi
+
+    def set_car(self, apply_car, channels=None):
+        """
+        Enable or disable CAR computed over channels. None keeps the current channels.
+        """
+        with self.lock:
+            self.apply_car = apply_car
+            if channels is not None:
+                self.car_channels = np.array(channels)
+
+    #
+    #	Calculation of bandpass coefficients.
+    #	Order is computed automatically.
+    #	Note that if filter is unstable this function crashes (TODO handle problems)
+    #
+    @staticmethod
+    def butter_bandpass(highcut, lowcut, fs, num_ch):
+        low = lowcut / (0.5 * fs)
+        high = highcut / (0.5 * fs)
+        # get the order. TO BE DONE: Sometimes it fails
+        ord = buttord(high, low, 2, 40)
+        sos = butter(ord[0], [high, low], btype='band', output='sos')
+        # filter states of each section for samples x channels input
+        zi = np.zeros([sos.shape[0], 2, num_ch])
+        return sos, zi
+
+    #
+    #	Plotting buffer
+    #
+    #	data_plot holds two copies of a ring buffer of n_plot samples (channels x 2*n_plot)
+    #	and plot_idx is the index of the oldest sample. Every chunk is written to both copies,
+    #	so that data_plot[:, plot_idx:plot_idx + n_plot] is always the time-ordered window
+    #	without copying the buffer. Timestamps are kept in the same way in ts_plot.
+    #
+    def init_plot_buffer(self, n_plot, data=None, ts=None):
+        self.n_plot = int(n_plot)
+        self.x_ticks = np.arange(self.n_plot) / float(self.sfreq)
+        self.data_plot = np.zeros((self.n_channels, 2 * self.n_plot))
+        self.ts_plot = np.zeros(2 * self.n_plot)
+        self.plot_idx = 0
+        self.init_envelope()
+        if data is not None:
+            self.write_plot_data(data, ts)
+
+    def write_plot_data(self, data, ts):
+        """
+        Write samples x channels data and their timestamps to the plotting buffer
+        """
+        if len(data) > self.n_plot:
+            data = data[-self.n_plot:]
+            ts = ts[-self.n_plot:]
+        rows = (self.plot_idx + np.arange(len(data))) % self.n_plot
+        self.data_plot[:, rows] = data.T
+        self.data_plot[:, rows + self.n_plot] = data.T
+        self.ts_plot[rows] = ts
+        self.ts_plot[rows + self.n_plot] = ts
+        self.plot_idx = (self.plot_idx + len(data)) % self.n_plot
+        if self.bin_size > 1:
+            self.update_envelope(data)
+
+    def get_plot_data(self):
+        """
+        Time-ordered view of the plotting buffer (channels x samples)
+        """
+        return self.data_plot[:, self.plot_idx:self.plot_idx + self.n_plot]
+
+    def get_plot_timestamps(self):
+        return self.ts_plot[self.plot_idx:self.plot_idx + self.n_plot]
+
+    def resize(self, n_plot):
+        """
+        Change the window length keeping the latest samples. Zeros are padded at the beginning if longer.
+        """
+        with self.lock:
+            self.init_plot_buffer(n_plot, self.get_plot_data().T.copy(), self.get_plot_timestamps().copy())
+
+    def set_plot_width(self, plot_width):
+        """
+        Rebuild the envelope for a new plot width in pixels
+        """
+        plot_width = max(PLOT_BINS_MIN, int(plot_width))
+        if plot_width == self.plot_width:
+            return
+        with self.lock:
+            self.plot_width = plot_width
+            self.init_plot_buffer(self.n_plot, self.get_plot_data().T.copy(), self.get_plot_timestamps().copy())
+
+    #
+    #	Min/max envelope for level-of-detail rendering
+    #
+    #	The plotting window is divided into bins of bin_size samples, about one bin per
+    #	pixel column. The minimum and maximum of each completed bin are kept in a doubled
+    #	ring buffer in the same way as data_plot, and bin_min/bin_max hold those of the bin
+    #	being filled. Each bin is drawn as a vertical line from its minimum to its maximum,
+    #	so that spikes remain visible while the number of points depends only on the width.
+    #
+    def init_envelope(self):
+        self.bin_size = max(1, self.n_plot // self.plot_width)
+        self.n_env = int(math.ceil(self.n_plot / self.bin_size))
+        self.env_min = np.zeros((self.n_channels, 2 * self.n_env))
+        self.env_max = np.zeros((self.n_channels, 2 * self.n_env))
+        self.env_idx = 0
+        self.bin_min = np.zeros(self.n_channels)
+        self.bin_max = np.zeros(self.n_channels)
+        self.bin_fill = 0
+        self.update_envelope_ticks()
+
+    def push_envelope(self, mins, maxs):
+        """
+        Append completed bins (bins x channels) to the envelope ring buffer
+        """
+        if len(mins) > self.n_env:
+            mins = mins[-self.n_env:]
+            maxs = maxs[-self.n_env:]
+        rows = (self.env_idx + np.arange(len(mins))) % self.n_env
+        self.env_min[:, rows] = mins.T
+        self.env_min[:, rows + self.n_env] = mins.T
+        self.env_max[:, rows] = maxs.T
+        self.env_max[:, rows + self.n_env] = maxs.T
+        self.env_idx = (self.env_idx + len(mins)) % self.n_env
+
+    def update_envelope(self, data):
+        """
+        Update the envelope with new samples x channels data
+        """
+        i = 0
+        n = len(data)
+        # complete the bin being filled
+        if self.bin_fill > 0:
+            i = min(self.bin_size - self.bin_fill, n)
+            np.minimum(self.bin_min, data[:i].min(axis=0), out=self.bin_min)
+            np.maximum(self.bin_max, data[:i].max(axis=0), out=self.bin_max)
+            self.bin_fill += i
+            if self.bin_fill < self.bin_size:
+                self.update_envelope_ticks()
+                return
+            self.push_envelope(self.bin_min.reshape(1, -1), self.bin_max.reshape(1, -1))
+            self.bin_fill = 0
+        # complete bins
+        n_bins = (n - i) // self.bin_size
+        if n_bins > 0:
+            bins = data[i:i + n_bins * self.bin_size].reshape(n_bins, self.bin_size, -1)
+            self.push_envelope(bins.min(axis=1), bins.max(axis=1))
+            i += n_bins * self.bin_size
+        # start a new bin with the remaining samples
+        if i < n:
+            self.bin_min = data[i:].min(axis=0)
+            self.bin_max = data[i:].max(axis=0)
+            self.bin_fill = n - i
+        self.update_envelope_ticks()
+
+    def update_envelope_ticks(self):
+        """
+        X values of the envelope points. Each bin is placed at its last sample
+        and the last (possibly incomplete) bin ends at the latest sample.
+        """
+        n_complete = self.n_env - 1 if self.bin_fill > 0 else self.n_env
+        ends = self.n_plot - 1 - self.bin_fill - self.bin_size * np.arange(n_complete - 1, -1, -1)
+        if self.bin_fill > 0:
+            ends = np.append(ends, self.n_plot - 1)
+        self.x_env = np.repeat(ends / float(self.sfreq), 2)
+
+    def get_curve_data(self, ch):
+        """
+        X and Y values to draw channel ch. Raw samples are returned if the
+        window has fewer samples than pixel columns. Must be called with the lock.
+        """
+        if self.bin_size == 1:
+            return self.x_ticks, self.get_plot_data()[ch].copy()
+        mins = self.env_min[ch, self.env_idx:self.env_idx + self.n_env]
+        maxs = self.env_max[ch, self.env_idx:self.env_idx + self.n_env]
+        if self.bin_fill > 0:
+            mins = np.append(mins[1:], self.bin_min[ch])
+            maxs = np.append(maxs[1:], self.bin_max[ch])
+        y = np.empty(2 * len(mins))
+        y[0::2] = mins
+        y[1::2] = maxs
+        return self.x_env, y
+
+    #
+    #	Read access for the GUI and monitoring
+    #
+    def get_curves(self, channels):
+        """
+        Returns
+        =======
+        list of (x, y) of each channel to draw, taken at the same time
+        """
+        with self.lock:
+            return [self.get_curve_data(ch) for ch in channels]
+
+    def pop_updates(self):
+        """
+        Returns
+        =======
+        n_new: number of samples received since the last call
+        events: [age, value, timestamp] of trigger onsets detected since the last call,
+                where age is the number of samples received after the onset
+        """
+        with self.lock:
+            n_new = self.n_new
+            events = [[self.n_received - 1 - idx, value, ts] for idx, value, ts in self.events]
+            self.n_new = 0
+            self.events = []
+        return n_new, events
+
+    def get_window(self, n_samples=None):
+        """
+        Copy of the latest filtered samples
+
+        Params
+        ======
+        n_samples: number of samples. If None, the whole plotting window.
+
+        Returns
+        =======
+        data: samples x channels
+        timestamps: samples
+        """
+        with self.lock:
+            n = self.n_plot if n_samples is None else min(n_samples, self.n_plot, self.n_received)
+            data = self.get_plot_data()[:, self.n_plot - n:].T.copy()
+            timestamps = self.get_plot_timestamps()[self.n_plot - n:].copy()
+        return data, timestamps
+
+
+def run_headless(amp_name=None, amp_serial=None, bandpass=None, car=False, seconds=10, report_sec=1.0):
+    """
+    Run the scope pipeline without GUI until Ctrl+C is pressed
+
+    Trigger onsets are printed as they are detected and the receiving rate,
+    lost samples and RMS of each channel over the last report_sec seconds are
+    printed every report_sec seconds.
+
+    Params
+    ======
+    amp_name, amp_serial: LSL server to connect to. None: no constraint.
+    bandpass: None | [highpass cutoff, lowpass cutoff]
+    car: apply CAR
+    seconds: length of the buffered window
+    report_sec: report interval
+    """
+    sr = StreamReceiver(window_size=1, buffer_size=10, amp_serial=amp_serial, amp_name=amp_name)
+    pipeline = ScopePipeline(sr, seconds)
+    if bandpass is not None:
+        pipeline.set_bandpass(bandpass[0], bandpass[1])
+    pipeline.set_car(car)
+    ch_names = np.array(sr.get_channel_names())[sr.get_eeg_channels()]
+    sr.reset_stats()
+    pipeline.start()
+    tm = qc.Timer()
+    try:
+        while True:
+            time.sleep(0.05)
+            n_new, events = pipeline.pop_updates()
+            for age, value, ts in events:
+                pipeline.print('Trigger %d at %.3f' % (value, ts))
+            if tm.sec() >= report_sec:
+                tm.reset()
+                st = sr.get_stats()
+                data, _ = pipeline.get_window(int(report_sec * pipeline.sfreq))
+                rms = np.sqrt(np.mean(data ** 2, axis=0)) if len(data) > 0 else np.zeros(len(ch_names))
+                pipeline.print('%.1f Hz, %d lost, acquire %.3f ms | RMS %s' % (st['samples_per_sec'],
+                    st['n_lost'], st['acquire_ms'], ' '.join('%s:%.1f' % (c, r) for c, r in zip(ch_names, rms))))
+    except KeyboardInterrupt:
+        pipeline.stop()
+
+
+if __name__ == '__main__':
+    if len(sys.argv) == 2:
+        amp_name = sys.argv[1]
+        amp_serial = None
+    elif len(sys.argv) == 3:
+        amp_name, amp_serial = sys.argv[1:3]
+    else:
+        amp_name, amp_serial = pu.search_lsl()
+    if amp_name == 'None':
+        amp_name = None
+    print('Connecting to a server %s (Serial %s).' % (amp_name, amp_serial))
+    run_headless(amp_name, amp_serial)
@@ -7,6 +7,11 @@ from __future__ import print_function, division, unicode_literals
  2017
 
  V1.0
+
+ Acquisition and filtering run in a worker thread (see scope_pipeline.py)
+ and the GUI timer only reads the buffered data, so that GUI stalls do not
+ delay acquisition. Run scope_pipeline.py for the headless mode.
+
  TODO
 	- Should move to VisPY: http://vispy.org/plot.html#module-vispy.plot but still under development
 	- The scope should be a class itself
@@ -15,7 +20,6 @@ from __future__ import print_function, division, unicode_literals
 
 """
 
-DEBUG_TRIGGER = False
 NUM_X_CHANNELS = 16
 
 import pycnbi
@@ -30,9 +34,9 @@ import struct
 import pyqtgraph as pg
 from pyqtgraph.Qt import QtCore, QtGui, uic
 import numpy as np
-from scipy.signal import butter, lfilter, lfiltic, buttord
 import subprocess
 from pycnbi.stream_receiver.stream_receiver import StreamReceiver
+from pycnbi.stream_viewer.scope_pipeline import ScopePipeline, PLOT_BINS_MIN
 import pycnbi.utils.q_common as qc
 from builtins import input
 from configparser import RawConfigParser
@@ -233,9 +237,7 @@ class Scope(QtGui.QMainWindow, form_class):
         self.main_plot_handler.setLabel(axis='bottom', text='Time (s)')
 
         # X axis
-        self.x_ticks = np.zeros(self.config['sf'] * self.seconds_to_show);
-        for x in range(0, self.config['sf'] * self.seconds_to_show):
-            self.x_ticks[x] = (x * 1) / float(self.config['sf'])
+        self.x_ticks = np.arange(self.config['sf'] * self.seconds_to_show) / float(self.config['sf'])
 
         # Plotting colors. If channels > 16, colors will roll back to the beginning
         self.colors = np.array(
@@ -244,19 +246,18 @@ class Scope(QtGui.QMainWindow, form_class):
             [0, 128, 128], [128, 128, 0], [255, 128, 128], [128, 0, 128],
             [128, 255, 0], [255, 128, 0], [0, 255, 128], [128, 0, 255]])
 
-        # We want a lightweight scope, so we downsample the plotting to 64 Hz
-        self.subsampling_value = self.config['sf'] / 64
+        # We want a lightweight scope, so each curve is drawn as the min/max envelope
+        # of about one bin per pixel column when there are more samples than pixels.
 
         # EEG data for plotting
-        self.data_plot = np.zeros((self.config['sf'] * self.seconds_to_show,
-        self.config['eeg_channels']))
+        self.pipeline.set_plot_width(self.get_plot_width())
+        curves = self.pipeline.get_curves(self.channels_to_show_idx)
         self.curve_eeg = []
         for x in range(0, len(self.channels_to_show_idx)):
-            self.curve_eeg.append(self.main_plot_handler.plot(x=self.x_ticks,
-                y=self.data_plot[:, self.channels_to_show_idx[x]],
-                pen=pg.mkColor(
+            x_plot, y_plot = curves[x]
+            self.curve_eeg.append(self.main_plot_handler.plot(x=x_plot,
+                y=y_plot, pen=pg.mkColor(
                     self.colors[self.channels_to_show_idx[x] % 16, :])))
-        # self.curve_eeg[-1].setDownsampling(ds=self.subsampling_value, auto=False, method="mean")
 
 
         # Events data
@@ -267,12 +268,7 @@ class Scope(QtGui.QMainWindow, form_class):
         # CAR initialization
         self.apply_car = int(
             self.scope_settings.get("filtering", "apply_car_filter"))
-        self.matrix_car = np.zeros(
-            (self.config['eeg_channels'], self.config['eeg_channels']),
-            dtype=float)
-        self.matrix_car[:, :] = -1 / float(self.config['eeg_channels'])
-        np.fill_diagonal(self.matrix_car,
-            1 - (1 / float(self.config['eeg_channels'])))
+        self.pipeline.set_car(self.apply_car)
 
         # Laplacian initalization. TO BE DONE
         self.matrix_lap = np.zeros(
@@ -369,6 +365,10 @@ class Scope(QtGui.QMainWindow, form_class):
             'tri_type':data[10], 'lbl_type':data[11], 'tim_size':1,
             'idx_size':1}
 
+        # acquisition and filtering pipeline running in a worker thread
+        self.pipeline = ScopePipeline(self.sr,
+            int(self.scope_settings.get("plot", "time_plot")))
+
         self.tri = np.zeros(self.config['samples'])
         self.last_tri = 0
         self.eeg = np.zeros(
@@ -389,6 +389,7 @@ class Scope(QtGui.QMainWindow, form_class):
 
         QtCore.QCoreApplication.processEvents()
         QtCore.QCoreApplication.flush()
+        self.pipeline.start()
         self.timer = QtCore.QTimer(self)
         self.timer.timeout.connect(self.update_loop)
         self.timer.start(20);
@@ -405,10 +406,10 @@ class Scope(QtGui.QMainWindow, form_class):
             # self.updating= True
 
             # self.handle_tobiid_input()	# Read TiDs
-            self.read_eeg()  # Read new chunk
-            if len(self.ts_list) > 0:
-                self.filter_signal()  # Filter acquired data
-                self.update_ringbuffers()  # Update the plotting infor
+            # new chunks are acquired and filtered by the pipeline thread
+            n_new, events = self.pipeline.pop_updates()
+            if n_new > 0:
+                self.update_events(n_new, events)  # Update the plotting infor
                 if (not self.stop_plot):
                     self.repaint()  # Call paint event
         except:
@@ -422,58 +423,6 @@ class Scope(QtGui.QMainWindow, form_class):
             # QtCore.QTimer.singleShot( 20, self.update_loop )
             pass
 
-    #
-    #	Read EEG
-    #
-    def read_eeg(self):
-
-        # if self.updating==True: print( '##### ERROR: thread destroyed ? ######' )
-        # self.updating= True
-
-        try:
-            # data, self.ts_list= self.sr.inlets[0].pull_chunk(max_samples=self.config['sf']) # [frames][channels]
-            data, self.ts_list = self.sr.acquire(blocking=False)
-            if len(self.ts_list) == 0:
-                # self.eeg= None
-                # self.tri= None
-                return
-
-            n = self.config['eeg_channels']
-            '''
-            x= np.array( data )
-            trg_ch= self.config['tri_channels']
-            if trg_ch is not None:
-                self.tri= np.reshape( x[:,trg_ch], (-1,1) ) # samples x 1
-            self.eeg= np.reshape( x[:,self.sr.eeg_channels], (-1,n) ) # samples x channels
-            '''
-            trg_ch = self.config['tri_channels']
-            if trg_ch is not None:
-                self.tri = np.reshape(data[:, trg_ch], (-1, 1))  # samples x 1
-            self.eeg = np.reshape(data[:, self.sr.eeg_channels],
-                (-1, n))  # samples x channels
-
-            if DEBUG_TRIGGER:
-                # show trigger value
-                try:
-                    trg_value = max(self.tri)
-                    if trg_value > 0:
-                        self.print('Received trigger', trg_value)
-                except:
-                    traceback.print_exc()
-                    self.print('Error! self.tri =', self.tri)
-
-                    # Read exg. self.config.samples*self.config.exg_ch, type float
-                    # bexg = np.random.rand( 1, self.config['samples'] * self.config['exg_channels'] )
-                    # self.exg = np.reshape(list(bexg), (self.config['samples'],self.config['exg_channels']))
-        except WindowsError:
-            # print('**** Access violation in read_eeg():\n%s\n%s'% (sys.exc_info()[0], sys.exc_info()[1]))
-            pass
-        except:
-            traceback.print_exc()
-            # exc_type, exc_obj, exc_tb= sys.exc_info()
-            # print('**** Unexpected error in read_eeg(), Line %d:\n%s\n%s'% (exc_tb.tb_lineno, exc_type, exc_obj) )
-            pdb.set_trace()
-
     #
     #	Read EEG
     #
@@ -508,34 +457,25 @@ class Scope(QtGui.QMainWindow, form_class):
                 4 * self.config['samples'] * self.config['tri_channels']))
 
     #
-    #	Bandpas + CAR filtering
+    #	Plot width used to set the number of envelope bins of the pipeline
     #
-    def filter_signal(self):
-
-        if (self.apply_bandpass):
-            for x in range(0, self.eeg.shape[1]):
-                self.eeg[:, x], self.zi[:, x] = lfilter(self.b, self.a,
-                    self.eeg[:, x], -1, self.zi[:, x])
-
-        # We only apply CAR if selected AND there are at least 2 channels. Otherwise it makes no sense
-        if (self.apply_car) and (len(self.channels_to_show_idx) > 1):
-            self.eeg = np.dot(self.matrix_car, np.transpose(self.eeg))
-            self.eeg = np.transpose(self.eeg)
+    def get_plot_width(self):
+        return max(PLOT_BINS_MIN, int(self.main_plot_handler.width()))
 
     #
-    #	Update ringbuffers and events for plotting
+    #	Update events for plotting
     #
-    def update_ringbuffers(self):
-        # leeq
-        self.data_plot = np.roll(self.data_plot, -len(self.ts_list), 0)
-        self.data_plot[-len(self.ts_list):, :] = self.eeg
+    #	n_new: number of samples received since the last update
+    #	events: [age, value, timestamp] of trigger onsets from ScopePipeline.pop_updates()
+    #
+    def update_events(self, n_new, events):
 
         # We have to remove those indexes that reached time = 0
         delete_indices_e = []
         delete_indices_c = []
         for x in range(0, len(self.events_detected), 2):
             xh = int(x / 2)
-            self.events_detected[x] -= len(self.ts_list)  # leeq
+            self.events_detected[x] -= n_new  # leeq
             if (self.events_detected[x] < 0) and (not self.stop_plot):
                 delete_indices_e.append(x)
                 delete_indices_e.append(x + 1)
@@ -550,14 +490,13 @@ class Scope(QtGui.QMainWindow, form_class):
         self.events_text = [i for j, i in enumerate(self.events_text) if
             j not in delete_indices_c]
 
-        # Find LPT events and add them
+        # Add LPT events
         if (self.show_LPT_events) and (not self.stop_plot):
-            for x in range(len(self.tri)):
-                tri = int(self.tri[x])
-                if tri != 0 and (tri != self.last_tri):
-                    self.addEventPlot("LPT", tri)
+            for age, tri, ts in events:
+                pos = self.pipeline.n_plot - 1 - age
+                if pos >= 0:
+                    self.addEventPlot("LPT", tri, pos)
                     self.print('Trigger %d received' % tri)
-                self.last_tri = tri
 
     #
     #	Called by repaint()
@@ -591,9 +530,14 @@ class Scope(QtGui.QMainWindow, form_class):
     #
     def paintInterface(self, qp):
 
+        # Rebuild the envelope if the plot width has changed
+        self.pipeline.set_plot_width(self.get_plot_width())
+
         # Update EEG channels
+        curves = self.pipeline.get_curves(self.channels_to_show_idx)
         for x in range(0, len(self.channels_to_show_idx)):
-            self.curve_eeg[x].setData(x=self.x_ticks, y=self.data_plot[:,self.channels_to_show_idx[x]] - x * self.scale)
+            x_plot, y_plot = curves[x]
+            self.curve_eeg[x].setData(x=x_plot, y=y_plot - x * self.scale)
 
         # Update events
         for x in range(0, len(self.events_detected), 2):
@@ -652,26 +596,13 @@ class Scope(QtGui.QMainWindow, form_class):
                 new_seconds < 100):
             self.spinBox_time.setValue(new_seconds)
             self.main_plot_handler.setRange(xRange=[0, new_seconds])
-            self.x_ticks = np.zeros(self.config['sf'] * new_seconds);
-            for x in range(0, self.config['sf'] * new_seconds):
-                self.x_ticks[x] = (x * 1) / float(self.config['sf'])
-
-            if (new_seconds > self.seconds_to_show):
-                padded_signal = np.zeros((self.config['sf'] * new_seconds,
-                self.config['eeg_channels']))
-                padded_signal[padded_signal.shape[0] - self.data_plot.shape[0]:,
-                :] = self.data_plot
-                for x in range(0, len(self.events_detected), 2):
-                    self.events_detected[x] += padded_signal.shape[0] - \
-                                               self.data_plot.shape[0]
-                self.data_plot = padded_signal
+            self.x_ticks = np.arange(self.config['sf'] * new_seconds) / float(self.config['sf'])
 
-            else:
-                for x in range(0, len(self.events_detected), 2):
-                    self.events_detected[x] -= self.data_plot.shape[0] - \
-                                               self.config['sf'] * new_seconds
-                self.data_plot = self.data_plot[
-                self.data_plot.shape[0] - self.config['sf'] * new_seconds:, :]
+            # the latest samples are kept. Zeros are padded at the beginning if longer.
+            n_plot = self.config['sf'] * new_seconds
+            for x in range(0, len(self.events_detected), 2):
+                self.events_detected[x] += n_plot - self.pipeline.n_plot
+            self.pipeline.resize(n_plot)
 
             self.seconds_to_show = new_seconds
             self.trigger_help()
@@ -713,9 +644,9 @@ class Scope(QtGui.QMainWindow, form_class):
                         "/>")
 
     #
-    # 	Add an event to the scope
+    # 	Add an event to the scope at sample index pos of the plot (default: latest sample)
     #
-    def addEventPlot(self, event_name, event_id):
+    def addEventPlot(self, event_name, event_id, pos=None):
         if (event_name == "TID"):
             color = pg.mkColor(0, 0, 255)
         elif (event_name == "KEY"):
@@ -725,33 +656,21 @@ class Scope(QtGui.QMainWindow, form_class):
         else:
             color = pg.mkColor(255, 255, 255)
 
-        self.events_detected.append(self.data_plot.shape[0] - 1)
+        if pos is None:
+            pos = self.pipeline.n_plot - 1
+        self.events_detected.append(pos)
         self.events_detected.append(event_id)
         self.events_curves.append(self.main_plot_handler.plot(pen=color,
-            x=np.array([self.x_ticks[-1], self.x_ticks[-1]]), y=np.array(
+            x=np.array([self.x_ticks[pos], self.x_ticks[pos]]), y=np.array(
                 [+1.5 * self.scale,
                     -1.5 * self.scale * self.config['eeg_channels']])))
         # text = pg.TextItem(event_name + "(" + str(self.events_detected[-1]) + ")", anchor=(1.1,0), fill=(0,0,0), color=color)
         text = pg.TextItem(str(self.events_detected[-1]), anchor=(1.1, 0),
             fill=(0, 0, 0), color=color)
-        text.setPos(self.x_ticks[-1], self.scale)
+        text.setPos(self.x_ticks[pos], self.scale)
         self.events_text.append(text)
         self.main_plot_handler.addItem(self.events_text[-1])
 
-    #
-    #	Calculation of bandpass coefficients.
-    #	Order is computed automatically.
-    #	Note that if filter is unstable this function crashes (TODO handle problems)
-    #
-    def butter_bandpass(self, highcut, lowcut, fs, num_ch):
-        low = lowcut / (0.5 * fs)
-        high = highcut / (0.5 * fs)
-        # get the order. TO BE DONE: Sometimes it fails
-        ord = buttord(high, low, 2, 40)
-        b, a = butter(ord[0], [high, low], btype='band')
-        zi = np.zeros([a.shape[0] - 1, num_ch])
-        return b, a, zi
-
     #
     #	Updates the title shown in the scope
     #
@@ -815,6 +734,7 @@ class Scope(QtGui.QMainWindow, form_class):
 
     def onActivated_checkbox_bandpass(self):
         self.apply_bandpass = False
+        self.pipeline.set_bandpass(None, None)
         self.pushButton_bp.setEnabled(self.checkBox_bandpass.isChecked())
         self.doubleSpinBox_hp.setEnabled(self.checkBox_bandpass.isChecked())
         self.doubleSpinBox_lp.setEnabled(self.checkBox_bandpass.isChecked())
@@ -822,6 +742,7 @@ class Scope(QtGui.QMainWindow, form_class):
 
     def onActivated_checkbox_car(self):
         self.apply_car = self.checkBox_car.isChecked()
+        self.pipeline.set_car(self.apply_car)
         self.update_title_scope()
 
     def onActivated_checkbox_TID(self):
@@ -846,9 +767,8 @@ class Scope(QtGui.QMainWindow, form_class):
     def onClicked_button_bp(self):
         if (self.doubleSpinBox_lp.value() > self.doubleSpinBox_hp.value()):
             self.apply_bandpass = True
-            self.b, self.a, self.zi = self.butter_bandpass(
-                self.doubleSpinBox_hp.value(), self.doubleSpinBox_lp.value(),
-                self.config['sf'], self.config['eeg_channels'])
+            self.pipeline.set_bandpass(self.doubleSpinBox_hp.value(),
+                self.doubleSpinBox_lp.value())
         self.update_title_scope()
 
     def onSelectionChanged_table(self):
@@ -873,25 +793,16 @@ class Scope(QtGui.QMainWindow, form_class):
                     idx += 1
 
         # Add new plots
+        curves = self.pipeline.get_curves(self.channels_to_show_idx)
         self.curve_eeg = []
         for x in range(0, len(self.channels_to_show_idx)):
-            self.curve_eeg.append(self.main_plot_handler.plot(x=self.x_ticks,
-                y=self.data_plot[:, self.channels_to_show_idx[x]],
-                pen=self.colors[self.channels_to_show_idx[x] % NUM_X_CHANNELS, :]))
-            self.curve_eeg[-1].setDownsampling(ds=self.subsampling_value,
-                auto=False, method="mean")
+            x_plot, y_plot = curves[x]
+            self.curve_eeg.append(self.main_plot_handler.plot(x=x_plot,
+                y=y_plot, pen=self.colors[self.channels_to_show_idx[x] % NUM_X_CHANNELS, :]))
 
         # Update CAR so it's computed based only on the shown channels
         if (len(self.channels_to_show_idx) > 1):
-            self.matrix_car = np.zeros(
-                (self.config['eeg_channels'], self.config['eeg_channels']),
-                dtype=float)
-            self.matrix_car[:, :] = -1 / float(len(self.channels_to_show_idx))
-            np.fill_diagonal(self.matrix_car,
-                1 - (1 / float(len(self.channels_to_show_idx))))
-            for x in range(0, len(self.channels_to_hide_idx)):
-                self.matrix_car[self.channels_to_hide_idx[x], :] = 0
-                self.matrix_car[:, self.channels_to_hide_idx[x]] = 0
+            self.pipeline.set_car(self.apply_car, self.channels_to_show_idx)
 
         # Refresh the plot
         self.update_plot_scale(self.scale)
@@ -956,6 +867,7 @@ class Scope(QtGui.QMainWindow, form_class):
         '''
 
         # leeq
+        self.pipeline.stop()
         if (self.pushButton_stoprec.isEnabled()):
             subprocess.Popen(["cl_rpc", "closexdf"], close_fds=True)
         # quit()
@@ -20,6 +20,13 @@ import sys
 import ctypes
 import time
 from builtins import input, bytes
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+# name of the LSL marker stream of 'LSL' trigger type
+LSL_TRIGGER_NAME = 'PyCNBITrigger'
 
 class Trigger(object):
     """
@@ -28,14 +35,21 @@ class Trigger(object):
      'USB2LPT': Commercial USB2LPT adapter
      'DESKTOP': Desktop native LPT
      'SOFTWARE': Software trigger
+     'LSL': Software trigger sent as an LSL marker stream
      'FAKE': Mock trigger device for testing
 
     When using USB2LPT, the port number (e.g. 0x378) can be searched automatically.
     When using Desktop's LPT, the port number must be specified during initialization.
 
     Software trigger writes event information into a text file with LSL timestamps, which
-    can be later added to fif. This file will be automatically saved and closed when Ctrl+C is
-    pressed or terminal window is closed (or killed for whatever reason).
+    can be later added to fif. Events are put into a queue and written by a background
+    thread, so signal() never waits for the disk. This file will be automatically saved and
+    closed when Ctrl+C is pressed or terminal window is closed (or killed for whatever reason).
+
+    LSL trigger pushes event values with LSL timestamps to a marker stream named
+    LSL_TRIGGER_NAME. Record it together with the signal stream using
+    stream_recorder/multi_recorder.py to store events in the same file, without any
+    event file or merge step. Only onsets are sent; signal_off() does nothing.
 
     The asynchronous function signal(x) sends 1-byte integer value x and returns immediately.
     It schedules to send the value 0 at the end of the signal length.
@@ -57,6 +71,7 @@ class Trigger(object):
     """
     def __init__(self, lpttype='USB2LPT', portaddr=None, verbose=True):
         self.evefile = None
+        self.eve_thread = None
         self.lpttype = lpttype
         self.verbose = verbose
 
@@ -121,14 +136,13 @@ class Trigger(object):
                 self.print('Warning: COM port %d is unusual.' % portaddr)
 
         elif self.lpttype == 'SOFTWARE':
-            from pycnbi.stream_receiver.stream_receiver import StreamReceiver
             self.print('Using software trigger')
 
             # get data file location
             LSL_SERVER = 'StreamRecorderInfo'
             inlet = cnbi_lsl.start_client(LSL_SERVER)
             fname = inlet.info().source_id()
-            if fname[-4:] != '.pcl':
+            if fname[-4:] not in ['.pcl', '.dat', '.eeg']:
                 self.print('ERROR: Received wrong record file name format %s' % fname)
                 sys.exit(-1)
             evefile = fname[:-8] + '-eve.txt'
@@ -136,17 +150,32 @@ class Trigger(object):
             self.print('Event file is: %s' % evefile)
             self.evefile = open(evefile, 'a')
 
+            # events are written by a background thread
+            self.eve_queue = queue.Queue()
+            self.eve_thread = threading.Thread(target=self.event_writer)
+            self.eve_thread.daemon = True
+            self.eve_thread.start()
+
             # check server LSL time server integrity
+            # a single sample is enough to compare the server's timestamp with the local clock
             self.print("Checking LSL server's timestamp integrity for logging software triggers.")
             amp_name, amp_serial = pu.search_lsl()
-            sr = StreamReceiver(window_size=1, buffer_size=1, amp_serial=amp_serial, eeg_only=False, amp_name=amp_name)
+            amp_inlet = cnbi_lsl.start_client(amp_name)
+            amp_inlet.pull_sample(timeout=5.0)  # discard the buffered sample
+            _, server_time = amp_inlet.pull_sample(timeout=5.0)
             local_time = pylsl.local_clock()
-            server_time = sr.get_window_list()[1][-1]
+            if server_time is None:
+                raise RuntimeError('No data received from %s.' % amp_name)
             lsl_time_offset = local_time - server_time
             with open(eveoffset_file, 'a') as f:
                 f.write('Local time: %.6f, Server time: %.6f, Offset: %.6f\n' % (local_time, server_time, lsl_time_offset))
             self.print('LSL timestamp offset (%.3f) saved to %s' % (lsl_time_offset, eveoffset_file))
 
+        elif self.lpttype == 'LSL':
+            self.print('Using LSL marker stream %s' % LSL_TRIGGER_NAME)
+            self.outlet = cnbi_lsl.start_server(LSL_TRIGGER_NAME, channel_format='int32', stype='Markers',
+                                                ch_names=['TRIGGER'])
+
         elif self.lpttype == 'FAKE' or self.lpttype is None or self.lpttype is False:
             self.print('WARNING: Using a fake trigger.')
             self.lpttype = 'FAKE'
@@ -157,17 +186,44 @@ class Trigger(object):
             sys.exit(-1)
 
     def __del__(self):
+        self.close()
+
+    def close(self):
+        """
+        Write the remaining software trigger events and close the event file
+        """
+        if self.eve_thread is not None and self.eve_thread.is_alive():
+            self.eve_queue.put(None)
+            self.eve_thread.join()
         if self.evefile is not None and not self.evefile.closed:
             self.evefile.close()
             self.print('Event file saved.')
             sys.stdout.flush()
 
+    def event_writer(self):
+        """
+        Write queued events in batches. Runs in a background thread until None is received.
+        """
+        while True:
+            events = [self.eve_queue.get()]
+            # take all events queued in the meantime
+            while True:
+                try:
+                    events.append(self.eve_queue.get_nowait())
+                except queue.Empty:
+                    break
+            stop = None in events
+            self.evefile.write(''.join(['%.6f\t0\t%d\n' % e for e in events if e is not None]))
+            self.evefile.flush()
+            if stop:
+                break
+
     def print(self, *args):
         qc.print_c('[pyLptControl] ', color='w', end='')
         print(*args)
 
     def init(self, duration):
-        if self.lpttype == 'SOFTWARE':
+        if self.lpttype in ['SOFTWARE', 'LSL']:
             self.print('>> Ignoring delay parameter for software trigger')
             return True
         elif self.lpttype == 'FAKE':
@@ -188,12 +244,18 @@ class Trigger(object):
     # write to software trigger
     def write_event(self, value):
         assert self.lpttype == 'SOFTWARE'
-        self.evefile.write('%.6f\t0\t%d\n' % (pylsl.local_clock(), value))
+        self.eve_queue.put((pylsl.local_clock(), value))
+        return True
+
+    # push to LSL trigger
+    def push_event(self, value):
+        assert self.lpttype == 'LSL'
+        self.outlet.push_sample([value], pylsl.local_clock())
         return True
 
     # set data
     def set_data(self, value):
-        if self.lpttype == 'SOFTWARE':
+        if self.lpttype in ['SOFTWARE', 'LSL']:
             self.print('>> set_data() not supported for software trigger.')
             return False
         elif self.lpttype == 'FAKE':
@@ -215,6 +277,10 @@ class Trigger(object):
             if self.verbose is True:
                 self.print('Sending software trigger', value)
             return self.write_event(value)
+        elif self.lpttype == 'LSL':
+            if self.verbose is True:
+                self.print('Sending LSL trigger', value)
+            return self.push_event(value)
         elif self.lpttype == 'FAKE':
             self.print('Sending FAKE trigger signal', value)
             return True
@@ -233,6 +299,8 @@ class Trigger(object):
     def signal_off(self):
         if self.lpttype == 'SOFTWARE':
             return self.write_event(0)
+        elif self.lpttype == 'LSL':
+            return True
         elif self.lpttype == 'FAKE':
             self.print('FAKE trigger off')
             return True
@@ -242,7 +310,7 @@ class Trigger(object):
 
     # set pin
     def set_pin(self, pin):
-        if self.lpttype == 'SOFTWARE':
+        if self.lpttype in ['SOFTWARE', 'LSL']:
             self.print('>> set_pin() not supported for software trigger.')
             return False
         elif self.lpttype == 'FAKE':
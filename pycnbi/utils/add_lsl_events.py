@@ -25,6 +25,7 @@ def add_lsl_events(event_dir, offset=0, recursive=False):
     Swiss Federal Institute of Technology Lausanne (EPFL)
     2017
     """
+    import os
     import pycnbi.utils.q_common as qc
     from pycnbi.utils.convert2fif import pcl2fif
     from builtins import input
@@ -45,7 +46,9 @@ def add_lsl_events(event_dir, offset=0, recursive=False):
 
     input('\nPress Enter to start')
     for f in to_process:
-        pclfile = f.replace('-eve.txt', '-raw.pcl')
+        pclfile = f.replace('-eve.txt', '-raw.dat')
+        if not os.path.exists(pclfile):
+            pclfile = f.replace('-eve.txt', '-raw.pcl')
         pcl2fif(pclfile, external_event=f, offset=offset)
 
 # sample code
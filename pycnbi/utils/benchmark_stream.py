@@ -0,0 +1,80 @@
+from __future__ import print_function, division
+
+"""
+Streaming throughput test.
+
+Streams synthetic signals with SyntheticPlayer and receives them with
+StreamReceiver in the same process for each configuration of channels,
+sampling rate and chunk size. Reports the received rate, the receiver's
+processing time per chunk, lost samples and the player's timing statistics.
+A configuration is sustainable if the received rate matches the nominal
+rate without lost samples.
+
+"""
+
+import time
+import pycnbi
+import pycnbi.utils.q_common as qc
+from pycnbi.stream_player.synthetic_player import SyntheticPlayer
+from pycnbi.stream_receiver.stream_receiver import StreamReceiver
+
+
+def benchmark(n_channels, sfreq, chunk_size, test_sec=10.0, window_size=1.0, get_window=True, server_name=None):
+    """
+    Measure throughput of a single configuration
+
+    Params
+    ======
+    n_channels: number of EEG channels
+    sfreq: sampling rate
+    chunk_size: chunk size of the player
+    test_sec: measurement length in seconds
+    window_size: window size of StreamReceiver
+    get_window: also call get_window() after each acquire() as a decoder would do
+
+    Returns
+    =======
+    dict of StreamReceiver.get_stats() plus 'window_ms' and player timing statistics with 'player_' prefix
+    """
+    if server_name is None:
+        server_name = 'StreamPlayerBench-%d-%d-%d' % (n_channels, sfreq, chunk_size)
+    player = SyntheticPlayer(server_name, n_channels=n_channels, sfreq=sfreq, chunk_size=chunk_size)
+    player.start()
+    sr = StreamReceiver(window_size=window_size, buffer_size=window_size, amp_name=server_name)
+    sr.reset_stats()
+    window_sec = 0.0
+    tm = qc.Timer()
+    while tm.sec() < test_sec:
+        sr.acquire()
+        if get_window:
+            t_start = time.time()
+            sr.get_window()
+            window_sec += time.time() - t_start
+    stats = sr.get_stats()
+    player.stop()
+    stats['window_ms'] = 1000.0 * window_sec / max(1, stats['n_chunks'])
+    for key, value in player.get_timing_stats().items():
+        stats['player_' + key] = value
+    del player, sr
+    return stats
+
+
+def run(configs, test_sec=10.0):
+    """
+    Run benchmark() for each configuration of (n_channels, sfreq, chunk_size) and print a summary
+    """
+    results = []
+    for n_channels, sfreq, chunk_size in configs:
+        qc.print_c('\n>> %d channels, %d Hz, chunk size %d' % (n_channels, sfreq, chunk_size), 'W')
+        results.append(benchmark(n_channels, sfreq, chunk_size, test_sec=test_sec))
+    print('\n  ch    sfreq  chunk  received(Hz)    MB/s  acquire(ms)  window(ms)  lost  jitter(ms)')
+    for (n_channels, sfreq, chunk_size), st in zip(configs, results):
+        print('%4d %8d %6d %13.1f %7.1f %12.3f %11.3f %5d %11.3f' % (n_channels, sfreq, chunk_size,
+            st['samples_per_sec'], st['mb_per_sec'], st['acquire_ms'], st['window_ms'], st['n_lost'],
+            st['player_jitter_ms']))
+    return results
+
+
+if __name__ == '__main__':
+    configs = [(64, 512, 16), (64, 2048, 32), (128, 4096, 64), (256, 10000, 100), (512, 20000, 200)]
+    run(configs)
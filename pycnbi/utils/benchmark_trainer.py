@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function, division
+
+"""
+Trainer speed test using synthetic data.
+
+Generates deterministic synthetic recordings, then times each stage of the
+trainer (feature computation, cross-validation, decoder training).
+Results are printed and saved as a JSON file to compare across versions.
+
+Usage:
+python benchmark_trainer.py [--channels 16] [--sfreq 512] [--trials 40] [--files 2]
+                            [--classifier RF] [--n-jobs N] [--out benchmark.json]
+
+"""
+
+import os
+import json
+import shutil
+import platform
+import argparse
+import tempfile
+import numpy as np
+import pycnbi
+import pycnbi.utils.q_common as qc
+import pycnbi.utils.synthetic_eeg as synthetic_eeg
+import pycnbi.decoder.trainer as trainer
+
+CONFIG_TEMPLATE = '''
+from pycnbi.triggers.trigger_def import trigger_def
+tdef = trigger_def('triggerdef_16.ini')
+TRIGGER_DEF = {tdef.LEFT_GO, tdef.RIGHT_GO}
+EPOCH = [0.5, 4.5]
+DATADIR = r'%(datadir)s'
+PSD = dict(fmin=1, fmax=40, wlen=0.5, wstep=%(wstep)d)
+CHANNEL_PICKS = None
+SP_FILTER = 'car'
+TP_FILTER = None
+NOTCH_FILTER = None
+FEATURES = 'PSD'
+CLASSIFIER = '%(classifier)s'
+RF = dict(trees=%(trees)d, max_depth=30, seed=0)
+GB = dict(trees=%(trees)d, learning_rate=0.01, max_depth=5, seed=0)
+RLDA_REGULARIZE_COEFF = 0.3
+CV_PERFORM = 'StratifiedShuffleSplit'
+CV_TEST_RATIO = 0.2
+CV_FOLDS = %(folds)d
+CV_RANDOM_SEED = 0
+CV_EXPORT_RESULT = True
+EXPORT_CLS = True
+EXPORT_GOOD_FEATURES = False
+N_JOBS = %(n_jobs)s
+'''
+
+
+def run_benchmark(channels=16, sfreq=512, trials=40, files=2, classifier='RF', trees=200, folds=8,
+                  n_jobs=None, wstep=None, workdir=None):
+    """
+    Run all trainer stages on synthetic data and return timings
+
+    Returns
+    =======
+    dict of parameters, environment and stage timings in seconds
+    """
+    if wstep is None:
+        wstep = int(sfreq / 16)
+    remove_workdir = workdir is None
+    if workdir is None:
+        workdir = tempfile.mkdtemp(prefix='pycnbi-benchmark-')
+    workdir = qc.forward_slashify(workdir)
+    params = dict(channels=channels, sfreq=sfreq, trials=trials, files=files, classifier=classifier,
+                  trees=trees, folds=folds, n_jobs=n_jobs, wstep=wstep)
+    stages = {}
+
+    try:
+        tm = qc.Timer()
+        synthetic_eeg.save_fif(workdir, n_files=files, n_channels=channels, sfreq=sfreq, n_trials=trials)
+        stages['generate_data'] = tm.sec()
+
+        cfg_file = '%s/config_benchmark.py' % workdir
+        with open(cfg_file, 'w') as fout:
+            fout.write(CONFIG_TEMPLATE % dict(datadir=workdir, classifier=classifier, trees=trees,
+                                              folds=folds, n_jobs=n_jobs, wstep=wstep))
+        cfg = trainer.load_cfg(cfg_file)
+
+        tm.reset()
+        featdata = trainer.compute_features(cfg)
+        stages['compute_features'] = tm.sec()
+        X_shape = list(featdata['X_data'].shape)
+
+        tm.reset()
+        trainer.cross_validate(cfg, featdata, cv_file='%s/cv_result.txt' % workdir)
+        stages['cross_validate'] = tm.sec()
+
+        tm.reset()
+        trainer.train_decoder(cfg, featdata)
+        stages['train_decoder'] = tm.sec()
+    finally:
+        if remove_workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    stages['total'] = sum(stages.values())
+    env = dict(python=platform.python_version(), platform=platform.platform(), machine=platform.machine(),
+               cpu_count=os.cpu_count() if hasattr(os, 'cpu_count') else None, numpy=np.__version__,
+               mne=trainer.mne.__version__)
+    return dict(params=params, environment=env, feature_shape=X_shape, stages=stages)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark trainer stages on synthetic data.')
+    parser.add_argument('--channels', type=int, default=16)
+    parser.add_argument('--sfreq', type=int, default=512)
+    parser.add_argument('--trials', type=int, default=40, help='trials per file')
+    parser.add_argument('--files', type=int, default=2)
+    parser.add_argument('--classifier', default='RF', choices=['RF', 'GB', 'XGB', 'LDA', 'rLDA'])
+    parser.add_argument('--trees', type=int, default=200)
+    parser.add_argument('--folds', type=int, default=8)
+    parser.add_argument('--n-jobs', type=int, default=None)
+    parser.add_argument('--workdir', default=None, help='keep generated data in this directory')
+    parser.add_argument('--out', default='benchmark_trainer.json', help='JSON output file')
+    args = parser.parse_args()
+
+    result = run_benchmark(channels=args.channels, sfreq=args.sfreq, trials=args.trials, files=args.files,
+                           classifier=args.classifier, trees=args.trees, folds=args.folds,
+                           n_jobs=args.n_jobs, workdir=args.workdir)
+    print('\n>> Benchmark results')
+    for stage in ['generate_data', 'compute_features', 'cross_validate', 'train_decoder', 'total']:
+        print('%-18s %8.2f sec' % (stage, result['stages'][stage]))
+    with open(args.out, 'w') as fout:
+        json.dump(result, fout, indent=2, sort_keys=True)
+    print('Results saved to %s' % args.out)
+
+
+if __name__ == '__main__':
+    main()
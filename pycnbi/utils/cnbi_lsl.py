@@ -28,7 +28,7 @@ import sys
 
 
 def start_server(server_name, n_channels=1, channel_format='string', nominal_srate=pylsl.IRREGULAR_RATE, stype='EEG',
-                 source_id=None):
+                 source_id=None, ch_names=None, chunk_size=0):
     """
     Start a new LSL server
 
@@ -52,6 +52,10 @@ def start_server(server_name, n_channels=1, channel_format='string', nominal_sra
         Signal type in string format
     source_id:
         If None, set to server name
+    ch_names:
+        If not None, channel labels are written to the stream description
+    chunk_size:
+        Preferred chunk size of the outlet. 0 uses the sender's chunk granularity.
 
     Returns
     -------
@@ -62,7 +66,12 @@ def start_server(server_name, n_channels=1, channel_format='string', nominal_sra
         source_id = server_name
     sinfo = pylsl.StreamInfo(server_name, channel_count=n_channels, channel_format=channel_format,\
                            nominal_srate=nominal_srate, type=stype, source_id=source_id)
-    return pylsl.StreamOutlet(sinfo)
+    if ch_names is not None:
+        assert len(ch_names) == n_channels, 'Length of ch_names must be n_channels.'
+        channel_desc = sinfo.desc().append_child('channels')
+        for ch in ch_names:
+            channel_desc.append_child('channel').append_child_value('label', str(ch))
+    return pylsl.StreamOutlet(sinfo, chunk_size=chunk_size)
 
 
 def start_client(server_name):
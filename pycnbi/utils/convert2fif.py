@@ -31,6 +31,7 @@ import numpy as np
 import pycnbi.utils.pycnbi_utils as pu
 import pycnbi.utils.q_common as qc
 from pycnbi.pycnbi_config import CAP, LAPLACIAN
+from pycnbi.stream_recorder.stream_writer import load_record
 from builtins import input
 mne.set_log_level('ERROR')
 
@@ -40,7 +41,7 @@ def event_timestamps_to_indices(sigfile, eventfile, offset=0):
     Convert LSL timestamps to sample indices for separetely recorded events.
 
     Parameters:
-    sigfile: raw signal file (Python Pickle) recorded with stream_recorder.py.
+    sigfile: raw signal file (.dat or Python Pickle) recorded with stream_recorder.py.
     eventfile: event file where events are indexed with LSL timestamps.
     offset: if the LSL server's timestamp is shifted, correct with offset value in seconds.
 
@@ -48,7 +49,7 @@ def event_timestamps_to_indices(sigfile, eventfile, offset=0):
     events list, which can be used as an input to mne.io.RawArray.add_events().
     """
 
-    raw = qc.load_obj(sigfile)
+    raw = load_record(sigfile)
     ts = raw['timestamps'].reshape(-1)
     ts_min = min(ts)
     ts_max = max(ts)
@@ -89,7 +90,7 @@ def convert2mat(filename, matfile):
 
 def pcl2fif(filename, interactive=False, outdir=None, external_event=None, offset=0, overwrite=False, precision='single'):
     """
-    PyCNBI Python pickle file
+    PyCNBI Python pickle file or stream file (.dat) written by stream_recorder
 
     Params
     --------
@@ -103,7 +104,7 @@ def pcl2fif(filename, interactive=False, outdir=None, external_event=None, offse
     elif outdir[-1] != '/':
         outdir += '/'
 
-    data = qc.load_obj(filename)
+    data = load_record(filename)
 
     if type(data['signals']) == list:
         signals_raw = np.array(data['signals'][0]).T  # to channels x samples
@@ -435,7 +436,7 @@ def any2fif(filename, interactive=False, outdir=None, channel_file=None):
     if outdir is not None:
         qc.make_dirs(outdir)
 
-    if p.ext == 'pcl':
+    if p.ext in ['pcl', 'dat']:
         eve_file = '%s/%s.txt' % (p.dir, p.name.replace('raw', 'eve'))
         if os.path.exists(eve_file):
             qc.print_c('Adding events from %s' % eve_file, 'G')
@@ -449,7 +450,7 @@ def any2fif(filename, interactive=False, outdir=None, channel_file=None):
     elif p.ext == 'gdf':
         gdf2fif(filename, interactive=interactive, outdir=outdir, channel_file=channel_file)
     else:  # unknown format
-        qc.print_c('WARNING: Ignored unrecognized file extension %s. It should be [.pcl | .eeg | .gdf | .bdf]'\
+        qc.print_c('WARNING: Ignored unrecognized file extension %s. It should be [.pcl | .dat | .eeg | .gdf | .bdf]'\
             % p.ext, 'r')
 
 def main(input_dir, channel_file=None):
@@ -457,7 +458,7 @@ def main(input_dir, channel_file=None):
     for f in qc.get_file_list(input_dir, fullpath=True, recursive=True):
         p = qc.parse_path(f)
         outdir = p.dir + '/fif/'
-        if p.ext in ['pcl', 'bdf', 'edf', 'gdf', 'eeg']:
+        if p.ext in ['pcl', 'dat', 'bdf', 'edf', 'gdf', 'eeg']:
             print('Converting %s' % f)
             any2fif(f, interactive=True, outdir=outdir, channel_file=channel_file)
             count += 1
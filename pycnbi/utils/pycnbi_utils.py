@@ -14,7 +14,6 @@ Swiss Federal Institute of Technology Lausanne (EPFL)
 """
 
 import os
-import sys
 import scipy.io
 import pylsl
 import mne
@@ -29,6 +28,61 @@ mne.set_log_level('ERROR')
 os.environ['OMP_NUM_THREADS'] = '1' # actually improves performance for multitaper
 
 
+def create_shared_array(shape, dtype=np.float64, data=None, dirname=None):
+    """
+    Create a file-backed array which can be shared with worker processes
+    without pickling its contents. Workers open it with np.memmap() using
+    the returned array's filename, dtype and shape.
+
+    Params
+    ======
+    shape: array shape
+    dtype: numpy data type
+    data: initial values to copy into the array (optional)
+    dirname: directory for the backing file; system temporary directory if None
+
+    Returns
+    =======
+    numpy.memmap object
+    """
+    import tempfile
+    fd, fname = tempfile.mkstemp(prefix='pycnbi-', suffix='.dat', dir=dirname)
+    os.close(fd)
+    arr = np.memmap(fname, dtype=dtype, mode='w+', shape=shape)
+    if data is not None:
+        arr[:] = data
+        arr.flush()
+    return arr
+
+
+def shared_array_info(arr):
+    """
+    Returns a picklable (filename, dtype, shape) tuple of a shared array
+    to be passed to open_shared_array() in worker processes.
+    """
+    return (arr.filename, arr.dtype, arr.shape)
+
+
+def open_shared_array(info, mode='r'):
+    """
+    Open an array created by create_shared_array() from its shared_array_info()
+    """
+    return np.memmap(info[0], dtype=info[1], mode=mode, shape=info[2])
+
+
+def remove_shared_array(arr):
+    """
+    Delete the backing file of an array created by create_shared_array()
+    """
+    fname = arr.filename
+    if hasattr(arr, '_mmap') and arr._mmap is not None:
+        arr._mmap.close()
+    try:
+        os.remove(fname)
+    except OSError:
+        qc.print_c('Warning: Could not remove temporary file %s' % fname, 'Y')
+
+
 def slice_win(epochs_data, w_starts, w_length, psde, picks=None, epoch_id=None, flatten=True, verbose=False):
     '''
     Compute PSD values of a sliding window
@@ -36,7 +90,9 @@ def slice_win(epochs_data, w_starts, w_length, psde, picks=None, epoch_id=None,
     Params
         epochs_data: [channels] x [samples]
         w_starts: starting indices of sample segments
-        w_length: window length in number of samples
+        w_length: window length in number of samples, or list of window lengths.
+            With multiple lengths, windows are aligned at the end of the longest window
+            and PSDs are concatenated along the frequency axis of each channel.
         psde: MNE PSDEstimator object
         picks: subset of channels within epochs_data
         epochs_id: just to print out epoch ID associated with PID
@@ -48,55 +104,75 @@ def slice_win(epochs_data, w_starts, w_length, psde, picks=None, epoch_id=None,
         [windows] x [channels*freqs] or [windows] x [channels] x [freqs]
     '''
 
-    # raise error for wrong indexing
-    def WrongIndexError(Exception):
-        sys.stderr.write('\nERROR: %s\n' % Exception)
-        sys.exit(-1)
-
-    w_length = int(w_length)
-
-    if epoch_id is None:
-        print('[PID %d] Frames %d-%d' % (os.getpid(), w_starts[0], w_starts[-1] + w_length - 1))
+    if type(w_length) is list:
+        w_lengths = [int(w) for w in w_length]
     else:
-        print('[PID %d] Epoch %d, Frames %d-%d' % (os.getpid(), epoch_id, w_starts[0], w_starts[-1] + w_length - 1))
-
-    X = None
-    for n in w_starts:
-        n = int(n)
-        if n >= epochs_data.shape[1]:
-            raise WrongIndexError(
-                'w_starts has an out-of-bounds index %d for epoch length %d.' % (n, epochs_data.shape[1]))
-        window = epochs_data[:, n:(n + w_length)]
-
-        # dimension: psde.transform( [epochs x channels x times] )
-        psd = psde.transform(window.reshape((1, window.shape[0], window.shape[1])))
-        psd = psd.reshape((psd.shape[0], psd.shape[1] * psd.shape[2]))
-        if picks:
-            psd = psd[0][picks]
-            psd = psd.reshape((1, len(psd)))
-
-        if X is None:
-            X = psd
-        else:
-            X = np.concatenate((X, psd), axis=0)
+        w_lengths = [int(w_length)]
+    w_max = max(w_lengths)
 
-        if verbose == True:
-            print('[PID %d] processing frame %d / %d' % (os.getpid(), n, w_starts[-1]))
+    if verbose:
+        if epoch_id is None:
+            print('[PID %d] Frames %d-%d' % (os.getpid(), w_starts[0], w_starts[-1] + w_max - 1))
+        else:
+            print('[PID %d] Epoch %d, Frames %d-%d' % (os.getpid(), epoch_id, w_starts[0], w_starts[-1] + w_max - 1))
+
+    w_starts = np.asarray(w_starts, dtype=int)
+    if w_starts[-1] + w_max > epochs_data.shape[1]:
+        raise IndexError('w_starts has an out-of-bounds index %d for epoch length %d.' % (w_starts[-1], epochs_data.shape[1]))
+
+    # stack all windows and compute PSDs in one call per window length
+    # dimension: psde.transform( [windows x channels x times] )
+    psds = []
+    for w_len in w_lengths:
+        offset = w_max - w_len
+        windows = np.empty((len(w_starts), epochs_data.shape[0], w_len))
+        for i, n in enumerate(w_starts):
+            windows[i] = epochs_data[:, (n + offset):(n + w_max)]
+        psds.append(psde.transform(windows))
+    psd = np.concatenate(psds, axis=2)
+    X = psd.reshape((psd.shape[0], psd.shape[1] * psd.shape[2]))
+    if picks:
+        X = X[:, picks]
 
     return X
 
 
-def get_psd(epochs, psde, wlen, wstep, picks=None, flatten=True, n_jobs=1):
+def slice_win_shared(epochs_info, out_info, ep_range, w_starts, w_length, psde, picks=None):
+    """
+    Compute sliding-window PSDs of a range of epochs and write them into a shared array.
+
+    Params
+    ======
+    epochs_info: shared_array_info() of the [epochs] x [channels] x [samples] array
+    out_info: shared_array_info() of the [epochs] x [windows] x [features] output array
+    ep_range: [first, last) epoch indices to be processed
+    w_starts, w_length, psde, picks: see slice_win()
+    """
+    epochs_data = open_shared_array(epochs_info, 'r')
+    X_data = open_shared_array(out_info, 'r+')
+    print('[PID %d] Epochs %d-%d' % (os.getpid(), ep_range[0], ep_range[1] - 1))
+    for ep in range(ep_range[0], ep_range[1]):
+        X_data[ep] = slice_win(epochs_data[ep], w_starts, w_length, psde, picks, ep)
+    X_data.flush()
+    del epochs_data, X_data
+
+
+def get_psd(epochs, psde, wlen, wstep, picks=None, flatten=True, n_jobs=1, pool=None):
     """
     Offline computation of multi-taper PSDs over a sliding window
 
+    Epoch data and the output array are shared with workers through memory-mapped
+    files, and each worker fills a contiguous range of epochs in place.
+
     Params
     epochs: MNE Epochs object
     psde: MNE PSDEstimator object
-    wlen: window length in frames
+    wlen: window length in frames, or list of window lengths (see slice_win())
     wstep: window step in frames
     picks: channel picks
     flatten: boolean, see Returns section
+    n_jobs: number of workers, also used to split epochs into tasks when pool is given
+    pool: multiprocessing.Pool object to reuse. A new pool is created if None.
 
     Returns
     -------
@@ -111,41 +187,58 @@ def get_psd(epochs, psde, wlen, wstep, picks=None, flatten=True, n_jobs=1):
         Accept input as numpy array as well, in addition to Epochs object
     """
 
-    print('get_psd(): Opening a pool of %d workers' % n_jobs)
-    pool = mp.Pool(n_jobs)
-
     labels = epochs.events[:, -1]
     epochs_data = epochs.get_data()
+    if type(wlen) is list:
+        wlen = [int(w) for w in wlen]
+        w_max = max(wlen)
+    else:
+        wlen = int(wlen)
+        w_max = wlen
 
     # sliding window
-    w_starts = np.arange(0, epochs_data.shape[2] - wlen, wstep)
-    X_data = None
-    y_data = None
-    results = []
-    for ep in np.arange(len(labels)):
-        # for debugging (results not saved)
-        # slice_win(epochs_data, w_starts, wlen, psde, picks, ep)
-
-        # parallel psd computation
-        results.append(pool.apply_async(slice_win, [epochs_data[ep], w_starts, wlen, psde, picks, ep]))
-
-    for ep in range(len(results)):
-        r = results[ep].get()  # windows x features
-        X = r.reshape((1, r.shape[0], r.shape[1]))  # 1 x windows x features
-        if X_data is None:
-            X_data = X
-        else:
-            X_data = np.concatenate((X_data, X), axis=0)
+    w_starts = np.arange(0, epochs_data.shape[2] - w_max, wstep)
 
-        # speed comparison: http://stackoverflow.com/questions/5891410/numpy-array-initialization-fill-with-identical-values
-        y = np.empty((1, r.shape[0]))  # 1 x windows
-        y.fill(labels[ep])
-        if y_data is None:
-            y_data = y
-        else:
-            y_data = np.concatenate((y_data, y), axis=0)
-    pool.close()
-    pool.join()
+    # feature dimension from the first window
+    n_features = slice_win(epochs_data[0], w_starts[:1], wlen, psde, picks).shape[1]
+    X_shape = (len(labels), len(w_starts), n_features)
+
+    if pool is None:
+        print('get_psd(): Opening a pool of %d workers' % n_jobs)
+        pool_local = mp.Pool(n_jobs)
+    else:
+        pool_local = pool
+
+    epochs_shared = None
+    X_shared = None
+    try:
+        epochs_shared = create_shared_array(epochs_data.shape, epochs_data.dtype, epochs_data)
+        X_shared = create_shared_array(X_shape, np.float64)
+        del epochs_data
+        epochs_info = shared_array_info(epochs_shared)
+        X_info = shared_array_info(X_shared)
+
+        # one task per worker, each processing a contiguous range of epochs
+        results = []
+        for ep_ids in np.array_split(np.arange(len(labels)), n_jobs):
+            if len(ep_ids) == 0:
+                continue
+            ep_range = [ep_ids[0], ep_ids[-1] + 1]
+            results.append(pool_local.apply_async(slice_win_shared,
+                [epochs_info, X_info, ep_range, w_starts, wlen, psde, picks]))
+        for r in results:
+            r.get()
+        X_data = np.array(X_shared)
+    finally:
+        # remove the temporary files even if a worker failed
+        if pool is None:
+            pool_local.close()
+            pool_local.join()
+        if X_shared is not None:
+            remove_shared_array(X_shared)
+        if epochs_shared is not None:
+            remove_shared_array(epochs_shared)
+    y_data = np.repeat(labels.reshape(-1, 1), len(w_starts), axis=1).astype(np.float64)
 
     if flatten:
         return X_data, y_data
@@ -155,6 +248,64 @@ def get_psd(epochs, psde, wlen, wstep, picks=None, flatten=True, n_jobs=1):
         return X_data.reshape(xs[0], xs[1], nch, int(xs[2] / nch)), y_data
 
 
+def decimate_mean(data, downsample):
+    """
+    Downsample signals by averaging every n samples along the last axis
+
+    The signal length is trimmed from the beginning to the nearest multiple of
+    downsample so that the last sample is always kept. This makes offline features
+    consistent with online windows, which always end at the latest sample.
+
+    Params
+    ======
+    data: [...] x [times] array
+    downsample: number of samples to average
+
+    Returns
+    =======
+    [...] x [times / downsample] array
+    """
+    downsample = int(downsample)
+    n_ds = data.shape[-1] // downsample
+    data = data[..., data.shape[-1] - n_ds * downsample:]
+    return data.reshape(data.shape[:-1] + (n_ds, downsample)).mean(axis=-1)
+
+
+def sliding_windows(data, wlen, wstep):
+    """
+    Return a read-only view of sliding windows along the last axis without copying
+
+    Windows are aligned at the end of the signal, i.e. the last window ends at the
+    last sample.
+
+    Params
+    ======
+    data: [...] x [times] array
+    wlen: window length in samples
+    wstep: window step in samples
+
+    Returns
+    =======
+    [...] x [windows] x [wlen] array view
+    """
+    wlen = int(wlen)
+    wstep = int(wstep)
+    if wlen > data.shape[-1]:
+        raise ValueError('Window length %d is longer than the signal length %d.' % (wlen, data.shape[-1]))
+    try:
+        from numpy.lib.stride_tricks import sliding_window_view
+        windows = sliding_window_view(data, wlen, axis=-1)
+    except ImportError:
+        # numpy < 1.20
+        from numpy.lib.stride_tricks import as_strided
+        data = np.asarray(data)
+        shape = data.shape[:-1] + (data.shape[-1] - wlen + 1, wlen)
+        strides = data.strides + (data.strides[-1],)
+        windows = as_strided(data, shape=shape, strides=strides, writeable=False)
+    offset = (data.shape[-1] - wlen) % wstep
+    return windows[..., offset::wstep, :]
+
+
 # note that MNE already has find_events function
 def find_events(events_raw):
     """
@@ -199,7 +350,6 @@ def find_event_channel(raw, ch_names=None):
                     and max(raw[ch]) < 256 and min(raw[ch]) == 0:
                 return ch
     else:
-        signals = raw._data
         for ch_name in raw.ch_names:
             if 'TRIGGER' in ch_name or 'STI ' in ch_name:
                 return raw.ch_names.index(ch_name)
@@ -249,14 +399,15 @@ def event_timestamps_to_indices(sigfile, eventfile):
     Convert LSL timestamps to sample indices for separetely recorded events.
 
     Parameters:
-    sigfile: raw signal file (Python Pickle) recorded with stream_recorder.py.
+    sigfile: raw signal file (.dat or Python Pickle) recorded with stream_recorder.py.
     eventfile: event file where events are indexed with LSL timestamps.
 
     Returns:
     events list, which can be used as an input to mne.io.RawArray.add_events().
     """
+    from pycnbi.stream_recorder.stream_writer import load_record
 
-    raw = qc.load_obj(sigfile)
+    raw = load_record(sigfile)
     ts = raw['timestamps'].reshape(-1)
     ts_min = min(ts)
     ts_max = max(ts)
@@ -476,9 +627,33 @@ def preprocess(raw, sfreq=None, spatial=None, spatial_ch=None, spectral=None, sp
     return True
 
 
+def read_raw(rawfile, preload=False, verbose='ERROR'):
+    """
+    Read a fif file or a BrainVision file (.vhdr) written by stream_recorder
+
+    The trigger channel of BrainVision files is set to stim type so that
+    they can be used in the same way as fif files.
+    """
+    extension = qc.parse_path(rawfile).ext
+    if extension in ['fif', 'fiff']:
+        return mne.io.read_raw_fif(rawfile, preload=preload, verbose=verbose)
+    elif extension == 'vhdr':
+        try:
+            # older MNE versions create a synthetic stim channel from markers
+            raw = mne.io.read_raw_brainvision(rawfile, preload=preload, stim_channel=False, verbose=verbose)
+        except TypeError:
+            raw = mne.io.read_raw_brainvision(rawfile, preload=preload, verbose=verbose)
+        tch = find_event_channel(raw)
+        if tch is not None:
+            raw.set_channel_types({raw.ch_names[tch]:'stim'})
+        return raw
+    else:
+        raise ValueError('Unsupported file format %s. Only fif and vhdr formats are supported.' % extension)
+
+
 def load_raw(rawfile, spfilter=None, spchannels=None, events_ext=None, multiplier=1, verbose='ERROR'):
     """
-    Loads data from a fif-format file.
+    Loads data from a fif-format file or a BrainVision file (.vhdr) written by stream_recorder.
     You can convert non-fif files (.eeg, .bdf, .gdf, .pcl) to fif format.
 
     Parameters:
@@ -506,9 +681,7 @@ def load_raw(rawfile, spfilter=None, spchannels=None, events_ext=None, multiplie
     if not os.path.isfile(rawfile):
         raise IOError('%s is not a file' % rawfile)
 
-    extension = qc.parse_path(rawfile).ext
-    assert extension in ['fif', 'fiff'], 'only fif format is supported'
-    raw = mne.io.Raw(rawfile, preload=True, verbose=verbose)
+    raw = read_raw(rawfile, preload=True, verbose=verbose)
     preprocess(raw, spatial=spfilter, spatial_ch=spchannels, multiplier=multiplier)
     if events_ext is not None:
         events = mne.read_events(events_ext)
@@ -523,18 +696,55 @@ def load_raw(rawfile, spfilter=None, spchannels=None, events_ext=None, multiplie
     return raw, events
 
 
-def load_multi(src, spfilter=None, spchannels=None, multiplier=1):
+def read_raw_into(rawfile, out, block_size=1000000):
+    """
+    Read the signals of a fif file into a preallocated array and find its events.
+
+    Data are read block by block so that no full-size temporary copy is created.
+
+    Params
+    ======
+    rawfile: fif or vhdr file path
+    out: array view of [channels] x [samples] to be filled
+    block_size: number of samples read at once
+
+    Returns
+    =======
+    events: mne-compatible events array with sample indices relative to the file start
+    """
+    raw = read_raw(rawfile, preload=False)
+    n_times = raw.n_times
+    if out.shape[1] != n_times:
+        raise ValueError('Output length %d does not match the file length %d.' % (out.shape[1], n_times))
+    for start in range(0, n_times, block_size):
+        stop = min(start + block_size, n_times)
+        out[:, start:stop] = raw.get_data(start=start, stop=stop)
+    tch = find_event_channel(raw)
+    if tch is None:
+        return np.zeros((0, 3), dtype=int)
+    events = mne.find_events(raw, stim_channel=raw.ch_names[tch], shortest_event=1, uint_cast=True,
+                             consecutive=True)
+    events[:, 0] -= raw.first_samp
+    return events
+
+
+def load_multi(src, spfilter=None, spchannels=None, multiplier=1, n_jobs=1):
     """
     Load multiple data files and concatenate them into a single series
 
     - Assumes all files have the same sampling rate and channel order.
     - Event locations are updated accordingly with new offset.
 
+    The total length is computed from the file headers and the signals are
+    read directly into a single preallocated array, in parallel if n_jobs > 1.
+    Events are detected in each file and shifted by the file offset.
+
     @params:
         src: directory or list of files.
         spfilter: apply spatial filter while loading.
         spchannels: list of channel names to apply spatial filter.
         multiplier: to change units for better numerical stability.
+        n_jobs: number of files read in parallel.
 
     See load_raw() for more low-level details.
 
@@ -545,7 +755,7 @@ def load_multi(src, spfilter=None, spchannels=None, multiplier=1):
             raise IOError('%s is not a directory or does not exist.' % src)
         flist = []
         for f in qc.get_file_list(src):
-            if qc.parse_path_list(f)[2] == 'fif':
+            if qc.parse_path_list(f)[2] in ['fif', 'vhdr']:
                 flist.append(f)
     elif type(src) in [list, tuple]:
         flist = src
@@ -557,32 +767,56 @@ def load_multi(src, spfilter=None, spchannels=None, multiplier=1):
     elif len(flist) == 1:
         return load_raw(flist[0], spfilter=spfilter, spchannels=spchannels, multiplier=multiplier)
 
-    # load raw files
-    rawlist = []
+    # read headers only to compute the total length
+    offsets = [0]
+    raw_info = None
     for f in flist:
-        print('Loading %s' % f)
-        raw, _ = load_raw(f, spfilter=spfilter, spchannels=spchannels, multiplier=multiplier)
-        rawlist.append(raw)
-
-    # concatenate signals
-    signals = None
-    for raw in rawlist:
-        if signals is None:
-            signals = raw._data
-        else:
-            signals = np.concatenate((signals, raw._data), axis=1) # append samples
-
-    # create a concatenated raw object and update channel names
-    raw = rawlist[0]
-    trigch = find_event_channel(raw)
-    ch_types = ['eeg'] * len(raw.ch_names)
+        if not os.path.exists(f):
+            raise IOError('File %s not found' % f)
+        raw = read_raw(f, preload=False)
+        if raw_info is None:
+            raw_info = raw
+        elif raw.ch_names != raw_info.ch_names:
+            raise RuntimeError('Channel names of %s differ from %s.' % (f, flist[0]))
+        elif raw.info['sfreq'] != raw_info.info['sfreq']:
+            raise RuntimeError('Sampling rate of %s differs from %s.' % (f, flist[0]))
+        offsets.append(offsets[-1] + raw.n_times)
+
+    # read each file into its slice
+    signals = np.empty((len(raw_info.ch_names), offsets[-1]))
+    if n_jobs is None:
+        n_jobs = mp.cpu_count()
+    n_jobs = min(n_jobs, len(flist))
+    if n_jobs > 1:
+        from multiprocessing.pool import ThreadPool
+        pool = ThreadPool(n_jobs)
+        results = []
+        for i, f in enumerate(flist):
+            print('Loading %s' % f)
+            results.append(pool.apply_async(read_raw_into, [f, signals[:, offsets[i]:offsets[i + 1]]]))
+        pool.close()
+        pool.join()
+        event_list = [r.get() for r in results]
+    else:
+        event_list = []
+        for i, f in enumerate(flist):
+            print('Loading %s' % f)
+            event_list.append(read_raw_into(f, signals[:, offsets[i]:offsets[i + 1]]))
+
+    # create a concatenated raw object
+    trigch = find_event_channel(raw_info)
+    ch_types = ['eeg'] * len(raw_info.ch_names)
     if trigch is not None:
         ch_types[trigch] = 'stim'
-    info = mne.create_info(raw.ch_names, raw.info['sfreq'], ch_types)
+    info = mne.create_info(raw_info.ch_names, raw_info.info['sfreq'], ch_types)
+    # float64 data are used without copying
     raw_merged = mne.io.RawArray(signals, info)
+    preprocess(raw_merged, spatial=spfilter, spatial_ch=spchannels, multiplier=multiplier)
 
-    # re-calculate event positions
-    events = mne.find_events(raw_merged, stim_channel='TRIGGER', shortest_event=1, consecutive=True)
+    # shift event positions by file offsets
+    for i, ev in enumerate(event_list):
+        ev[:, 0] += offsets[i]
+    events = np.concatenate(event_list, axis=0)
 
     return raw_merged, events
 
@@ -20,7 +20,9 @@ import inspect
 import pdb
 import traceback
 import itertools
+import json
 import numpy as np
+from contextlib import contextmanager
 try:
     import cPickle as pickle  # Python 2 (cPickle = C version of pickle)
 except ImportError:
@@ -569,6 +571,116 @@ class Timer(object):
             if self.autoreset: self.reset()
 
 
+def get_memory_usage(children=False):
+    """
+    Get the current and peak resident memory size of this process in MB
+
+    If children=True, the peak memory of terminated child processes is returned instead
+    and the current memory is None. None is returned for unavailable values.
+    """
+    rss = None
+    peak = None
+    if children is False:
+        try:
+            import psutil
+            meminfo = psutil.Process().memory_info()
+            rss = meminfo.rss / 1048576.0
+            if hasattr(meminfo, 'peak_wset'):
+                peak = meminfo.peak_wset / 1048576.0  # Windows
+        except ImportError:
+            pass
+    if peak is None:
+        try:
+            import resource
+            if children:
+                maxrss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+            else:
+                maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            # ru_maxrss is in bytes on OS X and kilobytes on Linux
+            if sys.platform == 'darwin':
+                peak = maxrss / 1048576.0
+            else:
+                peak = maxrss / 1024.0
+        except ImportError:
+            pass
+    return rss, peak
+
+
+class StageProfiler(object):
+    """
+    Record wall-clock time and memory usage of named processing stages
+
+    Usage:
+        profiler = StageProfiler()
+        with profiler.stage('load'):
+            load_data()
+        profiler.add('fold', 1.5, fold=0)  # stage timed elsewhere, e.g. in a child process
+        profiler.save_json('profile.json')
+
+    Each stage records the current memory (rss_mb) and the peak memory of the process
+    so far (peak_so_far_mb), which repeats the earlier peak unless the stage exceeded it.
+    Stages run with stage() also record the increase of the peak during the stage (peak_delta_mb).
+
+    """
+
+    def __init__(self):
+        self.stages = []
+        self.timer = Timer()
+
+    @contextmanager
+    def stage(self, name, **info):
+        _, peak_start = get_memory_usage()
+        timer = Timer()
+        try:
+            yield
+        finally:
+            _, peak_end = get_memory_usage()
+            if peak_start is not None and peak_end is not None:
+                info['peak_delta_mb'] = peak_end - peak_start
+            self.add(name, timer.sec(), **info)
+
+    def add(self, name, sec, **info):
+        rss, peak = get_memory_usage()
+        record = dict(name=name, sec=sec, rss_mb=rss, peak_so_far_mb=peak)
+        record.update(info)
+        self.stages.append(record)
+
+    def total(self, name):
+        """
+        Total seconds spent in stages with the given name
+        """
+        return sum([s['sec'] for s in self.stages if s['name'] == name])
+
+    def get_report(self):
+        """
+        Return a dictionary of all stages and a summary of the whole run
+        """
+        rss, peak = get_memory_usage()
+        _, peak_children = get_memory_usage(children=True)
+        names = []
+        for s in self.stages:
+            if s['name'] not in names:
+                names.append(s['name'])
+        summary = [dict(name=n, sec=self.total(n), count=len([s for s in self.stages if s['name'] == n]))
+                   for n in names]
+        return dict(total_sec=self.timer.sec(), rss_mb=rss, peak_mb=peak, peak_children_mb=peak_children,
+                    summary=summary, stages=self.stages)
+
+    def print_summary(self):
+        report = self.get_report()
+        print('\n>> Timing breakdown (total %.1f sec)' % report['total_sec'])
+        for s in report['summary']:
+            print('%-20s %8.2f sec  (%d call%s)' % (s['name'], s['sec'], s['count'], '' if s['count'] == 1 else 's'))
+        if report['peak_mb'] is not None:
+            print('Peak memory: %.1f MB' % report['peak_mb'])
+        if report['peak_children_mb']:
+            print('Peak memory of child processes: %.1f MB' % report['peak_children_mb'])
+
+    def save_json(self, filename):
+        with open(filename, 'w') as f:
+            json.dump(self.get_report(), f, indent=2, sort_keys=True)
+
+
 '''"""""""""""""""""""""""""""""""""""""""""""""""""""""""""""
  ETC
 """""""""""""""""""""""""""""""""""""""""""""""""""""""""""'''
@@ -0,0 +1,135 @@
+from __future__ import print_function, division
+
+"""
+Synthetic EEG data generator
+
+Generates deterministic motor imagery-like recordings for testing and
+benchmarking. Each trial has a rest period followed by an imagery period
+during which the band power of class-specific channels is attenuated
+(event-related desynchronization). Background activity is 1/f noise with
+an ongoing rhythm in the modulated band.
+
+The channel layout follows the PyCNBI convention: channel 0 is the trigger
+channel named TRIGGER, followed by EEG channels CH1, CH2, ...
+
+"""
+
+import mne
+import numpy as np
+import pycnbi.utils.q_common as qc
+from scipy.signal import butter, lfilter
+from builtins import input
+mne.set_log_level('ERROR')
+
+
+def pink_noise(n_channels, n_samples, rng):
+    """
+    Generate 1/f noise with unit variance per channel
+    """
+    spectrum = np.fft.rfft(rng.randn(n_channels, n_samples), axis=1)
+    f = np.arange(spectrum.shape[1], dtype=np.float64)
+    f[0] = 1.0
+    spectrum /= np.sqrt(f)
+    noise = np.fft.irfft(spectrum, n=n_samples, axis=1)
+    noise /= noise.std(axis=1, keepdims=True)
+    return noise
+
+
+def make_raw(n_channels=16, sfreq=512, n_trials=40, labels=None, rest_sec=3.0, mi_sec=5.0,
+             band=(8.0, 13.0), erd=0.5, amplitude=10.0, seed=0):
+    """
+    Create a synthetic recording
+
+    Params
+    ======
+    n_channels: number of EEG channels
+    sfreq: sampling rate
+    n_trials: total number of trials, equally divided among classes
+    labels: list of trigger values for each class. Default: LEFT_GO and RIGHT_GO of triggerdef_16.ini
+    rest_sec: length of rest period before each imagery period
+    mi_sec: length of imagery period
+    band: frequency band of the modulated rhythm
+    erd: relative band power attenuation during imagery of a class (0-1)
+    amplitude: signal amplitude in microvolts
+    seed: random seed; the same parameters always generate the same data
+
+    Returns
+    =======
+    raw: mne.io.RawArray object
+    events: mne-compatible events array (N x [frame, 0, type])
+
+    Class k attenuates the rhythm over the k-th group of channels, where channels
+    are divided into len(labels) contiguous groups.
+    """
+    if labels is None:
+        from pycnbi.triggers.trigger_def import trigger_def
+        tdef = trigger_def('triggerdef_16.ini')
+        labels = [tdef.LEFT_GO, tdef.RIGHT_GO]
+    if not 0 <= erd < 1:
+        raise ValueError('erd must be in [0, 1).')
+    rng = np.random.RandomState(seed)
+
+    trial_len = int(round((rest_sec + mi_sec) * sfreq))
+    rest_len = int(round(rest_sec * sfreq))
+    n_samples = trial_len * n_trials + rest_len
+    trial_labels = np.array([labels[i % len(labels)] for i in range(n_trials)])
+    rng.shuffle(trial_labels)
+
+    # ongoing rhythm in the modulated band
+    b, a = butter(4, [band[0] / (sfreq / 2.0), band[1] / (sfreq / 2.0)], btype='band')
+    rhythm = lfilter(b, a, rng.randn(n_channels, n_samples), axis=1)
+    rhythm /= rhythm.std(axis=1, keepdims=True)
+    gain = np.ones((n_channels, n_samples))
+
+    # class-specific attenuation
+    groups = np.array_split(np.arange(n_channels), len(labels))
+    trigger = np.zeros((1, n_samples))
+    events = []
+    for i, label in enumerate(trial_labels):
+        onset = rest_len + i * trial_len
+        trigger[0, onset] = label
+        events.append([onset, 0, label])
+        chs = groups[labels.index(label)]
+        gain[chs, onset:onset + trial_len - rest_len] = np.sqrt(1.0 - erd)
+
+    signals = amplitude * (pink_noise(n_channels, n_samples, rng) + 2.0 * gain * rhythm)
+    ch_names = ['TRIGGER'] + ['CH%d' % (x + 1) for x in range(n_channels)]
+    ch_info = ['stim'] + ['eeg'] * n_channels
+    info = mne.create_info(ch_names, sfreq, ch_info)
+    raw = mne.io.RawArray(np.concatenate((trigger, signals), axis=0), info)
+    return raw, np.array(events)
+
+
+def save_fif(outdir, n_files=1, seed=0, **kwargs):
+    """
+    Generate synthetic recordings and save them as fif files
+
+    Params
+    ======
+    outdir: output directory
+    n_files: number of files. Each file uses seed + file index as random seed.
+    seed: base random seed
+    kwargs: parameters passed to make_raw()
+
+    Returns
+    =======
+    List of file paths
+    """
+    qc.make_dirs(outdir)
+    files = []
+    for i in range(n_files):
+        raw, events = make_raw(seed=seed + i, **kwargs)
+        fiffile = '%s/synthetic-%02d-raw.fif' % (outdir, i)
+        raw.save(fiffile, overwrite=True)
+        files.append(fiffile)
+        print('Saved %s (%d channels, %d events)' % (fiffile, len(raw.ch_names) - 1, len(events)))
+    return files
+
+
+if __name__ == '__main__':
+    import sys
+    if len(sys.argv) < 2:
+        outdir = input('Output directory? ')
+    else:
+        outdir = sys.argv[1]
+    save_fif(outdir)